@@ -0,0 +1,113 @@
+import argparse
+import importlib
+import os
+import sys
+import time
+
+from typing import Dict, List
+
+
+# The subcommands and the script each of them runs.
+COMMANDS = {
+    'players': 'players',
+    'raw-data': 'raw_data',
+    'pairings': 'pairings',
+    'awards': 'awards',
+    'weekly': 'pipeline',
+    'perf-rtg': 'perf_rtg',
+    'snapshot': 'snapshot',
+    'simulate': 'simulate',
+}
+
+
+class ImportTimer:
+    """Measures how long each module takes to import, without the modules it imports itself.
+    It sits in front of the other finders on sys.meta_path and times the loaders they return.
+    """
+
+    def __init__(self):
+        self.times: Dict[str, float] = dict()
+        self.nested: List[float] = []
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+
+        # Builtin and frozen modules are loaded by classes that are shared by all of them.
+        loader = spec.loader
+        if loader is not None and not isinstance(loader, type) and hasattr(loader, 'exec_module'):
+            loader.exec_module = self._timed(name, loader.exec_module)
+
+        return spec
+
+    def _timed(self, name, exec_module):
+        def timed_exec_module(module):
+            self.nested.append(0)
+            start = time.perf_counter()
+
+            try:
+                exec_module(module)
+            finally:
+                elapsed = time.perf_counter() - start
+                nested = self.nested.pop()
+                self.times[name] = elapsed - nested
+
+                if self.nested:
+                    self.nested[-1] += elapsed
+
+        return timed_exec_module
+
+    def __enter__(self):
+        sys.meta_path.insert(0, self)
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.meta_path.remove(self)
+
+    def report(self, top: int = 15) -> str:
+        """Sums up the import times by top-level package, slowest first."""
+        packages = dict()
+        for name, seconds in self.times.items():
+            package = name.split('.')[0]
+            packages[package] = packages.get(package, 0) + seconds
+
+        lines = [f'Imported {len(self.times)} modules in {sum(self.times.values()):.3f}s']
+        for package, seconds in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+            lines.append(f'  {seconds:7.3f}s  {package}')
+
+        return '\n'.join(lines)
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(prog='python -m src', description='Runs one of the league scripts.')
+    parser.add_argument('--import-times', action='store_true', help='report how long the imports of each package took')
+    parser.add_argument('command', choices=list(COMMANDS), help='the script to run')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='passed on to the script, see python -m src COMMAND --help')
+    args = parser.parse_args(argv)
+
+    # The scripts import each other as top-level modules.
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.argv[0] = f'python -m src {args.command}'
+
+    if not args.import_times:
+        importlib.import_module(COMMANDS[args.command]).main(args.args)
+        return
+
+    # Also times the modules that the script only imports once it needs them.
+    timer = ImportTimer()
+    try:
+        with timer:
+            importlib.import_module(COMMANDS[args.command]).main(args.args)
+    finally:
+        print(timer.report(), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
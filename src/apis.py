@@ -1,22 +1,313 @@
-import berserk
-import gspread
+import functools
+import random
+import threading
+import time
 
-from berserk import Client, TokenSession
-from gspread import Spreadsheet
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Callable, Iterator, Optional
 
+from instrumentation import count, span, timed
+
+# berserk and gspread take a while to import, they are only loaded once a client is created.
+if TYPE_CHECKING:
+    from berserk import Client
+    from gspread import Spreadsheet
+
+
+LICHESS_URL = 'https://lichess.org'
+
+# Lichess asks clients to wait a full minute after a 429 if it doesn't say otherwise.
+RATE_LIMIT_BACKOFF = 60
+
+# Statuses that are worth retrying, the service is overloaded or rate limits us.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Spaces out the requests to a service. The bucket holds up to `capacity` tokens which refill
+    at `rate` tokens per second and every request takes one. A rate limit response empties the
+    bucket for everyone until the service allows requests again.
+    """
+
+    def __init__(self, rate: float, capacity: int, name: str = 'lichess'):
+        self.rate = rate
+        self.capacity = capacity
+        self.name = name
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        with span(f'{self.name}.throttle'):
+            self._acquire()
+
+    def _acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+
+                    wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def block(self, seconds: float):
+        """Holds back all requests for the given number of seconds.
+
+        Args:
+            seconds (float): How long to wait before the next request.
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+def get_status(error: Exception) -> Optional[int]:
+    """Reads the HTTP status of a failed request from the error berserk, gspread or requests raised.
+
+    Args:
+        error (Exception): The error.
+
+    Returns:
+        Optional[int]: The status, or None if the request didn't get a response.
+    """
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Reads how long to wait from the Retry-After header of a failed request.
+
+    Args:
+        error (Exception): The error.
+
+    Returns:
+        Optional[float]: The number of seconds to wait, or None if the response doesn't say.
+    """
+    response = getattr(error, 'response', None)
+
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def is_transient(error: Exception) -> bool:
+    """Checks whether a request that failed with the error may succeed when it is sent again."""
+    status = get_status(error)
+
+    if status is not None:
+        return status in RETRY_STATUSES
+
+    # A dropped connection or a timeout, not an error of the client. berserk wraps them.
+    import requests
+
+    cause = error.__cause__ if error.__cause__ is not None else error
+    return isinstance(cause, (requests.ConnectionError, requests.Timeout))
+
+
+class Service:
+    """A web service the scripts talk to. All requests to it share one retry policy and a limit on
+    how many of them may be in flight at once, and optionally a token bucket that spaces them out.
+    Transient errors (429, 5xx, dropped connections) are retried with exponential backoff and
+    jitter, or after the time the service asks for in Retry-After.
+    """
+
+    def __init__(self, name: str, concurrency: int, bucket: TokenBucket = None, max_retries: int = 3, initial_backoff: float = 1, max_backoff: float = 64, rate_limit_backoff: float = None):
+        """Creates a service.
+
+        Args:
+            name (str): The name of the service, it prefixes its counters in the run report.
+            concurrency (int): How many requests may be in flight at once.
+            bucket (TokenBucket, optional): Spaces out the requests. Defaults to None.
+            max_retries (int, optional): How often a request is retried. Defaults to 3.
+            initial_backoff (float, optional): The wait before the first retry (in s), doubled
+                for every further retry. Defaults to 1.
+            max_backoff (float, optional): The longest wait between retries (in s). Defaults to 64.
+            rate_limit_backoff (float, optional): The wait after a 429 without Retry-After (in s).
+                Defaults to the exponential backoff.
+        """
+        self.name = name
+        self.concurrency = concurrency
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.bucket = bucket
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.rate_limit_backoff = rate_limit_backoff
+
+    @contextmanager
+    def request(self) -> Iterator[None]:
+        """Holds one of the service's slots while a request, including a streamed response, is in flight."""
+        with span(f'{self.name}.wait_for_slot'):
+            self.slots.acquire()
+
+        try:
+            if self.bucket is not None:
+                self.bucket.acquire()
+
+            count(f'{self.name}.requests')
+            yield
+        finally:
+            self.slots.release()
+
+    def backoff(self, error: Exception, attempt: int, max_retries: int = None, initial_backoff: float = None) -> float:
+        """Decides how long to wait before retrying a failed request.
+
+        Args:
+            error (Exception): The error the request failed with.
+            attempt (int): The number of the failed attempt, starting at 0.
+            max_retries (int, optional): Overrides the service's number of retries. Defaults to None.
+            initial_backoff (float, optional): Overrides the service's initial backoff. Defaults to None.
+
+        Returns:
+            float: The number of seconds to wait.
+
+        Raises:
+            Exception: The error, if it isn't transient or the retries are used up.
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        initial_backoff = self.initial_backoff if initial_backoff is None else initial_backoff
+
+        if attempt >= max_retries or not is_transient(error):
+            raise error
+
+        seconds = get_retry_after(error)
+
+        if seconds is None and get_status(error) == 429 and self.rate_limit_backoff is not None:
+            seconds = self.rate_limit_backoff
+
+        if seconds is None:
+            # The jitter keeps requests that failed together from being retried together.
+            seconds = random.uniform(0.5, 1) * min(self.max_backoff, initial_backoff * 2 ** attempt)
+
+        print(f"{self.name} request failed (attempt {attempt + 1}/{max_retries + 1}): {error}. Retrying in {seconds:.1f}s...")
+        count(f'{self.name}.retries')
+        count(f'{self.name}.backoff_s', seconds)
+
+        return seconds
+
+    def wait(self, seconds: float):
+        """Waits before a retry. With a token bucket the other requests to the service wait too."""
+        if self.bucket is not None:
+            self.bucket.block(seconds)
+        else:
+            time.sleep(seconds)
+
+    def call(self, fn: Callable[..., Any], *args, max_retries: int = None, initial_backoff: float = None, **kwargs) -> Any:
+        """Sends a request, retrying it on transient errors.
+
+        Args:
+            fn (Callable[..., Any]): Sends the request, e.g. client.users.get_by_id.
+            args: Passed on to fn.
+            max_retries (int, optional): Overrides the service's number of retries. Defaults to None.
+            initial_backoff (float, optional): Overrides the service's initial backoff. Defaults to None.
+            kwargs: Passed on to fn.
+
+        Returns:
+            Any: What fn returned.
+        """
+        attempt = 0
+
+        while True:
+            try:
+                with self.request():
+                    return fn(*args, **kwargs)
+            except Exception as e:
+                seconds = self.backoff(e, attempt, max_retries, initial_backoff)
+
+            self.wait(seconds)
+            attempt += 1
+
+
+# Lichess wants one request at a time and not much more than one per second.
+LICHESS = Service('lichess', concurrency=1, bucket=TokenBucket(rate=1, capacity=2), rate_limit_backoff=RATE_LIMIT_BACKOFF)
+
+# The Sheets API allows 60 requests per minute per user, which the scripts stay well below.
+SHEETS = Service('sheets', concurrency=4)
+
+
+def _pool_connections(session, service: Service):
+    from requests.adapters import HTTPAdapter
+
+    # Keeps a connection open for each slot of the service, retries are left to the service.
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=service.concurrency, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+def create_lichess_client(session, base_url: str = LICHESS_URL) -> 'Client':
+    """Creates a berserk client on a session. The client keeps the session and the url as
+    `session` and `base_url`, for the requests that are sent without berserk, see
+    lichess_export.BatchExporter.export_records.
+
+    Args:
+        session (requests.Session): The session the requests are sent with.
+        base_url (str, optional): The url of Lichess. Defaults to LICHESS_URL.
+
+    Returns:
+        Client: The client.
+    """
+    from berserk import Client
+
+    client = Client(session=session, base_url=base_url)
+    client.session = session
+    client.base_url = base_url
+
+    return client
+
+
+@functools.lru_cache(maxsize=None)
+@timed('apis.init_lichess')
+def init_lichess_api() -> 'Client':
+    """Creates the Lichess client, once per process. Its session keeps the connection to Lichess open."""
+    from berserk import TokenSession
 
-def init_lichess_api() -> Client:
     with open('auth/lichess.txt') as f:
         lichess_auth_token = f.read()
-        
+
         session = TokenSession(lichess_auth_token)
-        client = Client(session=session)
+        _pool_connections(session, LICHESS)
+
+        return create_lichess_client(session)
+
+
+class LazyLichessClient:
+    """Stands in for the Lichess client and only creates it once it is used, so runs that don't
+    have to ask Lichess anything neither read the token nor load berserk.
+    """
+
+    def __init__(self, init=init_lichess_api):
+        self._init = init
+        self._client = None
+        self._lock = threading.Lock()
 
-        return client
-    
+    def __getattr__(self, name):
+        with self._lock:
+            if self._client is None:
+                self._client = self._init()
+
+        return getattr(self._client, name)
+
+
+@functools.lru_cache(maxsize=None)
+@timed('apis.init_gspread')
+def init_gspread_api() -> 'Spreadsheet':
+    """Opens the league spreadsheet, once per process. Its session keeps the connections to Google open."""
+    import gspread
 
-def init_gspread_api() -> Spreadsheet:
     gc = gspread.service_account()
-    sh = gc.open("Lichess4545 - Infinite Correspondence")
+    _pool_connections(gc.http_client.session, SHEETS)
+
+    sh = SHEETS.call(gc.open, "Lichess4545 - Infinite Correspondence")
 
-    return sh
\ No newline at end of file
+    return sh
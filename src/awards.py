@@ -1,8 +1,28 @@
+import argparse
 import chess
+import math
+import numpy as np
+import os
+import pandas as pd
 
-from apis import init_lichess_api
+from concurrent.futures import ProcessPoolExecutor
 
-from typing import List, Dict
+from apis import LazyLichessClient, init_gspread_api
+from eval_analytics import EVAL_CAP, EvalBatch, compensation
+from game_store import GameStore
+from lichess_export import GameRecord, UNFINISHED_STATUSES, analysis_score
+from gspread_utils import download_as_dataframe
+from instrumentation import add_report_args, count, run_report, span
+from snapshot import load_snapshot
+
+from typing import Any, Callable, List, Dict, Iterable, Iterator, Optional, Sequence, Tuple, Type
+
+
+# Bump this whenever compute_compensation changes, so stored results get recomputed.
+COMPENSATION_VERSION = 1
+
+# Below this many games starting worker processes costs more than it saves.
+PARALLEL_BATCH_SIZE = 256
 
 
 def get_material(board: chess.Board):
@@ -28,7 +48,11 @@ def get_material(board: chess.Board):
     return w_mat, b_mat
 
 
-def compute_compensation(game: Dict):
+def compute_compensation_reference(game: Dict):
+    """Computes the compensation by replaying the game with python-chess and recounting the
+    material after every move. Much slower than compute_compensation, which has to return the
+    same result.
+    """
     moves = game['moves'].split(' ')
     evals = game['analysis']
 
@@ -60,13 +84,737 @@ def compute_compensation(game: Dict):
     return round(100 * w_comp / n_moves), round(100 * b_comp / n_moves)
 
 
-if __name__ == '__main__':
-    client = init_lichess_api()
+# Squares are numbered from a1 = 0 to h8 = 63, pieces are stored as their python-chess piece type,
+# positive for white and negative for black.
+MATERIAL_VALUES = [0, 1, 3, 3, 5, 9, 0]
+PIECE_SYMBOLS = {'N': chess.KNIGHT, 'B': chess.BISHOP, 'R': chess.ROOK, 'Q': chess.QUEEN, 'K': chess.KING}
+
+ORTHOGONAL = [(0, 1), (0, -1), (1, 0), (-1, 0)]
+DIAGONAL = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+
+
+def _build_rays():
+    rays = []
+    for sq in range(64):
+        file, rank = sq % 8, sq // 8
+        sq_rays = []
+        for df, dr in ORTHOGONAL + DIAGONAL:
+            ray = []
+            f, r = file + df, rank + dr
+            while 0 <= f < 8 and 0 <= r < 8:
+                ray.append(r * 8 + f)
+                f, r = f + df, r + dr
+            sq_rays.append(ray)
+        rays.append(sq_rays)
+    return rays
+
+
+# RAYS[sq][d] lists the squares seen from sq in direction d, the first four directions are orthogonal.
+RAYS = _build_rays()
+# RAY_INDEX[a][b] is the direction in which b lies as seen from a, if it lies on a line with it.
+RAY_INDEX = [{target: d for d, ray in enumerate(RAYS[sq]) for target in ray} for sq in range(64)]
+KNIGHT_SOURCES = [
+    [(sq // 8 + dr) * 8 + sq % 8 + df for df, dr in [(1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)]
+     if 0 <= sq % 8 + df < 8 and 0 <= sq // 8 + dr < 8]
+    for sq in range(64)
+]
+SLIDER_DIRECTIONS = {chess.BISHOP: range(4, 8), chess.ROOK: range(0, 4), chess.QUEEN: range(0, 8)}
+
+
+class MaterialTracker:
+    """Replays a game from its SAN moves while keeping the material of both sides up to date. It
+    only resolves the square each move starts from, so unlike python-chess it neither generates
+    legal moves nor recounts the material after every move. The material only changes on captures
+    and promotions.
+    """
+
+    def __init__(self):
+        self.board = [0] * 64
+        for file, ptype in enumerate([chess.ROOK, chess.KNIGHT, chess.BISHOP, chess.QUEEN, chess.KING, chess.BISHOP, chess.KNIGHT, chess.ROOK]):
+            self.board[file] = ptype
+            self.board[8 + file] = chess.PAWN
+            self.board[48 + file] = -chess.PAWN
+            self.board[56 + file] = -ptype
+
+        self.kings = {1: 4, -1: 60}
+        self.turn = 1
+        self.w_mat = 39
+        self.b_mat = 39
+
+    def push_san(self, san: str):
+        """Plays a move given in SAN.
+
+        Args:
+            san (str): The move, e.g. 'Nbxd7+'.
+
+        Raises:
+            ValueError: If the move can't be played in the current position.
+        """
+        board = self.board
+        turn = self.turn
+        san = san.rstrip('+#')
+
+        if san.startswith('O-O'):
+            rank = 0 if turn == 1 else 56
+            if san == 'O-O':
+                self._move(rank + 4, rank + 6)
+                self._move(rank + 7, rank + 5)
+            else:
+                self._move(rank + 4, rank + 2)
+                self._move(rank, rank + 3)
+            self.turn = -turn
+            return
+
+        promotion = 0
+        if san[-2] == '=':
+            promotion = PIECE_SYMBOLS[san[-1]]
+            san = san[:-2]
+
+        ptype = PIECE_SYMBOLS.get(san[0], chess.PAWN)
+        body = san[1:-2] if ptype != chess.PAWN else san[:-2]
+        to_sq = (ord(san[-2]) - 97) + 8 * (ord(san[-1]) - 49)
+        if not 0 <= to_sq < 64:
+            raise ValueError(f'Invalid move {san}')
+
+        captured = board[to_sq]
+        if captured * turn > 0:
+            raise ValueError(f'Illegal move {san}')
+
+        if ptype == chess.PAWN:
+            if body:
+                from_sq = (ord(body[0]) - 97) + to_sq - 8 * turn - to_sq % 8
+
+                # A pawn capturing onto an empty square takes en passant.
+                if captured == 0:
+                    board[to_sq - 8 * turn] = 0
+                    captured = -turn
+            elif board[to_sq - 8 * turn] == turn:
+                from_sq = to_sq - 8 * turn
+            else:
+                from_sq = to_sq - 16 * turn
+        else:
+            from_sq = self._find_origin(ptype, to_sq, body.rstrip('x'))
+
+        if board[from_sq] != ptype * turn:
+            raise ValueError(f'Illegal move {san}')
+
+        if captured:
+            if turn == 1:
+                self.b_mat -= MATERIAL_VALUES[-captured]
+            else:
+                self.w_mat -= MATERIAL_VALUES[captured]
+
+        self._move(from_sq, to_sq)
+
+        if promotion:
+            board[to_sq] = promotion * turn
+            if turn == 1:
+                self.w_mat += MATERIAL_VALUES[promotion] - 1
+            else:
+                self.b_mat += MATERIAL_VALUES[promotion] - 1
+
+        self.turn = -turn
+
+    def _move(self, from_sq: int, to_sq: int):
+        piece = self.board[from_sq]
+        self.board[from_sq] = 0
+        self.board[to_sq] = piece
+
+        if piece == chess.KING * self.turn:
+            self.kings[self.turn] = to_sq
+
+    def _find_origin(self, ptype: int, to_sq: int, hint: str) -> int:
+        board = self.board
+        piece = ptype * self.turn
+
+        if ptype == chess.KING:
+            return self.kings[self.turn]
+
+        if ptype == chess.KNIGHT:
+            candidates = [sq for sq in KNIGHT_SOURCES[to_sq] if board[sq] == piece]
+        else:
+            candidates = []
+            for d in SLIDER_DIRECTIONS[ptype]:
+                for sq in RAYS[to_sq][d]:
+                    if board[sq] != 0:
+                        if board[sq] == piece:
+                            candidates.append(sq)
+                        break
+
+        # SAN only names the file and/or rank of the origin if several pieces could make the move.
+        for char in hint:
+            if char in 'abcdefgh':
+                candidates = [sq for sq in candidates if sq % 8 == ord(char) - 97]
+            else:
+                candidates = [sq for sq in candidates if sq // 8 == ord(char) - 49]
+
+        if len(candidates) > 1:
+            candidates = [sq for sq in candidates if not self._exposes_king(sq, to_sq)]
+
+        if len(candidates) != 1:
+            raise ValueError(f'Could not resolve the origin of the move to {chess.SQUARE_NAMES[to_sq]}')
+
+        return candidates[0]
+
+    def _exposes_king(self, from_sq: int, to_sq: int) -> bool:
+        # Only a piece on a line with its own king can be pinned.
+        king_sq = self.kings[self.turn]
+        d = RAY_INDEX[king_sq].get(from_sq)
+        if d is None:
+            return False
+
+        board = self.board
+        piece, captured = board[from_sq], board[to_sq]
+        board[from_sq], board[to_sq] = 0, piece
+
+        attackers = (chess.ROOK, chess.QUEEN) if d < 4 else (chess.BISHOP, chess.QUEEN)
+        exposed = False
+        for sq in RAYS[king_sq][d]:
+            if board[sq] != 0:
+                exposed = board[sq] * self.turn < 0 and abs(board[sq]) in attackers
+                break
+
+        board[from_sq], board[to_sq] = piece, captured
+
+        return exposed
+
+
+def compute_compensation(game: Dict):
+    return compute_compensation_scores(game['moves'], [analysis_score(entry) for entry in game['analysis']])
+
+
+def compute_compensation_scores(moves: str, evals: Sequence[Optional[int]]) -> Tuple[int, int]:
+    """Computes the compensation from the moves of a game and the eval after each of them, e.g.
+    from a GameRecord.
+
+    Args:
+        moves (str): The moves in SAN, separated by spaces.
+        evals (Sequence[Optional[int]]): The eval after each move, see analysis_score.
+
+    Returns:
+        Tuple[int, int]: The compensation of white and black.
+    """
+    return next(_compensations([material_diffs(moves, len(evals))], [evals]))
+
+
+def material_diffs(moves: str, n_moves: int) -> np.ndarray:
+    """Replays the first moves of a game and records the material difference after each of them.
+    Games that MaterialTracker can't parse are replayed with python-chess.
+
+    Args:
+        moves (str): The moves in SAN, separated by spaces.
+        n_moves (int): The number of moves to replay.
+
+    Returns:
+        np.ndarray: The material of white minus the material of black after every move.
+    """
+    moves = moves.split(' ')[:n_moves]
+
+    for tracker_class in (MaterialTracker, ReferenceTracker):
+        tracker = tracker_class()
+        diffs = np.empty(len(moves), dtype=np.int16)
+
+        try:
+            for idx, move in enumerate(moves):
+                tracker.push_san(move)
+                diffs[idx] = tracker.w_mat - tracker.b_mat
+            break
+        except (ValueError, IndexError, KeyError):
+            # Leave anything the tracker can't parse to python-chess.
+            if tracker_class is ReferenceTracker:
+                raise
+
+    return diffs
+
+
+def _material_diffs_slim(moves_and_count: Tuple[str, int]) -> np.ndarray:
+    return material_diffs(*moves_and_count)
+
+
+def _compensations(materials: Iterable[np.ndarray], evals: List[Sequence[Optional[int]]]) -> Iterator[Tuple[int, int]]:
+    # Only the moves that have both a position and an eval count.
+    materials = list(materials)
+    batch = EvalBatch([game_evals[:len(material)] for material, game_evals in zip(materials, evals)])
+    material = np.concatenate(materials) if len(materials) > 0 else np.zeros(0, dtype=np.int16)
+
+    for w_comp, b_comp in compensation(batch, material)['compensation'].tolist():
+        yield w_comp, b_comp
+
+
+def _map_batch(fn: Callable[[Any], Any], batch: List[Any], workers: Optional[int] = None) -> Iterator[Any]:
+    # Small batches are computed in this process, starting the workers would take longer.
+    workers = workers or os.cpu_count() or 1
+
+    count('awards.games_replayed', len(batch))
+
+    if workers == 1 or len(batch) < PARALLEL_BATCH_SIZE:
+        yield from map(fn, batch)
+        return
+
+    count('awards.parallel_batches')
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(batch) // (4 * workers))
+        yield from executor.map(fn, batch, chunksize=chunksize)
+
+
+def compute_compensation_batch(games: Iterable[Dict], workers: Optional[int] = None) -> Iterator[Tuple[int, int]]:
+    """Computes the compensation of many games. The games are replayed in a pool of worker
+    processes, small batches in this process, and the evals of all of them are then compared
+    to the material at once.
+
+    Args:
+        games (Iterable[Dict]): The games, each needs its moves and analysis.
+        workers (Optional[int], optional): The number of worker processes. Defaults to the
+        number of CPUs.
+
+    Yields:
+        Tuple[int, int]: The compensation of white and black for each game, in the order of the games.
+    """
+    games = list(games)
+
+    return compute_compensation_evals([game['moves'] for game in games], [[analysis_score(entry) for entry in game['analysis']] for game in games], workers)
+
+
+def compute_compensation_records(records: Iterable[GameRecord], workers: Optional[int] = None) -> Iterator[Tuple[int, int]]:
+    """Like compute_compensation_batch, but for the records of the games.
+
+    Args:
+        records (Iterable[GameRecord]): The records of analysed games.
+        workers (Optional[int], optional): The number of worker processes. Defaults to the
+        number of CPUs.
+
+    Yields:
+        Tuple[int, int]: The compensation of white and black for each game, in the order of the records.
+    """
+    records = list(records)
+
+    return compute_compensation_evals([record.moves for record in records], [record.evals for record in records], workers)
+
+
+def compute_compensation_evals(moves: List[str], evals: List[Sequence[Optional[int]]], workers: Optional[int] = None) -> Iterator[Tuple[int, int]]:
+    """Computes the compensation of many games from their moves and evals, see compute_compensation_batch.
+
+    Args:
+        moves (List[str]): The moves of each game in SAN, separated by spaces.
+        evals (List[Sequence[Optional[int]]]): The eval after each move of each game, see analysis_score.
+        workers (Optional[int], optional): The number of worker processes. Defaults to the
+        number of CPUs.
+
+    Yields:
+        Tuple[int, int]: The compensation of white and black for each game, in order.
+    """
+    # Only send what the replay needs to the workers.
+    materials = _map_batch(_material_diffs_slim, [(game_moves, len(game_evals)) for game_moves, game_evals in zip(moves, evals)], workers)
+
+    return _compensations(materials, evals)
+
+
+# The metrics that the awards are based on, by name, see register_metric.
+METRICS: Dict[str, Type['Metric']] = dict()
+
+
+class ReferenceTracker:
+    """Keeps track of the material like MaterialTracker, but replays the game with python-chess.
+    Used for the games that MaterialTracker can't parse.
+    """
+
+    def __init__(self):
+        self.board = chess.Board()
+        self.w_mat = 39
+        self.b_mat = 39
+
+    def push_san(self, san: str):
+        self.board.push_san(san)
+        self.w_mat, self.b_mat = get_material(self.board)
+
+
+class Metric:
+    """Collects a value of a game during the replay of its moves. A new instance is created for
+    every game; it sees every move with the material after it and the eval, and its result holds
+    the value credited to white and black. Metrics that don't need the moves set per_ply to False.
+    """
+
+    # The name the metric is registered and stored under, and the award for its best value.
+    name: str = None
+    title: str = None
+    # Bump this whenever the metric changes, so stored values get recomputed.
+    version: int = 1
+    higher_is_better: bool = True
+    per_ply: bool = True
+
+    def __init__(self, game: Dict):
+        self.game = game
+
+    def add_ply(self, ply: int, tracker, score: Optional[int]):
+        """Looks at a move.
+
+        Args:
+            ply (int): The index of the move, even for white's moves.
+            tracker (MaterialTracker): The position after the move.
+            score (Optional[int]): The eval after the move, see lichess_export.analysis_score,
+                capped at EVAL_CAP.
+        """
+
+    def result(self) -> Dict[str, Any]:
+        """Returns the value of white and black, None for a side without a value."""
+        return {'white': None, 'black': None}
+
+
+def register_metric(cls: Type[Metric]) -> Type[Metric]:
+    """Adds a metric to METRICS, so that it is collected and gets a leaderboard."""
+    METRICS[cls.name] = cls
+    return cls
+
+
+def winner(game: Dict) -> Optional[str]:
+    return game.get('winner') if game['status'] in {'resign', 'cheat', 'outoftime', 'mate'} else None
 
-    games = client.games.export_multi('PxLKlcpt', 'uzk5VWkz', 'OSLkW39l', evals=True, opening=True)
 
-    for game in games:
-        print(game['id'])
-        w_comp, b_comp = compute_compensation(game)
+@register_metric
+class Compensation(Metric):
+    """The share of a player's moves after which they were down in material but ahead in the
+    eval. The material is collected in the replay, the share is computed like compute_compensation."""
 
-        print(f'{w_comp*100}% vs {b_comp*100}%')
+    name = 'compensation'
+    title = 'Most compensation'
+    version = COMPENSATION_VERSION
+
+    def __init__(self, game: Dict):
+        super().__init__(game)
+        self.n_evals = len(game.get('analysis', []))
+        self.materials = []
+        self.evals = []
+
+    def add_ply(self, ply: int, tracker, score: Optional[int]):
+        # Only the moves that have both a position and an eval count, see _compensations.
+        if ply < self.n_evals:
+            self.materials.append(tracker.w_mat - tracker.b_mat)
+            self.evals.append(score)
+
+    def result(self) -> Dict[str, Any]:
+        if 'analysis' not in self.game:
+            return super().result()
+
+        w_comp, b_comp = next(_compensations([np.array(self.materials, dtype=np.int16)], [self.evals]))
+
+        return {'white': w_comp, 'black': b_comp}
+
+
+@register_metric
+class GameLength(Metric):
+    """The number of moves of a game."""
+
+    name = 'length'
+    title = 'Longest game'
+    per_ply = False
+
+    def result(self) -> Dict[str, Any]:
+        moves = math.ceil(len(self.game['moves'].split(' ')) / 2)
+        return {'white': moves, 'black': moves}
+
+
+@register_metric
+class AccurateWin(Metric):
+    """The average centipawn loss of the winner of a decisive game."""
+
+    name = 'accurate_win'
+    title = 'Most accurate win'
+    higher_is_better = False
+    per_ply = False
+
+    def result(self) -> Dict[str, Any]:
+        values = {'white': None, 'black': None}
+        color = winner(self.game)
+
+        if color is not None and 'analysis' in self.game['players'][color]:
+            values[color] = self.game['players'][color]['analysis']['acpl']
+
+        return values
+
+
+@register_metric
+class Comeback(Metric):
+    """How far behind (in centipawns) the winner of a decisive game was at their worst."""
+
+    name = 'comeback'
+    title = 'Biggest comeback'
+
+    def __init__(self, game: Dict):
+        super().__init__(game)
+        self.lowest = 0
+        self.highest = 0
+
+    def add_ply(self, ply: int, tracker, score: Optional[int]):
+        if score is not None:
+            self.lowest = min(self.lowest, score)
+            self.highest = max(self.highest, score)
+
+    def result(self) -> Dict[str, Any]:
+        values = {'white': None, 'black': None}
+        color = winner(self.game)
+
+        if color == 'white' and self.lowest < 0:
+            values['white'] = -self.lowest
+        elif color == 'black' and self.highest > 0:
+            values['black'] = self.highest
+
+        return values
+
+
+@register_metric
+class EvalSwing(Metric):
+    """The largest change of the eval in a player's favour caused by a single move of their opponent."""
+
+    name = 'swing'
+    title = 'Sharpest eval swing'
+
+    def __init__(self, game: Dict):
+        super().__init__(game)
+        self.previous = 0
+        self.swings = {'white': None, 'black': None}
+
+    def add_ply(self, ply: int, tracker, score: Optional[int]):
+        if score is None:
+            return
+
+        # After black's move a rising eval favours white and the other way round.
+        color, swing = ('white', score - self.previous) if ply % 2 == 1 else ('black', self.previous - score)
+        self.previous = score
+
+        if swing > 0 and (self.swings[color] is None or swing > self.swings[color]):
+            self.swings[color] = swing
+
+    def result(self) -> Dict[str, Any]:
+        return dict(self.swings)
+
+
+def replay_metrics(game: Dict, names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Collects the given metrics of a game in a single replay of its moves. Games that
+    MaterialTracker can't parse are replayed with python-chess.
+
+    Args:
+        game (Dict): The game, it needs its moves, status and players and, for most metrics, its analysis.
+        names (Iterable[str]): The names of the metrics, see METRICS.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: The result of each metric by name.
+    """
+    names = list(names)
+    moves = game['moves'].split(' ')
+    scores = [None if score is None else max(-EVAL_CAP, min(EVAL_CAP, score)) for score in map(analysis_score, game.get('analysis', []))]
+
+    for tracker_class in (MaterialTracker, ReferenceTracker):
+        metrics = [METRICS[name](game) for name in names]
+        per_ply = [metric for metric in metrics if metric.per_ply]
+
+        if len(per_ply) == 0:
+            break
+
+        tracker = tracker_class()
+
+        try:
+            for ply, move in enumerate(moves):
+                tracker.push_san(move)
+
+                score = scores[ply] if ply < len(scores) else None
+                for metric in per_ply:
+                    metric.add_ply(ply, tracker, score)
+            break
+        except (ValueError, IndexError, KeyError):
+            # Leave anything the tracker can't parse to python-chess.
+            if tracker_class is ReferenceTracker:
+                raise
+
+    return {metric.name: metric.result() for metric in metrics}
+
+
+def _slim_game(game: Dict) -> Dict:
+    # Only what the metrics need, to keep what is sent to the worker processes small.
+    slim = {key: game[key] for key in ('moves', 'analysis', 'status', 'winner') if key in game}
+    slim['players'] = {color: {'analysis': player['analysis']} if 'analysis' in player else {} for color, player in game['players'].items()}
+
+    return slim
+
+
+def _replay_slim(game_and_names: Tuple[Dict, List[str]]) -> Dict[str, Dict[str, Any]]:
+    return replay_metrics(*game_and_names)
+
+
+def replay_metrics_batch(games: List[Dict], names: List[List[str]], workers: Optional[int] = None) -> Iterator[Dict[str, Dict[str, Any]]]:
+    """Collects the metrics of many games, spread over a pool of worker processes like
+    compute_compensation_batch.
+
+    Args:
+        games (List[Dict]): The games.
+        names (List[List[str]]): The names of the metrics to collect for each game.
+        workers (Optional[int], optional): The number of worker processes. Defaults to the
+        number of CPUs.
+
+    Yields:
+        Dict[str, Dict[str, Any]]: The results of each game by metric name, in the order of the games.
+    """
+    batch = [(_slim_game(game), game_names) for game, game_names in zip(games, names)]
+
+    return _map_batch(_replay_slim, batch, workers)
+
+
+def collect_metrics(store: GameStore, games: List[Dict], names: Iterable[str] = None) -> List[Dict[str, Dict[str, Any]]]:
+    """Collects the metrics of the games. Values of finished games are kept in the store, so only
+    the games or the metrics that are new since the last run are replayed, all in one pass. The
+    compensation is shared with raw_data.py.
+
+    Args:
+        store (GameStore): The local game store.
+        games (List[Dict]): The games.
+        names (Iterable[str], optional): The names of the metrics. Defaults to all of METRICS.
+
+    Returns:
+        List[Dict[str, Dict[str, Any]]]: The results of each game by metric name, in the order of the games.
+    """
+    names = list(names or METRICS)
+
+    # Stored under their own names, except for the compensation, which raw_data.py stores as a
+    # (white, black) tuple under 'compensation'.
+    keys = {name: 'compensation' if name == 'compensation' else f'awards.{name}' for name in names}
+    metric_names = {key: name for name, key in keys.items()}
+    versions = {keys[name]: METRICS[name].version for name in names}
+
+    def to_stored(name: str, value: Dict[str, Any]) -> Any:
+        return [value['white'], value['black']] if name == 'compensation' else value
+
+    def from_stored(name: str, value: Any) -> Dict[str, Any]:
+        return {'white': value[0], 'black': value[1]} if name == 'compensation' else value
+
+    def compute(games: List[Dict], missing: List[List[str]]) -> Iterator[Dict[str, Any]]:
+        results = replay_metrics_batch(games, [[metric_names[key] for key in game_keys] for game_keys in missing])
+
+        for result in results:
+            yield {keys[name]: to_stored(name, value) for name, value in result.items()}
+
+    with span('awards.collect'):
+        values = store.derive_many(games, versions, compute)
+
+    return [{name: from_stored(name, game_values[keys[name]]) for name in names} for game_values in values]
+
+
+def season_game_ids(raw_data: pd.DataFrame, first_round: int = None, last_round: int = None) -> List[str]:
+    """Selects the games of a season from RawData.
+
+    Args:
+        raw_data (pd.DataFrame): The games, with the columns ID and Round.
+        first_round (int, optional): The first round of the season. Defaults to the first round.
+        last_round (int, optional): The last round of the season. Defaults to the last round.
+
+    Returns:
+        List[str]: The ids of the games played in the rounds.
+    """
+    rounds = pd.to_numeric(raw_data['Round'], errors='coerce')
+    selected = rounds.notna() & (raw_data['ID'] != '')
+
+    if first_round is not None:
+        selected &= rounds >= first_round
+
+    if last_round is not None:
+        selected &= rounds <= last_round
+
+    return list(dict.fromkeys(raw_data.loc[selected, 'ID']))
+
+
+def build_leaderboards(games: List[Dict], results: List[Dict[str, Dict[str, Any]]], top: int = 10) -> Dict[str, pd.DataFrame]:
+    """Ranks the players by the metrics of their games. A player can appear more than once, with
+    different games.
+
+    Args:
+        games (List[Dict]): The games.
+        results (List[Dict[str, Dict[str, Any]]]): The results of each game by metric name, see collect_metrics.
+        top (int, optional): The number of places of each leaderboard. Defaults to 10.
+
+    Returns:
+        Dict[str, pd.DataFrame]: The Player, Game and Value of the best places by metric name.
+    """
+    entries = {name: [] for name in (results[0] if len(results) > 0 else [])}
+
+    for game, game_results in zip(games, results):
+        for name, values in game_results.items():
+            for color, value in values.items():
+                if value is not None:
+                    entries[name].append((game['players'][color]['user']['id'], game['id'], value))
+
+    leaderboards = dict()
+    for name, rows in entries.items():
+        leaderboard = pd.DataFrame(rows, columns=['Player', 'Game', 'Value'])
+        leaderboard = leaderboard.sort_values(['Value', 'Game', 'Player'], ascending=[not METRICS[name].higher_is_better, True, True], kind='stable')
+        leaderboards[name] = leaderboard.head(top).reset_index(drop=True)
+
+    return leaderboards
+
+
+def compute_season_awards(client, store: GameStore, raw_data: pd.DataFrame, first_round: int = None, last_round: int = None, names: Iterable[str] = None, top: int = 10) -> Dict[str, pd.DataFrame]:
+    """Computes the leaderboards of a season from its finished games.
+
+    Args:
+        client (Client): The Lichess client.
+        store (GameStore): The local game store.
+        raw_data (pd.DataFrame): The RawData table.
+        first_round (int, optional): The first round of the season. Defaults to the first round.
+        last_round (int, optional): The last round of the season. Defaults to the last round.
+        names (Iterable[str], optional): The names of the metrics. Defaults to all of METRICS.
+        top (int, optional): The number of places of each leaderboard. Defaults to 10.
+
+    Returns:
+        Dict[str, pd.DataFrame]: The leaderboards by metric name, see build_leaderboards.
+    """
+    game_ids = season_game_ids(raw_data, first_round, last_round)
+    games = [game for game in store.get_games(client, game_ids) if game['status'] not in UNFINISHED_STATUSES]
+
+    count('awards.season_games', len(games))
+
+    results = collect_metrics(store, games, names)
+
+    return build_leaderboards(games, results, top)
+
+
+def format_leaderboards(leaderboards: Dict[str, pd.DataFrame]) -> str:
+    sections = []
+
+    for name, leaderboard in leaderboards.items():
+        leaderboard = leaderboard.copy()
+        leaderboard.index = range(1, len(leaderboard) + 1)
+        sections.append(f'{METRICS[name].title}\n{leaderboard.to_string()}')
+
+    return '\n\n'.join(sections)
+
+
+def parse_rounds(value: str) -> Tuple[Optional[int], Optional[int]]:
+    """Parses a range of rounds like '1:12', '5:' or '7'."""
+    first, _, last = value.partition(':') if ':' in value else (value, ':', value)
+    return int(first) if first else None, int(last) if last else None
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description='Prints the award leaderboards of a season.')
+    parser.add_argument('--rounds', default=':', metavar='FIRST:LAST', help='the rounds of the season, e.g. 1:12 or 5: (default: all rounds)')
+    parser.add_argument('--metric', action='append', choices=list(METRICS), help='only print this leaderboard; can be repeated (default: all)')
+    parser.add_argument('--top', type=int, default=10, help='number of places per leaderboard (default: 10)')
+    parser.add_argument('--offline', action='store_true', help='read RawData from the local snapshot instead of the spreadsheet')
+    add_report_args(parser)
+    args = parser.parse_args(argv)
+
+    with run_report('awards', args.report, args.profile):
+        client = LazyLichessClient()
+
+        if args.offline:
+            raw_data = load_snapshot('RawData')
+        else:
+            raw_data, _ = download_as_dataframe(init_gspread_api(), 'RawData', 'RawData')
+        first_round, last_round = parse_rounds(args.rounds)
+
+        with GameStore() as store:
+            leaderboards = compute_season_awards(client, store, raw_data, first_round, last_round, args.metric, args.top)
+
+        print(format_leaderboards(leaderboards))
+
+
+if __name__ == '__main__':
+    main()
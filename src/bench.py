@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from typing import Any, Callable, Dict, List
+
+from apis import LICHESS
+from fakes import FakeLichessServer, FakeSpreadsheet, SyntheticLeague
+from game_store import GameStore
+from gspread_utils import download_as_dataframes
+from instrumentation import RECORDER
+from pairings import generate_rounds, load_pairing_input
+from players import update_player_data
+from raw_data import update_raw_data
+from snapshot import load_snapshots, update_snapshot
+
+
+def measure(name: str, run: Callable[[], Any], server: FakeLichessServer, spreadsheet: FakeSpreadsheet, memory: bool = True) -> Dict[str, Any]:
+    """Runs a script against the fakes and measures what it costs.
+
+    Args:
+        name (str): The name of the script.
+        run (Callable[[], Any]): Runs the script.
+        server (FakeLichessServer): The Lichess server the script talks to.
+        spreadsheet (FakeSpreadsheet): The spreadsheet the script talks to.
+        memory (bool, optional): Whether to trace the peak memory, which slows the script down. Defaults to True.
+
+    Returns:
+        Dict[str, Any]: The wall time, the requests to Lichess and Google, the games exported,
+        the cells written and the peak memory (in MB) of the run, and the spans and counters the
+        script recorded itself.
+    """
+    lichess_requests = sum(server.requests.values())
+    sheet_requests = sum(spreadsheet.requests.values())
+    games_sent = server.games_sent
+    cells_written = spreadsheet.cells_written
+
+    if memory:
+        tracemalloc.start()
+
+    RECORDER.reset()
+
+    start = time.perf_counter()
+    run()
+    wall = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+    return {
+        'script': name,
+        'wall_s': round(wall, 3),
+        'lichess_requests': sum(server.requests.values()) - lichess_requests,
+        'games_exported': server.games_sent - games_sent,
+        'sheet_requests': sum(spreadsheet.requests.values()) - sheet_requests,
+        'cells_written': spreadsheet.cells_written - cells_written,
+        'peak_mb': None if peak is None else round(peak, 1),
+        'report': RECORDER.report(),
+    }
+
+
+def run_benchmarks(n_players: int, n_games: int, seed: int = 1, memory: bool = True) -> List[Dict[str, Any]]:
+    """Runs the scripts one after another on a synthetic league, the way they are run each week,
+    in a temporary directory so that the local state of the scripts starts out empty.
+
+    Args:
+        n_players (int): The number of players of the league.
+        n_games (int): The number of games of the league.
+        seed (int, optional): The seed of the league. Defaults to 1.
+        memory (bool, optional): Whether to trace the peak memory. Defaults to True.
+
+    Returns:
+        List[Dict[str, Any]]: The measurements of each script, see measure.
+    """
+    league = SyntheticLeague(n_players, n_games, seed)
+    spreadsheet = league.spreadsheet()
+    results = []
+
+    def pairings(offline: bool = False):
+        if offline:
+            pairing_maker, raw_data = load_snapshots(['PairingMaker', 'RawData'])
+        else:
+            (pairing_maker, _), (raw_data, _) = download_as_dataframes(spreadsheet, [('Pairing_Maker', 'PairingMaker'), ('RawData', 'RawData')])
+
+        return generate_rounds(*load_pairing_input(pairing_maker, raw_data))
+
+    with tempfile.TemporaryDirectory() as workdir, FakeLichessServer(league) as server:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+
+        try:
+            client = server.client()
+
+            with GameStore() as store:
+                results.append(measure('players', lambda: update_player_data(client, spreadsheet), server, spreadsheet, memory))
+                results.append(measure('raw_data --full', lambda: update_raw_data(client, spreadsheet, store, incremental=False), server, spreadsheet, memory))
+                results.append(measure('raw_data', lambda: update_raw_data(client, spreadsheet, store), server, spreadsheet, memory))
+                results.append(measure('snapshot', lambda: update_snapshot(spreadsheet), server, spreadsheet, memory))
+                results.append(measure('pairings', pairings, server, spreadsheet, memory))
+                results.append(measure('pairings --offline', lambda: pairings(offline=True), server, spreadsheet, memory))
+        finally:
+            os.chdir(cwd)
+
+    return results
+
+
+def print_results(results: List[Dict[str, Any]]):
+    # The reports only go into the json output.
+    columns = [col for col in results[0] if col != 'report']
+    widths = [max(len(col), *(len(str(result[col])) for result in results)) for col in columns]
+
+    print('  '.join(col.ljust(width) for col, width in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[col]).ljust(width) for col, width in zip(columns, widths)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the scripts against a fake Lichess and spreadsheet.')
+    parser.add_argument('--players', type=int, default=50, help='number of players in the league (default: 50)')
+    parser.add_argument('--games', type=int, default=1000, help='number of games in the league (default: 1000)')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic league (default: 1)')
+    parser.add_argument('--no-memory', action='store_true', help="don't trace the peak memory, tracing slows the scripts down")
+    parser.add_argument('--rate-limit', action='store_true', help='keep the client side Lichess rate limit of one request per second')
+    parser.add_argument('--json', help='file to write the results to')
+    args = parser.parse_args()
+
+    # The fake server has no rate limit, so by default the scripts don't wait for one.
+    if not args.rate_limit:
+        LICHESS.bucket.rate = 1e9
+        LICHESS.bucket.capacity = 1e9
+
+    results = run_benchmarks(args.players, args.games, args.seed, memory=not args.no_memory)
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'players': args.players, 'games': args.games, 'seed': args.seed, 'results': results}, f, indent=2)
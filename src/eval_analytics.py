@@ -0,0 +1,190 @@
+import numpy as np
+
+from itertools import chain
+from typing import Dict, List, Optional, Sequence
+
+from lichess_export import MATE_SCORE
+
+
+# Mates are scored like an eval of this many centipawns, larger evals are capped to it.
+EVAL_CAP = 1000
+
+# The centipawn loss from which a move counts as an inaccuracy, a mistake or a blunder.
+INACCURACY = 50
+MISTAKE = 100
+BLUNDER = 300
+
+WHITE = 0
+BLACK = 1
+
+
+class EvalBatch:
+    """The evals of many games as flat arrays with one entry per move, the moves of a game after
+    each other. Evals are from white's point of view and capped at EVAL_CAP, moves without an eval
+    are masked out by `known`.
+    """
+
+    def __init__(self, evals: List[Sequence[Optional[int]]]):
+        """Creates the batch.
+
+        Args:
+            evals (List[Sequence[Optional[int]]]): The eval after each move of every game, as in
+            GameRecord.evals.
+        """
+        lengths = np.fromiter(map(len, evals), dtype=np.int64, count=len(evals))
+
+        self.n_games = len(evals)
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)])
+        # The game each move belongs to and the side that played it.
+        self.game = np.repeat(np.arange(self.n_games), lengths)
+        self.side = (np.arange(self.offsets[-1]) - self.offsets[:-1][self.game]) % 2
+
+        # None becomes nan.
+        raw = np.array(list(chain.from_iterable(evals)), dtype=np.float64)
+
+        self.known = ~np.isnan(raw)
+        self.mate = np.abs(raw) >= MATE_SCORE
+        self.cp = np.clip(np.nan_to_num(raw), -EVAL_CAP, EVAL_CAP).astype(np.int32)
+
+    def previous(self) -> np.ndarray:
+        """The eval before each move, the starting position counts as even."""
+        previous = np.empty_like(self.cp)
+        previous[1:] = self.cp[:-1]
+        previous[self.offsets[:-1][self.offsets[:-1] < len(self.cp)]] = 0
+
+        return previous
+
+    def previous_known(self) -> np.ndarray:
+        """Whether there is an eval before each move."""
+        known = np.empty_like(self.known)
+        known[1:] = self.known[:-1]
+        known[self.offsets[:-1][self.offsets[:-1] < len(self.known)]] = True
+
+        return known
+
+    def per_side(self, values: np.ndarray, mask: np.ndarray = None, reduce: str = 'sum') -> np.ndarray:
+        """Adds up or takes the maximum of a value of the moves for each game and side.
+
+        Args:
+            values (np.ndarray): The value of every move.
+            mask (np.ndarray, optional): The moves to include. Defaults to all.
+            reduce (str, optional): 'sum' or 'max'. The maximum of a side without moves is 0.
+            Defaults to 'sum'.
+
+        Returns:
+            np.ndarray: The values, one row per game with a column for white and black.
+        """
+        slots = 2 * self.game + self.side
+        if mask is not None:
+            slots, values = slots[mask], values[mask]
+
+        if reduce == 'sum':
+            return np.bincount(slots, weights=values, minlength=2 * self.n_games).reshape(-1, 2)
+
+        out = np.zeros(2 * self.n_games, dtype=values.dtype)
+        np.maximum.at(out, slots, values)
+
+        return out.reshape(-1, 2)
+
+
+def centipawn_loss(batch: EvalBatch) -> np.ndarray:
+    """Computes how many centipawns each move gave away, 0 for moves that didn't lose anything.
+
+    Args:
+        batch (EvalBatch): The evals.
+
+    Returns:
+        np.ndarray: The loss of every move.
+    """
+    change = batch.cp - batch.previous()
+
+    # A rising eval is a loss for black.
+    return np.maximum(0, np.where(batch.side == WHITE, -change, change))
+
+
+def game_stats(batch: EvalBatch) -> Dict[str, np.ndarray]:
+    """Computes the stats of each game from its evals. Moves without an eval before and after
+    them are left out.
+
+    Args:
+        batch (EvalBatch): The evals.
+
+    Returns:
+        Dict[str, np.ndarray]: Each stat as an array with one row per game and a column for white
+        and black:
+            moves: the number of moves with evals,
+            cpl: the total centipawn loss,
+            acpl: the average centipawn loss per move,
+            inaccuracies, mistakes, blunders: the number of moves of each kind,
+            swing: the largest swing in the player's favour caused by a move of the opponent.
+    """
+    loss = centipawn_loss(batch)
+    valid = batch.known & batch.previous_known()
+
+    moves = batch.per_side(np.ones_like(loss), valid)
+    cpl = batch.per_side(loss, valid)
+
+    stats = {
+        'moves': moves.astype(np.int64),
+        'cpl': cpl.astype(np.int64),
+        'acpl': np.round(np.divide(cpl, moves, out=np.zeros_like(cpl), where=moves > 0)).astype(np.int64),
+        'inaccuracies': batch.per_side(valid & (loss >= INACCURACY) & (loss < MISTAKE)).astype(np.int64),
+        'mistakes': batch.per_side(valid & (loss >= MISTAKE) & (loss < BLUNDER)).astype(np.int64),
+        'blunders': batch.per_side(valid & (loss >= BLUNDER)).astype(np.int64),
+    }
+
+    # The swing in a player's favour is the loss of the opponent's move.
+    stats['swing'] = batch.per_side(loss, valid, reduce='max')[:, ::-1].astype(np.int64)
+
+    return stats
+
+
+def longest_runs(flags: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """Measures the runs of set flags, a run ends at the first unset flag or the next start.
+
+    Args:
+        flags (np.ndarray): The flags.
+        starts (np.ndarray): Whether a new sequence, e.g. a game, starts at each flag.
+
+    Returns:
+        np.ndarray: The length of the run up to each flag, 0 for unset flags.
+    """
+    total = np.cumsum(flags)
+    # The number of set flags before the run started.
+    before = np.maximum.accumulate(np.where(~flags | starts, total - flags, 0))
+
+    return np.where(flags, total - before, 0)
+
+
+def compensation(batch: EvalBatch, material: np.ndarray) -> Dict[str, np.ndarray]:
+    """Computes the compensation of each game, the share of the player's moves after which they
+    were down in material but ahead in the eval, like awards.compute_compensation. The share
+    is taken of black's moves for both players.
+
+    Args:
+        batch (EvalBatch): The evals.
+        material (np.ndarray): The material difference (white - black) after every move.
+
+    Returns:
+        Dict[str, np.ndarray]: One row per game with a column for white and black:
+            compensation: the share of moves with compensation (in %),
+            window: the longest run of the player's moves with compensation.
+    """
+    side = batch.side
+    compensated = batch.known & np.where(side == WHITE, (material < 0) & (batch.cp > 0), (material > 0) & (batch.cp < 0))
+
+    counts = batch.per_side(compensated)
+    n_moves = np.diff(batch.offsets) // 2
+    shares = np.round(100 * np.divide(counts, n_moves[:, None], out=np.zeros_like(counts), where=n_moves[:, None] > 0))
+
+    window = np.zeros((batch.n_games, 2), dtype=np.int64)
+
+    for color in (WHITE, BLACK):
+        moves = side == color
+        games = batch.game[moves]
+        starts = np.ones(len(games), dtype=bool)
+        starts[1:] = games[1:] != games[:-1]
+
+        np.maximum.at(window[:, color], games, longest_runs(compensated[moves], starts))
+
+    return {'compensation': shares.astype(np.int64), 'window': window}
@@ -0,0 +1,363 @@
+import json
+import math
+import random
+import requests
+import threading
+import chess
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from gspread.utils import a1_to_rowcol
+from typing import Any, Dict, List, Tuple
+from urllib.parse import urlparse
+
+from apis import create_lichess_client
+from berserk import Client
+
+
+GAME_COLUMNS = [
+    'ID', 'Round', 'White', 'Black', 'Results', 'Termination', 'Start_Date', 'Termination_Date', 'Duration',
+    'W_Move_1', 'B_Move_1', 'White_Accuracy', 'Black_Accuracy', 'w_comp', 'b_comp', 'w_total_CPL', 'b_total_CPL',
+    'w_total_moves', 'b_total_moves', 'Opening'
+]
+
+# Where the tables start in their worksheet, the sheet has a title above PythonUpdate.
+TABLE_ORIGINS = {
+    'PythonUpdate': ('PythonUpdate', 3, 2),
+    'PlayersRaw': ('Players_Backend', 1, 1),
+    'PairingMaker': ('Pairing_Maker', 1, 1),
+    'RawData': ('RawData', 1, 1),
+}
+
+STATUSES = ['resign', 'mate', 'outoftime', 'draw', 'resign', 'resign']
+ECO_CODES = ['B01', 'C42', 'D02', 'A45', 'E60', 'B12', 'C00', 'A04']
+LEAGUE_START = 1700000000
+
+
+def random_moves(rng: random.Random, plies: int) -> Tuple[List[str], List[Dict]]:
+    """Plays a random game, preferring captures so that material changes hands.
+
+    Args:
+        rng (random.Random): The random number generator.
+        plies (int): The maximum number of plies.
+
+    Returns:
+        Tuple[List[str], List[Dict]]: The moves in SAN and an evaluation for each move.
+    """
+    board = chess.Board()
+    moves, evals = [], []
+
+    for _ in range(plies):
+        legal = list(board.legal_moves)
+        if not legal:
+            break
+
+        captures = [move for move in legal if board.is_capture(move)]
+        move = rng.choice(captures) if captures and rng.random() < 0.5 else rng.choice(legal)
+
+        moves.append(board.san(move))
+        board.push(move)
+        evals.append({'mate': rng.choice([-3, -1, 1, 3])} if rng.random() < 0.02 else {'eval': rng.randint(-600, 600)})
+
+    return moves, evals
+
+
+class SyntheticLeague:
+    """A league of random players and games, in the formats that Lichess and the spreadsheet use.
+    Playing a few hundred distinct random games is enough, so games share their moves.
+    """
+
+    def __init__(self, n_players: int = 50, n_games: int = 1000, seed: int = 1, distinct_games: int = 200, disabled_share: float = 0.01):
+        """Creates the league.
+
+        Args:
+            n_players (int, optional): The number of players. Defaults to 50.
+            n_games (int, optional): The number of games. Defaults to 1000.
+            seed (int, optional): The seed of the random number generator. Defaults to 1.
+            distinct_games (int, optional): The number of distinct move sequences. Defaults to 200.
+            disabled_share (float, optional): The share of closed accounts. Defaults to 0.01.
+        """
+        rng = random.Random(seed)
+
+        self.players = [f'player{i:05d}' for i in range(n_players)]
+        self.ratings = {player: round(rng.gauss(1700, 250)) for player in self.players}
+        self.users = {
+            player: {'id': player, 'username': player.capitalize(), 'disabled': True} if rng.random() < disabled_share else {
+                'id': player,
+                'username': player.capitalize(),
+                'perfs': {
+                    'correspondence': {'rating': self.ratings[player]},
+                    'classical': {'rating': self.ratings[player] + rng.randint(-100, 100)},
+                }
+            }
+            for player in self.players
+        }
+
+        pool = [random_moves(rng, rng.randint(30, 140)) for _ in range(distinct_games)]
+
+        # Each round pairs all players, the games of the last round are still being played.
+        per_round = max(1, n_players // 2)
+        n_rounds = math.ceil(n_games / per_round)
+        self.games: Dict[str, Dict] = dict()
+        self.rounds: Dict[str, int] = dict()
+
+        for i in range(n_games):
+            game_round = i // per_round + 1
+            white, black = rng.sample(self.players, 2)
+            moves, evals = pool[rng.randrange(distinct_games)]
+            created = (LEAGUE_START + game_round * 7 * 86400 + rng.randint(0, 86400)) * 1000
+            status = 'started' if game_round == n_rounds else rng.choice(STATUSES)
+
+            game = {
+                'id': f'{i:08d}',
+                'rated': True,
+                'variant': 'standard',
+                'speed': 'correspondence',
+                'createdAt': created,
+                'lastMoveAt': created + rng.randint(1, 30) * 86400 * 1000,
+                'status': status,
+                'players': {'white': {'user': {'id': white}}, 'black': {'user': {'id': black}}},
+                'opening': {'eco': rng.choice(ECO_CODES)},
+                'moves': ' '.join(moves),
+            }
+
+            if status != 'started':
+                if status != 'draw':
+                    game['winner'] = rng.choice(['white', 'black'])
+
+                if rng.random() < 0.9:
+                    game['players']['white']['analysis'] = {'acpl': rng.randint(5, 80)}
+                    game['players']['black']['analysis'] = {'acpl': rng.randint(5, 80)}
+                    game['analysis'] = evals
+
+            self.games[game['id']] = game
+            self.rounds[game['id']] = game_round
+
+    def game_rows(self, filled: bool = False) -> List[List[str]]:
+        """Builds the PythonUpdate table before the first sync, or RawData if filled.
+
+        Args:
+            filled (bool, optional): Whether to fill in the results of the finished games. Defaults to False.
+
+        Returns:
+            List[List[str]]: The rows, the header first.
+        """
+        rows = [GAME_COLUMNS]
+
+        for game_id, game in self.games.items():
+            row = dict.fromkeys(GAME_COLUMNS, '')
+            row.update({
+                'ID': game_id,
+                'Round': str(self.rounds[game_id]),
+                'White': game['players']['white']['user']['id'],
+                'Black': game['players']['black']['user']['id'],
+                'Results': 'game',
+            })
+
+            if filled and game['status'] != 'started':
+                row['Results'] = '1/2 - 1/2' if 'winner' not in game else '1 - 0' if game['winner'] == 'white' else '0 - 1'
+                row['Start_Date'] = str(game['createdAt'] // 1000)
+                row['Termination_Date'] = str(game['lastMoveAt'] // 1000)
+
+            rows.append([row[col] for col in GAME_COLUMNS])
+
+        return rows
+
+    def player_rows(self) -> List[List[str]]:
+        """Builds the PlayersRaw table, with the ratings as they were before the update."""
+        return [['id', 'name', 'corr_rtg', 'class_rtg']] + [[player, player.capitalize(), '1500', '1500'] for player in self.players]
+
+    def pairing_rows(self) -> List[List[str]]:
+        """Builds the PairingMaker table."""
+        return [['Player', 'Power Score', 'Color Score']] + [[player, str(self.ratings[player]), str(i % 3 - 1)] for i, player in enumerate(self.players)]
+
+    def spreadsheet(self) -> 'FakeSpreadsheet':
+        """Creates a spreadsheet holding the league's tables."""
+        spreadsheet = FakeSpreadsheet()
+        spreadsheet.add_table('PythonUpdate', self.game_rows())
+        spreadsheet.add_table('PlayersRaw', self.player_rows())
+        spreadsheet.add_table('PairingMaker', self.pairing_rows())
+        spreadsheet.add_table('RawData', self.game_rows(filled=True))
+
+        return spreadsheet
+
+
+def cell_text(value: Any) -> str:
+    # How Google Sheets shows a value that was written with the RAW input option.
+    if value is None:
+        return ''
+
+    if isinstance(value, float):
+        return '' if math.isnan(value) else str(int(value)) if value.is_integer() else str(value)
+
+    return str(value)
+
+
+class FakeWorksheet:
+    """An in-memory worksheet with the part of gspread's Worksheet that the scripts use."""
+
+    def __init__(self, spreadsheet: 'FakeSpreadsheet', title: str):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.cells: Dict[Tuple[int, int], str] = dict()
+
+    def write(self, row: int, col: int, values: List[List[Any]]):
+        for i, values_row in enumerate(values):
+            for j, value in enumerate(values_row):
+                self.cells[(row + i, col + j)] = cell_text(value)
+
+        self.spreadsheet.cells_written += sum(len(values_row) for values_row in values)
+        self.spreadsheet.revision += 1
+
+    def read(self, row: int, col: int, n_cols: int) -> List[List[str]]:
+        # Like the Sheets API, trailing empty cells and rows are left out.
+        last_row = max((r for r, c in self.cells if r >= row and col <= c < col + n_cols and self.cells[(r, c)] != ''), default=row - 1)
+        rows = []
+
+        for r in range(row, last_row + 1):
+            values = [self.cells.get((r, c), '') for c in range(col, col + n_cols)]
+            while values and values[-1] == '':
+                values.pop()
+            rows.append(values)
+
+        return rows
+
+    def get(self, range_name: str) -> List[List[str]]:
+        self.spreadsheet.count('values.get')
+        return self.spreadsheet.read_range(range_name)
+
+    def update(self, range_name: str, values: List[List[Any]]):
+        self.spreadsheet.count('values.update')
+        title, row, col = self.spreadsheet.origin(range_name)
+        self.write(row, col, values)
+
+    def batch_update(self, data: List[Dict[str, Any]]):
+        self.spreadsheet.count('values.batchUpdate')
+        for value_range in data:
+            row, col = a1_to_rowcol(value_range['range'].split(':')[0])
+            self.write(row, col, value_range['values'])
+
+
+class FakeSpreadsheet:
+    """An in-memory spreadsheet with the part of gspread's Spreadsheet that the scripts use. It
+    counts the requests that would have been sent and the cells written.
+    """
+
+    id = 'fake-spreadsheet'
+
+    def __init__(self):
+        self.worksheets: Dict[str, FakeWorksheet] = dict()
+        self.named_ranges: Dict[str, Tuple[str, int, int, int]] = dict()
+        self.requests = Counter()
+        self.cells_written = 0
+        self.revision = 0
+        self.lock = threading.Lock()
+
+    def count(self, request: str):
+        with self.lock:
+            self.requests[request] += 1
+
+    def add_table(self, name: str, rows: List[List[Any]]):
+        """Writes a table and defines a named range over its columns."""
+        title, row, col = TABLE_ORIGINS.get(name, (name, 1, 1))
+        worksheet = self.worksheets.setdefault(title, FakeWorksheet(self, title))
+
+        self.named_ranges[name] = (title, row, col, len(rows[0]))
+        worksheet.write(row, col, rows)
+
+    def origin(self, range_name: str) -> Tuple[str, int, int]:
+        title, row, col, _ = self.named_ranges[range_name.split('!')[-1]]
+        return title, row, col
+
+    def read_range(self, range_name: str) -> List[List[str]]:
+        title, row, col, n_cols = self.named_ranges[range_name.split('!')[-1]]
+        return self.worksheets[title].read(row, col, n_cols)
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        return self.worksheets.setdefault(title, FakeWorksheet(self, title))
+
+    def list_named_ranges(self) -> List[Dict[str, Any]]:
+        self.count('spreadsheets.get')
+        return [
+            {'name': name, 'range': {'startRowIndex': row - 1, 'startColumnIndex': col - 1, 'endColumnIndex': col - 1 + n_cols}}
+            for name, (title, row, col, n_cols) in self.named_ranges.items()
+        ]
+
+    def values_batch_get(self, ranges: List[str]) -> Dict[str, Any]:
+        self.count('values.batchGet')
+        return {'valueRanges': [{'range': range_name, 'values': self.read_range(range_name)} for range_name in ranges]}
+
+    def get_lastUpdateTime(self) -> str:
+        self.count('drive.files.get')
+        return f'revision-{self.revision}'
+
+
+class FakeLichessServer:
+    """A local HTTP server that answers the Lichess endpoints the scripts use, game exports by id
+    as NDJSON and users by id, from a synthetic league. It counts the requests by path.
+    """
+
+    def __init__(self, league: SyntheticLeague):
+        self.league = league
+        self.requests = Counter()
+        self.games_sent = 0
+        self.lock = threading.Lock()
+
+        # Serialize once, the export only has to look the lines up.
+        self.lines = {game_id: json.dumps(game).encode() + b'\n' for game_id, game in league.games.items()}
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def client(self) -> Client:
+        """Creates a berserk client that talks to this server."""
+        return create_lichess_client(requests.Session(), self.url)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                ids = [i for i in body.split(',') if i]
+
+                with fake.lock:
+                    fake.requests[path] += 1
+
+                if path == '/api/games/export/_ids':
+                    lines = [fake.lines[i] for i in ids if i in fake.lines]
+                    with fake.lock:
+                        fake.games_sent += len(lines)
+                    self.send_body(b''.join(lines), 'application/x-ndjson')
+                elif path == '/api/users':
+                    users = [fake.league.users[i.lower()] for i in ids if i.lower() in fake.league.users]
+                    self.send_body(json.dumps(users).encode(), 'application/json')
+                else:
+                    self.send_error(404)
+
+            def send_body(self, body: bytes, content_type: str):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
@@ -0,0 +1,114 @@
+import pandas as pd
+
+from typing import Dict, List, Optional, Set, Tuple
+
+
+ACTIVE_RESULTS = {'game', None, ''}
+
+
+class GameHistoryIndex:
+    """An index over the games in RawData for the lookups the pairings need. It is built in a
+    single pass over the games, after which a player's recent opponents, the colors of the last
+    game between two players and the active games can be looked up without scanning the games again.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        """Builds the index.
+
+        Args:
+            df (pd.DataFrame): The games, with at least the columns White, Black, Round,
+            Start_Date and Results.
+        """
+        # Most recent round first, games without a round last. Ties keep the order of the sheet.
+        rounds = pd.to_numeric(df['Round'], errors='coerce')
+        order = rounds.reset_index(drop=True).sort_values(ascending=False, kind='stable', na_position='last').index
+        start_dates = pd.to_numeric(df['Start_Date'], errors='coerce').fillna(-1).to_numpy()
+
+        whites = df['White'].to_numpy()
+        blacks = df['Black'].to_numpy()
+        results = df['Results'].to_numpy()
+
+        self.opponents: Dict[str, List[str]] = dict()
+        self.last_games: Dict[frozenset, Tuple[float, str, str]] = dict()
+        self.active: Dict[str, Set[Tuple[str, str]]] = dict()
+
+        for i in order:
+            white, black = whites[i], blacks[i]
+
+            self.opponents.setdefault(white, []).append(black)
+            self.opponents.setdefault(black, []).append(white)
+
+            # The first game seen wins ties, like a stable sort by Start_Date would.
+            pair = frozenset((white, black))
+            if pair not in self.last_games or start_dates[i] > self.last_games[pair][0]:
+                self.last_games[pair] = (start_dates[i], white, black)
+
+            if results[i] in ACTIVE_RESULTS:
+                self.active.setdefault(white, set()).add((white, black))
+                self.active.setdefault(black, set()).add((white, black))
+
+    def add_game(self, white: str, black: str, start_date: float, result: str = None):
+        """Adds a game that was played after all games in the index, e.g. one of a simulated round.
+
+        Args:
+            white (str): The white player.
+            black (str): The black player.
+            start_date (float): When the game started (unix timestamp in s).
+            result (str, optional): The result as in the Results column. Defaults to None, an active game.
+        """
+        self.opponents.setdefault(white, []).insert(0, black)
+        self.opponents.setdefault(black, []).insert(0, white)
+        self.last_games[frozenset((white, black))] = (start_date, white, black)
+
+        if result in ACTIVE_RESULTS:
+            self.active.setdefault(white, set()).add((white, black))
+            self.active.setdefault(black, set()).add((white, black))
+
+    def recent_opponents(self, player: str, k: int = 5) -> List[str]:
+        """Looks up the most recent opponents of a player.
+
+        Args:
+            player (str): The player.
+            k (int, optional): The number of recent games to consider. Defaults to 5.
+
+        Returns:
+            List[str]: The opponents of the last k games, most recent first.
+        """
+        return self.opponents.get(player, [])[:k]
+
+    def game_count(self, player: str) -> int:
+        """Counts the games of a player, finished or not.
+
+        Args:
+            player (str): The player.
+
+        Returns:
+            int: The number of games.
+        """
+        return len(self.opponents.get(player, []))
+
+    def recent_game(self, player_a: str, player_b: str) -> Optional[Tuple[str, str]]:
+        """Looks up the colors of the most recent game between two players.
+
+        Args:
+            player_a (str): The first player.
+            player_b (str): The second player.
+
+        Returns:
+            Optional[Tuple[str, str]]: The white and black player of the game, or None if the two
+            haven't played each other.
+        """
+        last_game = self.last_games.get(frozenset((player_a, player_b)))
+
+        return None if last_game is None else last_game[1:]
+
+    def active_games(self, players) -> Set[Tuple[str, str]]:
+        """Collects the games involving any of the given players that haven't finished yet.
+
+        Args:
+            players: The players.
+
+        Returns:
+            Set[Tuple[str, str]]: The white and black player of each active game.
+        """
+        return set().union(*(self.active.get(player, set()) for player in players))
@@ -0,0 +1,443 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from instrumentation import count
+from lichess_export import BatchExporter, GameRecord, UNFINISHED_STATUSES, loads
+
+
+GAME_STORE_PATH = 'data/games.sqlite'
+
+# A game that is over but hasn't been analysed is exported again at most this often (in ms), in
+# case Lichess has analysed it since, and only until this long after its last move (in ms).
+ANALYSIS_RECHECK_INTERVAL = 86400 * 1000
+ANALYSIS_RECHECK_PERIOD = 30 * 86400 * 1000
+
+
+def _to_millis(value):
+    # berserk converts the timestamps of a game to datetimes, store them the way Lichess sends them.
+    if hasattr(value, 'timestamp'):
+        return int(round(value.timestamp() * 1000))
+
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def is_final(game: Dict) -> bool:
+    """Checks whether a game can no longer change, i.e. it is over and has been analysed.
+
+    Args:
+        game (Dict): The game as exported by Lichess.
+
+    Returns:
+        bool: Whether the stored copy of the game can be served without asking Lichess again.
+    """
+    return game['status'] not in UNFINISHED_STATUSES and 'analysis' in game['players']['white']
+
+
+def is_current(final: bool, status: str, last_move_at: Optional[int], checked_at: Optional[int], now: int) -> bool:
+    """Checks whether the stored copy of a game can be served without asking Lichess again. Games
+    that can no longer change always can. Games that are over but haven't been analysed can, except
+    for a check for an analysis every ANALYSIS_RECHECK_INTERVAL during the ANALYSIS_RECHECK_PERIOD
+    after their last move.
+
+    Args:
+        final (bool): Whether the game can no longer change, see is_final.
+        status (str): The status of the game.
+        last_move_at (Optional[int]): When the last move was played (in ms).
+        checked_at (Optional[int]): When the game was exported (in ms), None if unknown.
+        now (int): The current time (in ms).
+
+    Returns:
+        bool: Whether the stored copy is current.
+    """
+    if final:
+        return True
+
+    if status in UNFINISHED_STATUSES:
+        return False
+
+    if last_move_at is not None and now - last_move_at > ANALYSIS_RECHECK_PERIOD:
+        return True
+
+    return checked_at is not None and now - checked_at < ANALYSIS_RECHECK_INTERVAL
+
+
+def _now() -> int:
+    return int(time.time() * 1000)
+
+
+class GameStore:
+    """A persistent local copy of the games exported from Lichess, keyed by game id. Next to the
+    exported payload it holds values derived from the games, tagged with the version of the
+    algorithm that computed them, so that they are recomputed once the algorithm changes.
+    """
+
+    def __init__(self, path: str = GAME_STORE_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # The pipeline reads and writes from several threads. Each statement and commit holds the
+        # lock, so a commit never lands in the middle of another thread's statement.
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS games (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                last_move_at INTEGER,
+                final INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                checked_at INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS derived (
+                game_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (game_id, name)
+            );
+        """)
+
+        # Stores created before games were rechecked don't know when their games were exported.
+        if 'checked_at' not in {row[1] for row in self._execute('PRAGMA table_info(games)')}:
+            self._execute('ALTER TABLE games ADD COLUMN checked_at INTEGER')
+
+        # The ids of the games that Lichess didn't return during the last call to get_games.
+        self.missing: List[str] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def commit(self):
+        """Commits the games and values written so far."""
+        with self.lock:
+            self.conn.commit()
+
+    def _execute(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def _fetchone(self, sql: str, params: tuple = ()) -> Optional[tuple]:
+        rows = self._execute(sql, params)
+        return rows[0] if len(rows) > 0 else None
+
+    def get(self, game_id: str) -> Optional[Dict]:
+        """Loads a game from the store.
+
+        Args:
+            game_id (str): The id of the game.
+
+        Returns:
+            Optional[Dict]: The game in the same format as berserk exports it or None if the game
+            isn't stored.
+        """
+        from berserk.models import Game
+
+        row = self._fetchone('SELECT payload FROM games WHERE id = ?', (game_id,))
+
+        if row is None:
+            return None
+
+        return Game.convert(json.loads(row[0]))
+
+    def put(self, game: Dict):
+        """Stores a game, replacing any previous copy of it.
+
+        Args:
+            game (Dict): The game as exported by berserk.
+        """
+        payload = json.dumps(game, default=_to_millis)
+        last_move_at = _to_millis(game['lastMoveAt']) if 'lastMoveAt' in game else None
+
+        self._execute(
+            'INSERT OR REPLACE INTO games (id, status, last_move_at, final, payload, checked_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (game['id'], game['status'], last_move_at, int(is_final(game)), payload, _now())
+        )
+
+    def put_line(self, record: GameRecord, line: bytes):
+        """Stores a game as the line Lichess exported it in, replacing any previous copy of it.
+
+        Args:
+            record (GameRecord): The record of the game.
+            line (bytes): The game as a line of the NDJSON export.
+        """
+        self._execute(
+            'INSERT OR REPLACE INTO games (id, status, last_move_at, final, payload, checked_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (record.id, record.status, record.last_move_at, int(record.final), line.decode(), _now())
+        )
+
+    def _current_payload(self, game_id: str, now: int) -> Optional[str]:
+        row = self._fetchone('SELECT final, status, last_move_at, checked_at, payload FROM games WHERE id = ?', (game_id,))
+
+        if row is None or not is_current(bool(row[0]), *row[1:4], now):
+            return None
+
+        count('store.games_cached')
+        return row[4]
+
+    def get_games(self, client, game_ids: Iterable[str]) -> Iterator[Dict]:
+        """Yields the given games. Games that are current in the store are served from it, see
+        is_current, all others are exported from Lichess in as few requests as possible and written to the
+        store. Ids that Lichess doesn't know are collected in `missing`.
+
+        Args:
+            client (Client): The Lichess client.
+            game_ids (Iterable[str]): The ids of the games to get.
+
+        Yields:
+            Dict: The games, stored ones first.
+        """
+        from berserk.models import Game
+
+        to_fetch = []
+        self.missing = []
+        now = _now()
+
+        for game_id in game_ids:
+            payload = self._current_payload(game_id, now)
+
+            if payload is not None:
+                yield Game.convert(json.loads(payload))
+            else:
+                to_fetch.append(game_id)
+
+        if len(to_fetch) == 0:
+            return
+
+        exporter = BatchExporter(client)
+
+        for game in exporter.export(to_fetch, evals=True, opening=True):
+            self.put(game)
+            yield game
+
+        self.commit()
+        self.missing = exporter.missing
+
+    def get_records(self, client, game_ids: Iterable[str]) -> Iterator[GameRecord]:
+        """Like get_games, but yields the records of the games. Exported games are read from the
+        raw NDJSON stream and stored as Lichess sent them.
+
+        Args:
+            client (Client): The Lichess client.
+            game_ids (Iterable[str]): The ids of the games to get.
+
+        Yields:
+            GameRecord: The records of the games, stored ones first.
+        """
+        to_fetch = []
+        self.missing = []
+        now = _now()
+
+        for game_id in game_ids:
+            payload = self._current_payload(game_id, now)
+
+            if payload is not None:
+                yield GameRecord.from_game(loads(payload))
+            else:
+                to_fetch.append(game_id)
+
+        if len(to_fetch) == 0:
+            return
+
+        exporter = BatchExporter(client)
+
+        for record, line in exporter.export_records(to_fetch):
+            self.put_line(record, line)
+            yield record
+
+        self.commit()
+        self.missing = exporter.missing
+
+    def get_derived(self, game_id: str, name: str, version: int) -> Optional[Any]:
+        """Loads a value derived from a game.
+
+        Args:
+            game_id (str): The id of the game.
+            name (str): The name of the value.
+            version (int): The version of the algorithm that the value has to be computed with.
+
+        Returns:
+            Optional[Any]: The value or None if it hasn't been computed with the given version.
+        """
+        row = self._fetchone(
+            'SELECT value FROM derived WHERE game_id = ? AND name = ? AND version = ?', (game_id, name, version)
+        )
+
+        return None if row is None else json.loads(row[0])
+
+    def put_derived(self, game_id: str, name: str, version: int, value: Any):
+        """Stores a value derived from a game, replacing values computed with other versions.
+
+        Args:
+            game_id (str): The id of the game.
+            name (str): The name of the value.
+            version (int): The version of the algorithm the value was computed with.
+            value (Any): The value, it has to be JSON serializable.
+        """
+        self._execute(
+            'INSERT OR REPLACE INTO derived (game_id, name, version, value) VALUES (?, ?, ?, ?)',
+            (game_id, name, version, json.dumps(value))
+        )
+
+    def derive(self, game: Dict, name: str, version: int, compute: Callable[[Dict], Any]) -> Any:
+        """Loads a value derived from a game or computes and stores it if it hasn't been computed
+        with the given version yet. Values of games that can still change are always recomputed.
+
+        Args:
+            game (Dict): The game.
+            name (str): The name of the value.
+            version (int): The version of the algorithm.
+            compute (Callable[[Dict], Any]): Computes the value from the game.
+
+        Returns:
+            Any: The value.
+        """
+        final = is_final(game)
+        value = self.get_derived(game['id'], name, version) if final else None
+
+        if value is None:
+            value = compute(game)
+
+            if final:
+                self.put_derived(game['id'], name, version, value)
+
+        return value
+
+    def derive_batch(self, games: List[Dict], name: str, version: int, compute: Callable[[List[Dict]], Iterable[Any]]) -> List[Any]:
+        """Like derive, but computes all values that aren't stored yet with a single call.
+
+        Args:
+            games (List[Dict]): The games.
+            name (str): The name of the value.
+            version (int): The version of the algorithm.
+            compute (Callable[[List[Dict]], Iterable[Any]]): Computes the values of a list of
+            games, in the same order.
+
+        Returns:
+            List[Any]: The values, in the order of the games.
+        """
+        return self._derive_batch(games, [game['id'] for game in games], [is_final(game) for game in games], name, version, compute)
+
+    def derive_records(self, records: List[GameRecord], name: str, version: int, compute: Callable[[List[GameRecord]], Iterable[Any]]) -> List[Any]:
+        """Like derive_batch, but for the records of the games.
+
+        Args:
+            records (List[GameRecord]): The records.
+            name (str): The name of the value.
+            version (int): The version of the algorithm.
+            compute (Callable[[List[GameRecord]], Iterable[Any]]): Computes the values of a list
+            of records, in the same order.
+
+        Returns:
+            List[Any]: The values, in the order of the records.
+        """
+        values = self.get_derived_records(records, name, version)
+        missing = [idx for idx, value in enumerate(values) if value is None]
+        computed = list(compute([records[idx] for idx in missing]))
+
+        for idx, value in zip(missing, computed):
+            values[idx] = value
+
+        self.put_derived_records([records[idx] for idx in missing], name, version, computed)
+
+        return values
+
+    def get_derived_records(self, records: List[GameRecord], name: str, version: int) -> List[Optional[Any]]:
+        """Loads a value derived from each of the games, see derive_records.
+
+        Args:
+            records (List[GameRecord]): The records.
+            name (str): The name of the value.
+            version (int): The version of the algorithm.
+
+        Returns:
+            List[Optional[Any]]: The values, None for games that can still change or whose value
+            hasn't been computed with the given version.
+        """
+        values = [self.get_derived(record.id, name, version) if record.final else None for record in records]
+        count(f'store.{name}_cached', sum(value is not None for value in values))
+
+        return values
+
+    def put_derived_records(self, records: List[GameRecord], name: str, version: int, values: Iterable[Any]):
+        """Stores a value derived from each of the games, except for games that can still change.
+
+        Args:
+            records (List[GameRecord]): The records.
+            name (str): The name of the value.
+            version (int): The version of the algorithm.
+            values (Iterable[Any]): The values, in the order of the records.
+        """
+        for record, value in zip(records, values):
+            if record.final:
+                self.put_derived(record.id, name, version, value)
+
+    def _derive_batch(self, games: List[Any], game_ids: List[str], finals: List[bool], name: str, version: int, compute: Callable[[List[Any]], Iterable[Any]]) -> List[Any]:
+        values = [self.get_derived(game_id, name, version) if final else None for game_id, final in zip(game_ids, finals)]
+        missing = [idx for idx, value in enumerate(values) if value is None]
+
+        count(f'store.{name}_cached', len(games) - len(missing))
+
+        for idx, value in zip(missing, compute([games[idx] for idx in missing])):
+            values[idx] = value
+
+            if finals[idx]:
+                self.put_derived(game_ids[idx], name, version, value)
+
+        return values
+
+    def get_derived_values(self, game_id: str, versions: Dict[str, int]) -> Dict[str, Any]:
+        """Loads several values derived from a game in one query.
+
+        Args:
+            game_id (str): The id of the game.
+            versions (Dict[str, int]): The version each value has to be computed with, by name.
+
+        Returns:
+            Dict[str, Any]: The values that have been computed with their version, by name.
+        """
+        rows = self._execute('SELECT name, version, value FROM derived WHERE game_id = ?', (game_id,))
+
+        return {name: json.loads(value) for name, version, value in rows if versions.get(name) == version}
+
+    def derive_many(self, games: List[Dict], versions: Dict[str, int], compute: Callable[[List[Dict], List[List[str]]], Iterable[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """Like derive_batch, but for several values per game. Only the values that aren't stored
+        yet are computed, with a single call for all games.
+
+        Args:
+            games (List[Dict]): The games.
+            versions (Dict[str, int]): The version of the algorithm of each value, by name.
+            compute (Callable[[List[Dict], List[List[str]]], Iterable[Dict[str, Any]]]): Computes
+            the values with the given names for each of a list of games, in the same order.
+
+        Returns:
+            List[Dict[str, Any]]: The values by name, in the order of the games.
+        """
+        values = [self.get_derived_values(game['id'], versions) if is_final(game) else dict() for game in games]
+        missing = [(idx, [name for name in versions if name not in game_values]) for idx, game_values in enumerate(values)]
+        missing = [(idx, names) for idx, names in missing if len(names) > 0]
+
+        count('store.values_cached', sum(len(game_values) for game_values in values))
+
+        computed = compute([games[idx] for idx, _ in missing], [names for _, names in missing])
+
+        for (idx, names), game_values in zip(missing, computed):
+            values[idx].update(game_values)
+
+            if is_final(games[idx]):
+                for name in names:
+                    self.put_derived(games[idx]['id'], name, versions[name], game_values[name])
+
+        return values
@@ -1,16 +1,29 @@
+import json
+import math
+import os
+import numpy as np
 import pandas as pd
-import gspread as gs
-import time
-from gspread.exceptions import APIError
 
-from typing import List, Any, Tuple
+from typing import TYPE_CHECKING, List, Any, Dict, Optional, Tuple
 
-from apis import init_gspread_api
+from apis import SHEETS, init_gspread_api
+from instrumentation import count, span
 
+# gspread takes a while to import, it is only loaded once a request is sent.
+if TYPE_CHECKING:
+    import gspread as gs
 
-def download_as_dataframe(spreadsheet, ws_name, table_name, max_retries=3, initial_backoff=1) -> Tuple[pd.DataFrame, List[Any]]:
+
+SHEET_CACHE_DIR = 'data/sheet_cache'
+
+# Google Sheets error values, they are replaced with empty strings.
+ERROR_VALUES = ['#N/A', '#DIV/0!', '#REF!', '#VALUE!', '#ERROR!']
+
+
+def download_as_dataframe(spreadsheet, ws_name, table_name, max_retries=3, initial_backoff=1, cache=True) -> Tuple[pd.DataFrame, List[Any]]:
     """
     Download a named range from Google Sheets with retry logic for transient API failures.
+    The range is read from the local cache if the spreadsheet hasn't changed since it was cached.
     
     Args:
         spreadsheet: gspread Spreadsheet object
@@ -18,44 +31,127 @@ def download_as_dataframe(spreadsheet, ws_name, table_name, max_retries=3, initi
         table_name: named range/table name
         max_retries: maximum number of retry attempts (default: 3)
         initial_backoff: initial backoff time in seconds (default: 1)
+        cache: whether to use the local cache (default: True)
     
     Returns:
         Tuple of (DataFrame, header list)
     """
-    worksheet = spreadsheet.worksheet(ws_name)
-    
-    # Retry loop with exponential backoff
-    for attempt in range(max_retries):
-        try:
-            table = worksheet.get(table_name)
-            break
-        except APIError as e:
-            if attempt == max_retries - 1:
-                raise  # Re-raise on final attempt
-            
-            # Check if it's a retryable error (5xx or rate limit)
-            error_code = int(str(e).split('[')[1].split(']')[0]) if '[' in str(e) else None
-            if error_code and error_code >= 500:
-                backoff_time = initial_backoff * (2 ** attempt)  # Exponential backoff
-                print(f"API error (attempt {attempt + 1}/{max_retries}): {e}. Retrying in {backoff_time}s...")
-                time.sleep(backoff_time)
-            else:
-                raise  # Don't retry on non-5xx errors
-    df = pd.DataFrame(table[1:], columns=table[0])
-    
-    # Replace Google Sheets error values with empty strings
-    df = df.replace('#N/A', '')
-    df = df.replace('#DIV/0!', '')
-    df = df.replace('#REF!', '')
-    df = df.replace('#VALUE!', '')
-    df = df.replace('#ERROR!', '')
+    return download_as_dataframes(spreadsheet, [(ws_name, table_name)], max_retries, initial_backoff, cache)[0]
+
+
+def download_as_dataframes(spreadsheet, ranges: List[Tuple[str, str]], max_retries=3, initial_backoff=1, cache=True) -> List[Tuple[pd.DataFrame, List[Any]]]:
+    """
+    Download several named ranges from Google Sheets in a single request. Ranges are read from
+    the local cache if the spreadsheet hasn't changed since they were cached, only the others
+    are requested.
+
+    Args:
+        spreadsheet: gspread Spreadsheet object
+        ranges: the worksheet name and named range/table name of each table
+        max_retries: maximum number of retry attempts (default: 3)
+        initial_backoff: initial backoff time in seconds (default: 1)
+        cache: whether to use the local cache (default: True)
+
+    Returns:
+        List of (DataFrame, header list), one for each range
+    """
+    with span('sheets.download'):
+        modified = SHEETS.call(spreadsheet.get_lastUpdateTime, max_retries=max_retries, initial_backoff=initial_backoff) if cache else None
+
+        tables = [load_cached_table(spreadsheet, ws_name, table_name, modified) for ws_name, table_name in ranges]
+        missing = [i for i, table in enumerate(tables) if table is None]
+
+        count('sheets.cache_hits', len(tables) - len(missing))
+
+        if len(missing) > 0:
+            from gspread.utils import absolute_range_name
+
+            names = [absolute_range_name(*ranges[i]) for i in missing]
+            response = SHEETS.call(spreadsheet.values_batch_get, names, max_retries=max_retries, initial_backoff=initial_backoff)
+
+            for i, value_range in zip(missing, response['valueRanges']):
+                tables[i] = value_range.get('values', [])
+                count('sheets.cells_read', sum(len(row) for row in tables[i]))
+
+                if cache:
+                    save_cached_table(spreadsheet, *ranges[i], modified, tables[i])
+
+    with span('sheets.to_dataframe'):
+        return [(table_to_dataframe(table), table[0]) for table in tables]
+
+
+def table_to_dataframe(table: List[List[Any]]) -> pd.DataFrame:
+    """
+    Turn a downloaded table into a DataFrame, with Google Sheets error values replaced by empty strings.
+
+    Args:
+        table: the rows of the table, the header first
+
+    Returns:
+        DataFrame with the header as columns
+    """
+    # The API leaves out empty cells at the end of a row.
+    width = len(table[0])
+    df = pd.DataFrame([row + [''] * (width - len(row)) for row in table[1:]], columns=table[0])
 
-    return df, table[0]
+    return df.replace(ERROR_VALUES, '')
 
 
-def upload_dataframe(spreadsheet: gs.Worksheet, ws_name, table_name, df: pd.DataFrame, header: List=None, max_retries=3, initial_backoff=1):
+def _cache_path(spreadsheet, ws_name, table_name) -> str:
+    return os.path.join(SHEET_CACHE_DIR, spreadsheet.id, f'{ws_name}.{table_name}.json')
+
+
+def load_cached_table(spreadsheet, ws_name, table_name, modified) -> Optional[List[List[Any]]]:
+    """
+    Load a range from the local cache.
+
+    Args:
+        spreadsheet: gspread Spreadsheet object
+        ws_name: worksheet name
+        table_name: named range/table name
+        modified: when the spreadsheet was last modified, None to skip the cache
+
+    Returns:
+        The rows of the range, or None if it isn't cached or the spreadsheet changed since
+    """
+    path = _cache_path(spreadsheet, ws_name, table_name)
+
+    if modified is None or not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        cached = json.load(f)
+
+    return cached['table'] if cached['modified'] == modified else None
+
+
+def save_cached_table(spreadsheet, ws_name, table_name, modified, table: List[List[Any]]):
+    """
+    Store a range in the local cache, replacing the previous copy in one step.
+
+    Args:
+        spreadsheet: gspread Spreadsheet object
+        ws_name: worksheet name
+        table_name: named range/table name
+        modified: when the spreadsheet was last modified
+        table: the rows of the range
+    """
+    path = _cache_path(spreadsheet, ws_name, table_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'modified': modified, 'table': table}, f)
+
+    os.replace(path + '.tmp', path)
+
+
+def upload_dataframe(spreadsheet: 'gs.Worksheet', ws_name, table_name, df: pd.DataFrame, header: List=None, original: pd.DataFrame=None, max_retries=3, initial_backoff=1, cache=True) -> Dict[str, int]:
     """
     Upload a DataFrame to Google Sheets with retry logic for transient API failures.
+    If the downloaded version of the table is given, only the cells that differ from it are sent,
+    grouped into one range per run of changed cells in a row, and columns it doesn't have are sent
+    as one range next to the table, all written in a single batch request. The uploaded table then
+    replaces the cached copy of the range, see cache_uploaded_table.
     
     Args:
         spreadsheet: gspread Spreadsheet object
@@ -63,33 +159,203 @@ def upload_dataframe(spreadsheet: gs.Worksheet, ws_name, table_name, df: pd.Data
         table_name: named range/table name
         df: DataFrame to upload
         header: optional custom header row
+        original: optional DataFrame as it was downloaded, to only upload the changes
         max_retries: maximum number of retry attempts (default: 3)
         initial_backoff: initial backoff time in seconds (default: 1)
+        cache: whether to store the uploaded table in the local cache (default: True)
+
+    Returns:
+        Dict with the number of cells, ranges and bytes that were sent
     """
-    worksheet = spreadsheet.worksheet(ws_name)
-    table = df.values.tolist()
+    with span('sheets.upload'):
+        stats = _upload_dataframe(spreadsheet, ws_name, table_name, df, header, original, max_retries, initial_backoff)
 
-    print(header)
+        if cache and original is not None and stats['ranges'] > 0:
+            cache_uploaded_table(spreadsheet, ws_name, table_name, df, header, original, max_retries, initial_backoff)
 
-    if header is not None:
-        table = [header] + table
+    count('sheets.cells_written', stats['cells'])
+    count('sheets.ranges_written', stats['ranges'])
+    count('sheets.bytes_sent', stats['bytes'])
+
+    print(f"Uploaded {stats['cells']} cells in {stats['ranges']} ranges ({stats['bytes']} bytes) to {table_name}")
+
+    return stats
+
+
+def _upload_dataframe(spreadsheet, ws_name, table_name, df, header, original, max_retries, initial_backoff) -> Dict[str, int]:
+    worksheet = SHEETS.call(spreadsheet.worksheet, ws_name, max_retries=max_retries, initial_backoff=initial_backoff)
+
+    if original is None:
+        table = df.values.tolist()
+
+        if header is not None:
+            table = [header] + table
+
+        SHEETS.call(worksheet.update, table_name, table, max_retries=max_retries, initial_backoff=initial_backoff)
+
+        stats = {'cells': sum(len(row) for row in table), 'ranges': 1, 'bytes': len(json.dumps(table, default=str))}
+    else:
+        data = diff_ranges(spreadsheet, table_name, df, original, header)
+
+        if len(data) > 0:
+            SHEETS.call(worksheet.batch_update, data, max_retries=max_retries, initial_backoff=initial_backoff)
+
+        stats = {
+            'cells': sum(len(row) for d in data for row in d['values']),
+            'ranges': len(data),
+            'bytes': len(json.dumps(data, default=str)) if len(data) > 0 else 0
+        }
+
+    return stats
+
+
+def cache_uploaded_table(spreadsheet, ws_name, table_name, df: pd.DataFrame, header: List, original: pd.DataFrame, max_retries=3, initial_backoff=1):
+    """
+    Store a table that was just uploaded over its downloaded version in the local cache, as it
+    would be downloaded now and tagged with the spreadsheet's new modified time, so that the next
+    download of the range doesn't fetch it again. Tables with other columns than the downloaded
+    version aren't stored, the named range may not cover them. Other cached ranges still count as
+    changed, they may be computed from this one.
+
+    Args:
+        spreadsheet: gspread Spreadsheet object
+        ws_name: worksheet name
+        table_name: named range/table name
+        df: DataFrame that was uploaded
+        header: custom header row that was uploaded, None for the columns of the downloaded table
+        original: DataFrame as it was downloaded
+        max_retries: maximum number of retry attempts (default: 3)
+        initial_backoff: initial backoff time in seconds (default: 1)
+    """
+    if list(df.columns) != list(original.columns):
+        return
+
+    # Rows the upload didn't reach are left as they were.
+    rows = [list(header if header is not None else original.columns)]
+    for values in (df.values, original.values[len(df):]):
+        if values.size > 0:
+            rows.extend(np.vectorize(_cell_text, otypes=[object])(values).tolist())
+
+    # Like the API, leave out empty cells at the end of a row and empty rows at the end.
+    table = []
+    for row in rows:
+        while row and row[-1] == '':
+            row.pop()
+        table.append(row)
+
+    while len(table) > 1 and len(table[-1]) == 0:
+        table.pop()
+
+    modified = SHEETS.call(spreadsheet.get_lastUpdateTime, max_retries=max_retries, initial_backoff=initial_backoff)
+    save_cached_table(spreadsheet, ws_name, table_name, modified, table)
+
+
+def diff_ranges(spreadsheet, table_name, df: pd.DataFrame, original: pd.DataFrame, header: List=None, max_gap=3) -> List[Dict[str, Any]]:
+    """
+    Compare a DataFrame against the version of the table that was downloaded and collect the cells
+    that changed. Cells are compared by how they show up in the sheet, e.g. 5.0 equals '5'. Columns
+    that the downloaded table doesn't have, e.g. a new stat column, are sent whole with their name
+    as one range to the right of the table, columns that the DataFrame lacks are left as they are.
+
+    Args:
+        spreadsheet: gspread Spreadsheet object
+        table_name: named range/table name
+        df: DataFrame to upload
+        original: DataFrame as it was downloaded
+        header: optional custom header row
+        max_gap: runs of changed cells in a row separated by at most this many unchanged cells
+            are sent as one range (default: 3)
+
+    Returns:
+        List of ranges in the format expected by Worksheet.batch_update, one per run of changed
+        cells in a row
+    """
+    from gspread.utils import rowcol_to_a1
+
+    columns = list(original.columns)
+    extra = [col for col in df.columns if col not in columns]
+    values = df.reindex(columns=columns).values.astype(object)
+    n_rows = min(len(original), len(df))
+
+    # Columns the DataFrame lacks keep their values, in case a range spans them.
+    missing = [col not in df.columns for col in columns]
+    values[:, missing] = ''
+    values[:n_rows, missing] = original.values[:n_rows][:, missing]
+
+    new_text = np.vectorize(_cell_text, otypes=[object])(values) if values.size > 0 else values
+    old_text = np.full(new_text.shape, '', dtype=object)
+
+    if n_rows > 0:
+        old_text[:n_rows] = np.vectorize(_cell_text, otypes=[object])(original.values[:n_rows])
+
+    changed = new_text != old_text
+    changed[:, missing] = False
+    rows = np.flatnonzero(changed.any(axis=1))
+
+    data = []
+    first_row, first_col = None, None
+
+    if header is not None and list(header) != list(original.columns):
+        first_row, first_col = get_range_origin(spreadsheet, table_name)
+        data.append({
+            'range': f'{rowcol_to_a1(first_row, first_col)}:{rowcol_to_a1(first_row, first_col + len(header) - 1)}',
+            'values': [list(header)]
+        })
+
+    if (len(rows) > 0 or len(extra) > 0) and first_row is None:
+        first_row, first_col = get_range_origin(spreadsheet, table_name)
+
+    if len(extra) > 0:
+        col = first_col + len(columns)
+        data.append({
+            'range': f'{rowcol_to_a1(first_row, col)}:{rowcol_to_a1(first_row + len(df), col + len(extra) - 1)}',
+            'values': [extra] + df[extra].values.tolist()
+        })
+
+    for row in rows:
+        # Split the changed cells of a row into runs, resending a few unchanged cells is cheaper
+        # than an extra range.
+        cols = np.flatnonzero(changed[row])
+        breaks = np.flatnonzero(np.diff(cols) > max_gap + 1)
+        starts = np.concatenate(([cols[0]], cols[breaks + 1]))
+        ends = np.concatenate((cols[breaks], [cols[-1]]))
+
+        sheet_row = first_row + 1 + row
+        for start, end in zip(starts, ends):
+            data.append({
+                'range': f'{rowcol_to_a1(sheet_row, first_col + start)}:{rowcol_to_a1(sheet_row, first_col + end)}',
+                'values': [values[row, start:end + 1].tolist()]
+            })
+
+    return data
+
+
+def _cell_text(value) -> str:
+    # How a value shows up in the sheet, which is how downloaded cells are represented.
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ''
+
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return str(value)
+
+
+def get_range_origin(spreadsheet, table_name) -> Tuple[int, int]:
+    """
+    Look up the top left cell of a named range.
+
+    Args:
+        spreadsheet: gspread Spreadsheet object
+        table_name: named range/table name
+
+    Returns:
+        Tuple of 1-based (row, column) of the first cell in the range
+    """
+    for named_range in SHEETS.call(spreadsheet.list_named_ranges):
+        if named_range['name'] == table_name:
+            grid_range = named_range['range']
+            return grid_range.get('startRowIndex', 0) + 1, grid_range.get('startColumnIndex', 0) + 1
+
+    raise ValueError(f"Named range '{table_name}' not found")
 
-    print(table)
-    
-    # Retry loop with exponential backoff
-    for attempt in range(max_retries):
-        try:
-            worksheet.update(table_name, table)
-            break
-        except APIError as e:
-            if attempt == max_retries - 1:
-                raise  # Re-raise on final attempt
-            
-            # Check if it's a retryable error (5xx or rate limit)
-            error_code = int(str(e).split('[')[1].split(']')[0]) if '[' in str(e) else None
-            if error_code and error_code >= 500:
-                backoff_time = initial_backoff * (2 ** attempt)  # Exponential backoff
-                print(f"API error (attempt {attempt + 1}/{max_retries}): {e}. Retrying in {backoff_time}s...")
-                time.sleep(backoff_time)
-            else:
-                raise  # Don't retry on non-5xx errors
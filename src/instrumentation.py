@@ -0,0 +1,151 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from typing import Any, Dict, Iterator
+
+
+REPORT_DIR = 'data/reports'
+
+
+class Recorder:
+    """Collects how long the spans of a run took and what it counted, e.g. requests, retries or
+    games processed. Spans with the same name are added up. It is shared by all threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.perf_counter()
+            self.spans: Dict[str, Dict[str, float]] = dict()
+            self.counters: Dict[str, float] = dict()
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Times the code in the with block.
+
+        Args:
+            name (str): The name of the span, e.g. 'sheets.download'.
+        """
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+
+            with self.lock:
+                span = self.spans.setdefault(name, {'count': 0, 'total_s': 0, 'max_s': 0})
+                span['count'] += 1
+                span['total_s'] += elapsed
+                span['max_s'] = max(span['max_s'], elapsed)
+
+    def count(self, name: str, value: float = 1):
+        """Adds to a counter.
+
+        Args:
+            name (str): The name of the counter, e.g. 'lichess.requests'.
+            value (float, optional): The amount to add. Defaults to 1.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self) -> Dict[str, Any]:
+        """Summarizes the run so far.
+
+        Returns:
+            Dict[str, Any]: The wall time, the spans and the counters.
+        """
+        with self.lock:
+            return {
+                'wall_s': round(time.perf_counter() - self.started, 3),
+                'spans': {name: {'count': span['count'], 'total_s': round(span['total_s'], 3), 'max_s': round(span['max_s'], 3)} for name, span in sorted(self.spans.items())},
+                'counters': {name: round(value, 3) for name, value in sorted(self.counters.items())},
+            }
+
+
+# Shared by everything that runs in this process.
+RECORDER = Recorder()
+
+span = RECORDER.span
+count = RECORDER.count
+
+
+def timed(name: str):
+    """Times every call of the decorated function as a span."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def run_report(script: str, path: str = None, profile: bool = False) -> Iterator[Recorder]:
+    """Records a run of a script and writes a JSON report when it ends, even if it fails.
+
+    Args:
+        script (str): The name of the script.
+        path (str, optional): The file to write the report to. Defaults to a timestamped file in REPORT_DIR.
+        profile (bool, optional): Whether to run the script under cProfile. The profile is saved
+            next to the report and its most expensive functions are added to it. Defaults to False.
+
+    Yields:
+        Recorder: The recorder of the run.
+    """
+    RECORDER.reset()
+
+    if path is None:
+        path = os.path.join(REPORT_DIR, f"{script}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+
+    profiler = cProfile.Profile() if profile else None
+    if profiler:
+        profiler.enable()
+
+    error = None
+    try:
+        yield RECORDER
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        report = {'script': script, 'finished_at': datetime.now().isoformat(timespec='seconds'), 'error': error}
+        report.update(RECORDER.report())
+
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(os.path.splitext(path)[0] + '.prof')
+
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(25)
+            report['profile'] = out.getvalue().splitlines()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        # On stderr, so that output like the pairings as json stays valid.
+        print(f"Run report written to {path} ({report['wall_s']}s)", file=sys.stderr)
+
+
+def add_report_args(parser):
+    """Adds the --report and --profile options of run_report to a script's argument parser."""
+    parser.add_argument('--report', help=f'file to write the run report to (default: a timestamped file in {REPORT_DIR})')
+    parser.add_argument('--profile', action='store_true', help='run under cProfile and add the most expensive functions to the report')
@@ -0,0 +1,212 @@
+import json
+
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from apis import LICHESS, Service
+from instrumentation import count
+
+if TYPE_CHECKING:
+    from berserk import Client
+
+# orjson decodes the export about a fifth faster, it is used when it is installed.
+try:
+    from orjson import loads
+except ImportError:
+    loads = json.loads
+
+
+# Lichess accepts at most 300 ids per request to /api/games/export/_ids.
+EXPORT_CHUNK_SIZE = 300
+
+EXPORT_PATH = '/api/games/export/_ids'
+
+# Games in these states can still receive moves and have to be requested again.
+UNFINISHED_STATUSES = {'created', 'started'}
+
+# Mates are stored as an eval of this many centipawns, with the sign of the side that mates.
+MATE_SCORE = 100000
+
+
+def analysis_score(entry: Dict) -> Optional[int]:
+    """Reads the eval after a move from white's point of view.
+
+    Args:
+        entry (Dict): The move's entry in the game's analysis.
+
+    Returns:
+        Optional[int]: The eval in centipawns, +-MATE_SCORE for a mate, or None if there is none.
+    """
+    if 'eval' in entry:
+        return entry['eval']
+
+    if 'mate' in entry:
+        return MATE_SCORE if entry['mate'] > 0 else -MATE_SCORE if entry['mate'] < 0 else 0
+
+    return None
+
+
+def _millis(value) -> Optional[int]:
+    # berserk converts the timestamps to datetimes, Lichess sends them in ms.
+    if hasattr(value, 'timestamp'):
+        return int(round(value.timestamp() * 1000))
+
+    return value
+
+
+class GameRecord:
+    """The fields of an exported game that the scripts use, without the rest of the export.
+    Timestamps are in ms and the analysis is reduced to the eval after each move, see analysis_score.
+    """
+
+    __slots__ = ('id', 'status', 'created_at', 'last_move_at', 'white', 'black', 'winner', 'moves', 'eco', 'white_acpl', 'black_acpl', 'evals')
+
+    def __init__(self, id: str, status: str, created_at: int, last_move_at: Optional[int], white: str, black: str, winner: Optional[str], moves: str, eco: Optional[str], white_acpl: Optional[int], black_acpl: Optional[int], evals: Tuple[Optional[int], ...]):
+        self.id = id
+        self.status = status
+        self.created_at = created_at
+        self.last_move_at = last_move_at
+        self.white = white
+        self.black = black
+        self.winner = winner
+        self.moves = moves
+        self.eco = eco
+        self.white_acpl = white_acpl
+        self.black_acpl = black_acpl
+        self.evals = evals
+
+    @classmethod
+    def from_game(cls, game: Dict[str, Any]) -> 'GameRecord':
+        """Reads the record from a game, as Lichess sends it or as berserk converts it.
+
+        Args:
+            game (Dict[str, Any]): The game.
+
+        Returns:
+            GameRecord: The record of the game.
+        """
+        white = game['players']['white']
+        black = game['players']['black']
+
+        return cls(
+            game['id'],
+            game['status'],
+            _millis(game['createdAt']),
+            _millis(game.get('lastMoveAt')),
+            white['user']['id'],
+            black['user']['id'],
+            game.get('winner'),
+            game.get('moves', ''),
+            game.get('opening', {}).get('eco'),
+            white['analysis']['acpl'] if 'analysis' in white else None,
+            black['analysis']['acpl'] if 'analysis' in black else None,
+            tuple(map(analysis_score, game.get('analysis', ()))),
+        )
+
+    @property
+    def analysed(self) -> bool:
+        """Whether Lichess has analysed the game."""
+        return self.white_acpl is not None
+
+    @property
+    def final(self) -> bool:
+        """Whether the game can no longer change, i.e. it is over and has been analysed."""
+        return self.status not in UNFINISHED_STATUSES and self.analysed
+
+
+class BatchExporter:
+    """Exports games from Lichess in as few requests as possible. The ids are split into chunks of
+    the largest size Lichess accepts, the games of a chunk are yielded once all of it has arrived
+    and failed requests are retried by the service. Ids that Lichess didn't return are collected
+    in `missing`.
+    """
+
+    def __init__(self, client: 'Client', chunk_size: int = EXPORT_CHUNK_SIZE, service: Service = LICHESS):
+        self.client = client
+        self.chunk_size = chunk_size
+        self.service = service
+        self.missing: List[str] = []
+
+    def export(self, game_ids: Iterable[str], **params) -> Iterator[Dict]:
+        """Exports the given games.
+
+        Args:
+            game_ids (Iterable[str]): The ids of the games to export.
+            params: Passed on to export_multi, e.g. evals=True.
+
+        Yields:
+            Dict: The games in the order Lichess sends them.
+        """
+        def fetch(ids: List[str]) -> Iterator[Tuple[str, Dict]]:
+            for game in self.client.games.export_multi(*ids, **params):
+                yield game['id'], game
+
+        return self._export(game_ids, fetch)
+
+    def export_records(self, game_ids: Iterable[str]) -> Iterator[Tuple[GameRecord, bytes]]:
+        """Exports the given games with their moves, analysis and opening as raw NDJSON. Each line
+        is decoded into a GameRecord as soon as it has arrived, the decoded game is dropped right
+        away and berserk's conversion of the whole game is skipped. The request is sent on the
+        client's session directly, see apis.create_lichess_client, as berserk has no public way
+        to read the raw lines.
+
+        Args:
+            game_ids (Iterable[str]): The ids of the games to export.
+
+        Yields:
+            Tuple[GameRecord, bytes]: The record of each game and the line it was read from, in
+            the order Lichess sends them.
+        """
+        def fetch(ids: List[str]) -> Iterator[Tuple[str, Tuple[GameRecord, bytes]]]:
+            response = self.client.session.post(
+                self.client.base_url + EXPORT_PATH,
+                params={'evals': 'true', 'opening': 'true'},
+                data=','.join(ids),
+                headers={'Accept': 'application/x-ndjson'},
+                stream=True
+            )
+
+            with response:
+                response.raise_for_status()
+
+                for line in response.iter_lines(chunk_size=16384):
+                    if line:
+                        record = GameRecord.from_game(loads(line))
+                        yield record.id, (record, line)
+
+        return self._export(game_ids, fetch)
+
+    def _export(self, game_ids: Iterable[str], fetch: Callable[[List[str]], Iterator[Tuple[str, Any]]]) -> Iterator[Any]:
+        self.missing = []
+        game_ids = list(dict.fromkeys(game_ids))
+
+        for start in range(0, len(game_ids), self.chunk_size):
+            chunk = game_ids[start:start + self.chunk_size]
+            pending = set(chunk)
+
+            attempt = 0
+
+            while len(pending) > 0:
+                received = []
+                error = None
+
+                try:
+                    # The response of a chunk is read in full before its games are handed out, so
+                    # that the slot is free again while they are processed, e.g. for the players.
+                    with self.service.request():
+                        # After a retry only ask for the games that haven't arrived yet.
+                        for game_id, game in fetch([id for id in chunk if id in pending]):
+                            pending.discard(game_id)
+                            received.append(game)
+                except Exception as e:
+                    error = e
+
+                count('lichess.games', len(received))
+                yield from received
+
+                if error is None:
+                    break
+
+                self.service.wait(self.service.backoff(error, attempt))
+                attempt += 1
+
+            self.missing.extend(id for id in chunk if id in pending)
@@ -0,0 +1,300 @@
+import numpy as np
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+from instrumentation import count, span
+
+
+# How many neighbours by rating on either side a player is connected to at first. Pairs further
+# apart are only considered if there is no pairing otherwise, see find_pairings.
+DEFAULT_K = 10
+
+Edges = Tuple[np.ndarray, np.ndarray, np.ndarray]
+Matching = List[Tuple[int, int]]
+
+
+def candidate_edges(ratings: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Connects each player with the k players closest in rating on either side.
+
+    Args:
+        ratings (np.ndarray): The rating of each player.
+        k (int): The number of neighbours on either side.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The two ends of each edge, the smaller index first.
+    """
+    n = len(ratings)
+    order = np.argsort(ratings, kind='stable')
+
+    offsets = range(1, min(k, n - 1) + 1)
+    i = np.concatenate([order[:-offset] for offset in offsets]) if n > 1 else np.empty(0, dtype=int)
+    j = np.concatenate([order[offset:] for offset in offsets]) if n > 1 else np.empty(0, dtype=int)
+
+    return np.minimum(i, j), np.maximum(i, j)
+
+
+def solve_networkx(n: int, i: np.ndarray, j: np.ndarray, w: np.ndarray) -> Optional[Matching]:
+    """Finds a minimum weight perfect matching with networkx' blossom algorithm.
+
+    Args:
+        n (int): The number of nodes.
+        i (np.ndarray): The first end of each edge.
+        j (np.ndarray): The second end of each edge.
+        w (np.ndarray): The weight of each edge.
+
+    Returns:
+        Optional[Matching]: The matched pairs, or None if there is no perfect matching.
+    """
+    import networkx as nx
+
+    G = nx.Graph()
+    G.add_nodes_from(range(n))
+    G.add_weighted_edges_from(zip(i.tolist(), j.tolist(), w.tolist()))
+
+    matching = nx.algorithms.matching.min_weight_matching(G)
+
+    return list(matching) if 2 * len(matching) == n else None
+
+
+def solve_milp(n: int, i: np.ndarray, j: np.ndarray, w: np.ndarray) -> Optional[Matching]:
+    """Finds a minimum weight perfect matching as an integer program solved by HiGHS. This
+    requires scipy.
+
+    Args:
+        n (int): The number of nodes.
+        i (np.ndarray): The first end of each edge.
+        j (np.ndarray): The second end of each edge.
+        w (np.ndarray): The weight of each edge.
+
+    Returns:
+        Optional[Matching]: The matched pairs, or None if there is no perfect matching.
+    """
+    from scipy.optimize import Bounds, LinearConstraint, milp
+    from scipy.sparse import coo_matrix
+
+    m = len(w)
+    if m == 0:
+        return [] if n == 0 else None
+
+    # Every node is covered by exactly one chosen edge.
+    incidence = coo_matrix((np.ones(2 * m), (np.concatenate([i, j]), np.tile(np.arange(m), 2))), shape=(n, m))
+    result = milp(
+        c=w,
+        constraints=LinearConstraint(incidence.tocsr(), 1, 1),
+        integrality=np.ones(m),
+        bounds=Bounds(0, 1),
+        options={'mip_rel_gap': 0}
+    )
+
+    if result.status != 0:
+        return None
+
+    chosen = np.flatnonzero(result.x > 0.5)
+
+    return list(zip(i[chosen].tolist(), j[chosen].tolist()))
+
+
+SOLVERS: Dict[str, Callable[[int, np.ndarray, np.ndarray, np.ndarray], Optional[Matching]]] = {
+    'networkx': solve_networkx,
+    'milp': solve_milp,
+}
+
+
+def default_solver() -> str:
+    """Picks the fastest solver that is installed."""
+    try:
+        import scipy.optimize  # noqa: F401
+        return 'milp'
+    except ImportError:
+        return 'networkx'
+
+
+def find_pairings(ratings: np.ndarray, allowed: Callable[[int, int], bool], k: int = DEFAULT_K, solver: str = None, weight: Callable[[np.ndarray, np.ndarray], np.ndarray] = None) -> Tuple[Optional[Matching], Edges]:
+    """Pairs the players such that the total rating difference is minimal among the pairs of
+    players close in rating. Only the k neighbours by rating on either side are considered as
+    opponents; the neighbourhood is only widened when no pairing exists for everyone, until all
+    players are connected. The pairing is therefore the best of the candidate graph, which is
+    usually but not always the best of all allowed pairs, e.g. when many nearby pairs aren't
+    allowed. A k of len(ratings) - 1 always gives the optimal pairing.
+
+    Args:
+        ratings (np.ndarray): The rating of each player.
+        allowed (Callable[[int, int], bool]): Whether two players (by index) may be paired.
+        k (int, optional): The initial number of neighbours by rating on either side. Defaults to DEFAULT_K.
+        solver (str, optional): One of SOLVERS. Defaults to the fastest one installed.
+        weight (Callable[[np.ndarray, np.ndarray], np.ndarray], optional): The cost of the edges
+            between the players (by index) in the first and the second array. Defaults to the
+            rating difference.
+
+    Returns:
+        Tuple[Optional[Matching], Edges]: The pairs of player indices, or None if there is no way
+        to pair everyone, and the edges of the last candidate graph.
+    """
+    solve = SOLVERS[solver or default_solver()]
+    ratings = np.asarray(ratings, dtype=float)
+    n = len(ratings)
+
+    while True:
+        i, j = candidate_edges(ratings, k)
+        mask = np.fromiter((allowed(a, b) for a, b in zip(i.tolist(), j.tolist())), dtype=bool, count=len(i))
+        i, j = i[mask], j[mask]
+        w = np.abs(ratings[i] - ratings[j]) if weight is None else weight(i, j)
+
+        count('pairings.graph_edges', len(i))
+
+        with span('pairings.matching'):
+            matching = solve(n, i, j, w)
+
+        if matching is not None or k >= n - 1:
+            return matching, (i, j, w)
+
+        count('pairings.widenings')
+        k *= 2
+
+
+
+def _round_matching(degrees: np.ndarray, i: np.ndarray, j: np.ndarray, w: np.ndarray, solve) -> Optional[np.ndarray]:
+    """Pairs a single round in which some players sit out and one may play twice.
+
+    Args:
+        degrees (np.ndarray): The number of games of each player in the round.
+        i (np.ndarray): The first end of each edge.
+        j (np.ndarray): The second end of each edge.
+        w (np.ndarray): The weight of each edge, np.inf for edges that may not be played.
+        solve: One of SOLVERS.
+
+    Returns:
+        Optional[np.ndarray]: Whether each edge is played, or None if the round can't be paired.
+    """
+    # A player playing twice gets two nodes, each with all of the player's edges.
+    first = np.concatenate([[0], np.cumsum(degrees)[:-1]])
+    slot_i, slot_j, edge = [], [], []
+    for da in range(2):
+        for db in range(2):
+            mask = (degrees[i] > da) & (degrees[j] > db) & np.isfinite(w)
+            slot_i.append(first[i[mask]] + da)
+            slot_j.append(first[j[mask]] + db)
+            edge.append(np.flatnonzero(mask))
+
+    slot_i, slot_j, edge = np.concatenate(slot_i), np.concatenate(slot_j), np.concatenate(edge)
+    matching = solve(int(degrees.sum()), slot_i, slot_j, w[edge])
+
+    if matching is None:
+        return None
+
+    edges = {(a, b): e for a, b, e in zip(slot_i.tolist(), slot_j.tolist(), edge.tolist())}
+    played = np.zeros(len(w), dtype=bool)
+    for a, b in matching:
+        played[edges[(a, b)] if (a, b) in edges else edges[(b, a)]] = True
+
+    return played
+
+
+def pair_rounds(degrees: np.ndarray, i: np.ndarray, j: np.ndarray, w: np.ndarray, solver: str = None, iterations: int = 10) -> Tuple[Optional[List[Matching]], float]:
+    """Pairs several rounds such that no two players meet twice and the total weight over all
+    rounds is small. Pairing the rounds one after another lets an early round take the opponents a
+    later round needs, so edges wanted by several rounds are given a price (a Lagrangian
+    relaxation of 'each edge is played at most once') and the rounds are paired again with the
+    prices until the rounds agree or the iterations run out. Pairing the rounds one after
+    another on the same candidate graph is the first solution tried, so the result is never
+    worse than that.
+
+    Args:
+        degrees (np.ndarray): The number of games of each node in each round, shape (rounds, nodes).
+        i (np.ndarray): The first end of each edge.
+        j (np.ndarray): The second end of each edge.
+        w (np.ndarray): The weight of each edge.
+        solver (str, optional): One of SOLVERS. Defaults to the fastest one installed.
+        iterations (int, optional): The maximum number of times the prices are updated. Defaults to 10.
+
+    Returns:
+        Tuple[Optional[List[Matching]], float]: The matched pairs of each round, or None if no
+        solution was found, and a lower bound on the total weight of any solution.
+    """
+    solve = SOLVERS[solver or default_solver()]
+    prices = np.zeros(len(w))
+    best, best_cost, bound = None, np.inf, -np.inf
+
+    for _ in range(iterations):
+        # Pair the rounds one after another with the prices, each avoiding the edges of the ones before.
+        played = np.zeros(len(w), dtype=bool)
+        rounds = []
+        for round_degrees in degrees:
+            chosen = _round_matching(round_degrees, i, j, np.where(played, np.inf, w + prices), solve)
+            if chosen is None:
+                break
+            played |= chosen
+            rounds.append(chosen)
+
+        if len(rounds) == len(degrees) and w[played].sum() < best_cost:
+            best, best_cost = rounds, w[played].sum()
+
+        # Pair the rounds independently with the prices, which bounds the cost from below. Rounds
+        # with the same players have the same pairings.
+        independent = dict()
+        for round_degrees in degrees:
+            if round_degrees.tobytes() not in independent:
+                independent[round_degrees.tobytes()] = _round_matching(round_degrees, i, j, w + prices, solve)
+        rounds = [independent[round_degrees.tobytes()] for round_degrees in degrees]
+        if any(chosen is None for chosen in rounds):
+            return None, np.inf
+
+        uses = np.sum(rounds, axis=0)
+        bound = max(bound, (w + prices) @ uses - prices.sum())
+
+        if uses.max() <= 1 and w @ uses < best_cost:
+            best, best_cost = rounds, w @ uses
+
+        # Stop when the best solution is (close to) optimal or the prices no longer change.
+        overuse = uses - 1.0
+        overuse[(prices == 0) & (overuse < 0)] = 0
+        if best_cost - bound < 1e-6 or not overuse.any():
+            break
+
+        step = (best_cost - bound if best is not None else w.mean()) / (overuse @ overuse)
+        prices = np.maximum(prices + step * overuse, 0)
+
+    if best is None:
+        return None, bound
+
+    return [list(zip(i[chosen].tolist(), j[chosen].tolist())) for chosen in best], bound
+
+
+def find_round_pairings(ratings: np.ndarray, degrees: np.ndarray, allowed: Callable[[int, int], bool], k: int = DEFAULT_K, solver: str = None, weight: Callable[[np.ndarray, np.ndarray], np.ndarray] = None) -> Tuple[Optional[List[Matching]], float]:
+    """Pairs the players of several rounds such that no two players meet twice and the total
+    rating difference over all rounds is small, see pair_rounds. The candidate graph is built once
+    and shared by all rounds; it is widened like in find_pairings until all rounds can be paired
+    or all players are connected.
+
+    Args:
+        ratings (np.ndarray): The rating of each player.
+        degrees (np.ndarray): The number of games of each player in each round, 0 for players
+            who sit a round out and 2 for a player paired twice, shape (rounds, players).
+        allowed (Callable[[int, int], bool]): Whether two players (by index) may be paired.
+        k (int, optional): The initial number of neighbours by rating on either side. Defaults to DEFAULT_K.
+        solver (str, optional): One of SOLVERS. Defaults to the fastest one installed.
+        weight (Callable[[np.ndarray, np.ndarray], np.ndarray], optional): See find_pairings.
+
+    Returns:
+        Tuple[Optional[List[Matching]], float]: The pairs of player indices of each round, or
+        None if there is no way to pair the rounds, and a lower bound on the total rating difference.
+    """
+    ratings = np.asarray(ratings, dtype=float)
+    degrees = np.asarray(degrees, dtype=int)
+    n = len(ratings)
+
+    while True:
+        i, j = candidate_edges(ratings, k)
+        mask = np.fromiter((allowed(a, b) for a, b in zip(i.tolist(), j.tolist())), dtype=bool, count=len(i))
+        i, j = i[mask], j[mask]
+
+        count('pairings.graph_edges', len(i))
+
+        with span('pairings.joint_matching'):
+            matchings, bound = pair_rounds(degrees, i, j, np.abs(ratings[i] - ratings[j]) if weight is None else weight(i, j), solver)
+
+        if matchings is not None or k >= n - 1:
+            return matchings, bound
+
+        count('pairings.widenings')
+        k *= 2
@@ -1,14 +1,26 @@
-import networkx as nx
+import argparse
+import csv
+import io
+import json
+import sys
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 
 from enum import Enum
-from typing import List, Dict, Set
+from typing import TYPE_CHECKING, Any, Callable, List, Dict, Optional, Set, Tuple, Union
 from itertools import combinations
 from functools import total_ordering
 
 from apis import init_lichess_api, init_gspread_api
-from gspread_utils import download_as_dataframe, upload_dataframe
+from gspread_utils import download_as_dataframes, upload_dataframe
+from game_history import GameHistoryIndex
+from instrumentation import add_report_args, count, run_report, span, timed
+from pairing_engine import DEFAULT_K, find_pairings, find_round_pairings
+from snapshot import load_snapshots
+
+# networkx and matplotlib are only loaded to plot or for the reference implementation.
+if TYPE_CHECKING:
+    import networkx as nx
 
 
 @total_ordering
@@ -24,66 +36,158 @@ class ColorPref(Enum):
         return NotImplemented
 
 
-def get_active_pairings(df: pd.DataFrame, players) -> Set[Set[str]]:
-    """_summary_
+# How the colors of a pairing are decided, see PairingPolicy.
+COLOR_RULES = ['rematch', 'preference']
+
+# The options of a PairingPolicy and how they are parsed, see PairingPolicy.parse.
+POLICY_OPTIONS = {'recent': int, 'gap_exponent': float, 'rematch_penalty': float, 'color_rule': str}
+
+
+class PairingPolicy:
+    """The rules the pairings follow: which recent opponents are ruled out, what a pairing costs
+    and who plays white. The defaults are the rules the league uses, simulate.py compares others
+    against them.
+    """
+
+    def __init__(self, name: str = 'default', recent: int = 5, gap_exponent: float = 1, rematch_penalty: float = 0, color_rule: str = 'rematch'):
+        """Creates the policy.
+
+        Args:
+            name (str, optional): The name the policy is reported under. Defaults to 'default'.
+            recent (int, optional): Two players aren't paired if each of them is among the last
+                `recent` opponents of the other. Defaults to 5.
+            gap_exponent (float, optional): A pairing costs the rating difference to this power,
+                above 1 a single large gap costs more than several small ones. Defaults to 1.
+            rematch_penalty (float, optional): Added to the cost of pairing two players who have
+                met before. Defaults to 0.
+            color_rule (str, optional): One of COLOR_RULES. With 'rematch' players who met before
+                swap colors and otherwise the color preferences decide, with 'preference' the color
+                preferences decide and players who met before only swap colors if their preferences
+                are the same. Defaults to 'rematch'.
+        """
+        if color_rule not in COLOR_RULES:
+            raise ValueError(f"'{color_rule}' is not one of {', '.join(COLOR_RULES)}")
+
+        self.name = name
+        self.recent = recent
+        self.gap_exponent = gap_exponent
+        self.rematch_penalty = rematch_penalty
+        self.color_rule = color_rule
+
+    @classmethod
+    def parse(cls, spec: str) -> 'PairingPolicy':
+        """Parses a policy like 'wide:recent=8,gap_exponent=2'. Options that aren't given keep
+        their defaults.
+
+        Args:
+            spec (str): The name of the policy, optionally followed by a colon and comma-separated
+                options, see POLICY_OPTIONS.
+
+        Returns:
+            PairingPolicy: The policy.
+        """
+        name, _, options = spec.partition(':')
+        kwargs = dict()
+
+        for option in filter(None, options.split(',')):
+            key, _, value = option.partition('=')
+            key = key.strip().replace('-', '_')
+
+            if key not in POLICY_OPTIONS:
+                raise ValueError(f"Unknown policy option '{key}', expected one of {', '.join(POLICY_OPTIONS)}")
+
+            kwargs[key] = POLICY_OPTIONS[key](value.strip())
+
+        return cls(name.strip() or 'default', **kwargs)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'name': self.name, **{option: getattr(self, option) for option in POLICY_OPTIONS}}
+
+    def edge_weights(self, pairing_players: List[str], rtgs: Dict[str, float], history: GameHistoryIndex) -> Optional[Callable[[np.ndarray, np.ndarray], np.ndarray]]:
+        """Builds the cost of the pairings, see pairing_engine.find_pairings.
+
+        Args:
+            pairing_players (List[str]): The players the indices refer to.
+            rtgs (Dict[str, float]): The player's ratings.
+            history (GameHistoryIndex): Index over the games played so far.
+
+        Returns:
+            Optional[Callable[[np.ndarray, np.ndarray], np.ndarray]]: The cost of the pairings
+            between the players in two arrays of indices, or None for the rating difference.
+        """
+        if self.gap_exponent == 1 and self.rematch_penalty == 0:
+            return None
+
+        ratings = np.array([rtgs[player] for player in pairing_players], dtype=float)
+
+        def weight(i: np.ndarray, j: np.ndarray) -> np.ndarray:
+            w = np.abs(ratings[i] - ratings[j]) ** self.gap_exponent
+
+            if self.rematch_penalty != 0:
+                met = np.fromiter((history.recent_game(pairing_players[a], pairing_players[b]) is not None for a, b in zip(i.tolist(), j.tolist())), dtype=bool, count=len(i))
+                w = w + self.rematch_penalty * met
+
+            return w
+
+        return weight
+
+
+DEFAULT_POLICY = PairingPolicy()
+
+
+def get_active_pairings(df: pd.DataFrame, players, history: GameHistoryIndex = None) -> Set[Set[str]]:
+    """Collects the games of the given players that haven't finished yet.
 
     Args:
-        df (pd.DataFrame): _description_
-        players (_type_): _description_
+        df (pd.DataFrame): The games dataframe.
+        players (_type_): The players to get the active games for.
+        history (GameHistoryIndex, optional): Index over the games in df, built from df if not
+            given. Pass it when calling this more than once. Defaults to None.
 
     Returns:
-        Set[Set[str]]: _description_
+        Set[Set[str]]: The white and black player of each active game.
     """
-    df_filtered = df[(df['White'].isin(players) | df['Black'].isin(players))]
-    df_filtered = df_filtered[df_filtered['Results'].isin({'game', None, ''})]
-
-    active_games = {(row['White'], row['Black']) for _, row in df_filtered.iterrows()}
+    if history is None:
+        history = GameHistoryIndex(df)
 
-    return active_games
+    return history.active_games(players)
 
 
-def get_k_recent_opponents(df: pd.DataFrame, players, k=5) -> Dict[str, List[str]]:
+def get_k_recent_opponents(df: pd.DataFrame, players, k=5, history: GameHistoryIndex = None) -> Dict[str, List[str]]:
     """Extracts the recent k opponents for each players from the spreadsheet.
 
     Args:
-        spreadsheet (_type_): The speadsheet to load the data from.
+        df (pd.DataFrame): The games dataframe.
         players (_type_): The list of players to get the data for.
         k (int, optional): The number of recent games to consider. Defaults to 5. 
+        history (GameHistoryIndex, optional): Index over the games in df, built from df if not
+            given. Pass it when calling this more than once. Defaults to None.
 
     Returns:
         Dict[str, List[str]]: Returns a dict containing the list of recent players for each
         player.
     """
-    df_filtered = df[(df['White'].isin(players) | df['Black'].isin(players))]
-    df_sorted = df_filtered.sort_values(by='Round', ascending=False)
+    if history is None:
+        history = GameHistoryIndex(df)
 
-    recent_opps = dict()
+    return {player: history.recent_opponents(player, k) for player in players}
 
-    for player in players:
-        df_recent = df_sorted[(df_sorted['White'] == player) | (df_sorted['Black'] == player)]
-        recent_opps[player] = []
 
-        for i in range(min(k, len(df_recent))):
-            if df_recent['White'].iloc[i] == player:
-                recent_opps[player] = recent_opps.get(player, []) + [df_recent['Black'].iloc[i]]
-            else:
-                recent_opps[player] = recent_opps.get(player, []) + [df_recent['White'].iloc[i]]
+def get_recent_game(df, player_a, player_b, history: GameHistoryIndex = None):
+    # Building the index reads all games, pass it when looking up more than one pair.
+    if history is None:
+        history = GameHistoryIndex(df)
 
-    return recent_opps
+    return history.recent_game(player_a, player_b)
 
 
-def get_recent_game(df, player_a, player_b):
-    players = { player_a, player_b }
-    df_filtered = df[(df['White'].isin(players) & df['Black'].isin(players))]
-    df_sorted = df_filtered.sort_values(by='Start_Date', ascending=False)
-
-    if len(df_sorted) == 0:
-        return None
-    
-    return df_sorted['White'].iloc[0], df_sorted['Black'].iloc[0]
+ODD_PLAYER_RULES = ['lowest-rated', 'highest-rated', 'fewest-games']
 
 
 def plot_pairings_graph(G, pairing_players=None):
+    import matplotlib.pyplot as plt
+    import networkx as nx
+
     # Create a mapping of indices to player names if provided
     if pairing_players:
         node_labels = {i: pairing_players[i] for i in G.nodes()}
@@ -105,91 +209,349 @@ def plot_pairings_graph(G, pairing_players=None):
     plt.show()
 
 
-def generate_pairings(df: pd.DataFrame, players: List[str], rtgs: Dict[str, float], col_pref: Dict[str, ColorPref], verbose: bool = True, exclude_pairings: set = None):
-    """Generates pairings for the given players based on their ratings, recent opponents and color
-    preferences. It constraints the potential pairings to not include pairings that have recently
-    occured. With odd numbers, one player will receive a 2nd pairing.
+def build_pairing_graph(pairing_players: List[str], rtgs: Dict[str, float], allowed: Callable[[int, int], bool], weight: Callable[[np.ndarray, np.ndarray], np.ndarray] = None) -> 'nx.Graph':
+    """Builds the complete candidate graph used by the reference implementation.
+
+    Args:
+        pairing_players (List[str]): The players to pair, a player paired twice appears twice.
+        rtgs (Dict[str, float]): The player's ratings.
+        allowed (Callable[[int, int], bool]): Whether two players (by index) may be paired.
+        weight (Callable[[np.ndarray, np.ndarray], np.ndarray], optional): The cost of the edges,
+            see PairingPolicy.edge_weights. Defaults to the rating difference.
+
+    Returns:
+        nx.Graph: The graph with a node per index in pairing_players, weighted by rating difference.
+    """
+    import networkx as nx
+
+    G = nx.Graph()
+    G.add_nodes_from(range(len(pairing_players)))  # Use indices instead of player names
+
+    # Connect two players with an edge iff they may be paired.
+    pairs = [(i, j) for i, j in combinations(range(len(pairing_players)), 2) if allowed(i, j)]
+
+    if weight is None:
+        weights = [abs(rtgs[pairing_players[i]] - rtgs[pairing_players[j]]) for i, j in pairs]
+    else:
+        weights = weight(np.array([i for i, _ in pairs], dtype=int), np.array([j for _, j in pairs], dtype=int)).tolist()
+
+    G.add_weighted_edges_from((i, j, w) for (i, j), w in zip(pairs, weights))
+
+    return G
+
+
+def select_odd_player(players: List[str], rtgs: Dict[str, float], history: GameHistoryIndex, rule: str = 'lowest-rated') -> str:
+    """Selects the player who receives a 2nd pairing when the number of players is odd.
 
     Args:
         players (List[str]): The players to pair.
         rtgs (Dict[str, float]): The player's ratings.
-        cols_pref (Dict[str, int]): The color preference for each player.
-        verbose (bool): Whether to print debug info and show graph. Defaults to True.
-        exclude_pairings (set): Set of tuples representing pairings to exclude (e.g., from previous round).
+        history (GameHistoryIndex): Index over the games played so far.
+        rule (str, optional): The name of a player or one of ODD_PLAYER_RULES. Defaults to 'lowest-rated'.
+
+    Returns:
+        str: The player to pair twice.
+    """
+    if rule in players:
+        return rule
+
+    # Ties are broken by name, so the choice doesn't depend on the order of the players.
+    if rule == 'lowest-rated':
+        return min(players, key=lambda p: (rtgs[p], p))
+    if rule == 'highest-rated':
+        return max(players, key=lambda p: (rtgs[p], p))
+    if rule == 'fewest-games':
+        return min(players, key=lambda p: (history.game_count(p), rtgs[p], p))
+
+    raise ValueError(f"'{rule}' is neither a player nor one of {', '.join(ODD_PLAYER_RULES)}")
+
+
+def round_rule(odd_player: Union[str, List[str]], round: int) -> str:
+    """Looks up who receives a 2nd pairing in a round, see generate_rounds."""
+    return odd_player if isinstance(odd_player, str) else odd_player[round]
+
+
+def prompt_odd_player(players: List[str], verbose: bool = True) -> str:
+    """Asks on the command line which player receives a 2nd pairing.
+
+    Args:
+        players (List[str]): The players to pair.
+        verbose (bool): Whether to print the available players. Defaults to True.
+
+    Returns:
+        str: The player to pair twice.
+    """
+    if verbose:
+        print(f"\nOdd number of players ({len(players)}). One player will receive a 2nd pairing.")
+        print(f"Available players: {', '.join(players)}")
+    
+    while True:
+        player_input = input(f"Enter the username of the player who should receive a 2nd pairing: ").lower()
+        if player_input in players:
+            if verbose:
+                print(f"{player_input} will receive a 2nd pairing\n")
+            return player_input
+        else:
+            print(f"Player '{player_input}' not found. Please enter a valid username.")
+
+
+def pair_players(history: GameHistoryIndex, players: List[str], rtgs: Dict[str, float], exclude_pairings: set = None, double_pairing_player: str = None, solver: str = None, k: int = DEFAULT_K, graph: bool = True, policy: PairingPolicy = None) -> Tuple[List[Tuple[str, str]], 'nx.Graph', List[str]]:
+    """Pairs the given players based on their ratings and recent opponents. It constraints the
+    potential pairings to not include pairings that have recently occured.
+
+    Args:
+        history (GameHistoryIndex): Index over the games played so far.
+        players (List[str]): The players to pair.
+        rtgs (Dict[str, float]): The player's ratings.
+        exclude_pairings (set): Set of frozensets representing pairings to exclude (e.g., from previous round).
+        double_pairing_player (str): The player who is paired twice, required for odd numbers of players.
+        solver (str): 'reference' for the networkx matching on the complete graph, otherwise one
+            of pairing_engine.SOLVERS used on a graph of players close in rating. Defaults to the
+            fastest solver installed.
+        k (int): The initial number of neighbours by rating each player is connected to on either
+            side, unless the reference solver is used. The pairing is the best among these, see
+            find_pairings. Defaults to DEFAULT_K.
+        graph (bool): Whether to return the candidate graph, which loads networkx. Defaults to True.
+        policy (PairingPolicy): Which recent opponents are ruled out and what a pairing costs.
+            Defaults to DEFAULT_POLICY.
+
+    Returns:
+        Tuple[List[Tuple[str, str]], nx.Graph, List[str]]: The pairs of players (without colors),
+        the candidate graph (None if not requested) and the players the graph's node indices refer to.
     """
     if exclude_pairings is None:
         exclude_pairings = set()
-    
+
+    policy = policy or DEFAULT_POLICY
     pairing_players = players.copy()
-    double_pairing_player = None
-    
-    # Handle odd number of players
-    if len(players) % 2 != 0:
-        if verbose:
-            print(f"\nOdd number of players ({len(players)}). One player will receive a 2nd pairing.")
-            print(f"Available players: {', '.join(players)}")
-        
-        while True:
-            player_input = input(f"Enter the username of the player who should receive a 2nd pairing: ").lower()
-            if player_input in players:
-                double_pairing_player = player_input
-                # Add the player twice to the list so they get paired twice
-                pairing_players.append(double_pairing_player)
-                if verbose:
-                    print(f"{double_pairing_player} will receive a 2nd pairing\n")
-                break
-            else:
-                print(f"Player '{player_input}' not found. Please enter a valid username.")
-    
-    assert len(pairing_players) % 2 == 0, "Number of pairing players must be even!"
 
-    recent_k_opps = get_k_recent_opponents(df, players)
-    if verbose:
-        print(recent_k_opps)
+    if len(players) % 2 != 0:
+        if double_pairing_player not in players:
+            raise ValueError('An odd number of players needs a player who receives a 2nd pairing')
 
-    active_games = get_active_pairings(df, players)
-    if verbose:
-        print(active_games)
+        # Add the player twice to the list so they get paired twice
+        pairing_players.append(double_pairing_player)
 
-    G = nx.Graph()
-    G.add_nodes_from(range(len(pairing_players)))  # Use indices instead of player names
+    recent_k_opps = {player: history.recent_opponents(player, policy.recent) for player in players}
+    weight = policy.edge_weights(pairing_players, rtgs, history)
 
-    # Connect two players with an edge iff they don't prefer the same color and haven't been matched recently.
-    for i, j in combinations(range(len(pairing_players)), 2):
+    def allowed(i, j):
         a = pairing_players[i]
         b = pairing_players[j]
         
         # Prevent a player from being paired with themselves (if they have 2 slots)
         if a == b:
-            continue
+            return False
         
         # Prevent pairings that should be excluded (e.g., from previous round)
         pairing = frozenset([a, b])
         if pairing in exclude_pairings:
-            continue
+            return False
             
-        if b not in recent_k_opps[a] or a not in recent_k_opps[b]:
-            G.add_edge(i, j, weight=abs(rtgs[a]-rtgs[b]))
+        return b not in recent_k_opps[a] or a not in recent_k_opps[b]
+
+    pairings_indices, G = None, None
+    if solver != 'reference':
+        ratings = [rtgs[player] for player in pairing_players]
+        pairings_indices, (edges_i, edges_j, weights) = find_pairings(ratings, allowed, k, solver, weight)
+
+        if graph:
+            import networkx as nx
+
+            G = nx.Graph()
+            G.add_nodes_from(range(len(pairing_players)))
+            G.add_weighted_edges_from(zip(edges_i.tolist(), edges_j.tolist(), weights.tolist()))
 
-    # Compute the pairings with a min weight matching on the created graph.
-    pairings_indices = nx.algorithms.matching.min_weight_matching(G)
+    # Without a way to pair everyone, fall back to the reference implementation which pairs as
+    # many players as possible.
+    if pairings_indices is None:
+        import networkx as nx
+
+        G = build_pairing_graph(pairing_players, rtgs, allowed, weight)
+        count('pairings.graph_edges', G.number_of_edges())
+
+        # Compute the pairings with a min weight matching on the created graph.
+        with span('pairings.matching'):
+            pairings_indices = nx.algorithms.matching.min_weight_matching(G)
     
     # Convert indices back to player names
     pairings = [(pairing_players[i], pairing_players[j]) for i, j in pairings_indices]
 
-    # pretty print the pairings.
+    return pairings, G, pairing_players
+
+
+def assign_colors(pairings: List[Tuple[str, str]], history: GameHistoryIndex, col_pref: Dict[str, ColorPref], policy: PairingPolicy = None) -> List[Tuple[str, str]]:
+    """Decides who plays white in each pairing. Players who met before swap colors, otherwise the
+    color preferences decide, unless the policy's color rule says otherwise.
+
+    Args:
+        pairings (List[Tuple[str, str]]): The pairs of players.
+        history (GameHistoryIndex): Index over the games played so far.
+        col_pref (Dict[str, ColorPref]): The color preference for each player.
+        policy (PairingPolicy, optional): See PairingPolicy.color_rule. Defaults to DEFAULT_POLICY.
+
+    Returns:
+        List[Tuple[str, str]]: The white and black player of each pairing.
+    """
+    color_rule = (policy or DEFAULT_POLICY).color_rule
+    games = []
+
     for a, b in pairings:
-        recent_game = get_recent_game(df, a, b)
+        recent_game = history.recent_game(a, b)
 
-        if recent_game != None:
+        if recent_game != None and (color_rule == 'rematch' or col_pref[a] == col_pref[b]):
             if recent_game[0] == a:
-                print(f'@{ b } vs @{ a }')
+                games.append((b, a))
             else:
-                print(f'@{ a } vs @{ b }')
+                games.append((a, b))
         elif col_pref[a] <= col_pref[b]:
-            print(f'@{ a } vs @{ b }')
+            games.append((a, b))
         else:
-            print(f'@{ b } vs @{ a }')
+            games.append((b, a))
+
+    return games
+
+
+def generate_rounds(history: GameHistoryIndex, players: List[str], rtgs: Dict[str, float], col_pref: Dict[str, ColorPref], rounds: int = 1, odd_player: Union[str, List[str]] = 'lowest-rated', excluded_players: Dict[int, Set[str]] = None, solver: str = None, k: int = DEFAULT_K, policy: PairingPolicy = None) -> List[List[Tuple[str, str]]]:
+    """Generates the pairings of one or more rounds without any interaction. Each round avoids the
+    pairings of the rounds before it.
+
+    Args:
+        history (GameHistoryIndex): Index over the games played so far.
+        players (List[str]): The players to pair.
+        rtgs (Dict[str, float]): The player's ratings.
+        col_pref (Dict[str, ColorPref]): The color preference for each player.
+        rounds (int, optional): The number of rounds. Defaults to 1.
+        odd_player (Union[str, List[str]], optional): Who receives a 2nd pairing in rounds with an
+            odd number of players, a player's name or one of ODD_PLAYER_RULES, or a list with one
+            of these for each round. Defaults to 'lowest-rated'.
+        excluded_players (Dict[int, Set[str]], optional): The players to leave out of each round,
+            by round index starting at 0. Defaults to None.
+        solver (str, optional): See pair_players.
+        k (int, optional): See pair_players.
+        policy (PairingPolicy, optional): See pair_players and assign_colors.
+
+    Returns:
+        List[List[Tuple[str, str]]]: The white and black player of each game, for each round.
+    """
+    excluded_players = excluded_players or dict()
+    exclude_pairings = set()
+    games = []
+
+    for round in range(rounds):
+        round_players = [p for p in players if p not in excluded_players.get(round, set())]
+
+        double_pairing_player = None
+        if len(round_players) % 2 != 0:
+            double_pairing_player = select_odd_player(round_players, rtgs, history, round_rule(odd_player, round))
+
+        pairings, _, _ = pair_players(history, round_players, rtgs, exclude_pairings, double_pairing_player, solver, k, graph=False, policy=policy)
+        games.append(assign_colors(pairings, history, col_pref, policy))
+
+        # Convert pairings to a set of frozensets for comparison (order doesn't matter)
+        exclude_pairings |= {frozenset([a, b]) for a, b in pairings}
+
+    return games
+
+
+def generate_joint_rounds(history: GameHistoryIndex, players: List[str], rtgs: Dict[str, float], col_pref: Dict[str, ColorPref], rounds: int = 2, odd_player: Union[str, List[str]] = 'lowest-rated', excluded_players: Dict[int, Set[str]] = None, solver: str = None, k: int = DEFAULT_K, policy: PairingPolicy = None) -> List[List[Tuple[str, str]]]:
+    """Generates the pairings of several rounds in one optimization, such that no two players meet
+    twice and the total rating difference over all rounds is small. Unlike generate_rounds, an
+    early round doesn't take the opponents a later round needs. The candidate graph and the
+    recent opponents are computed once for all rounds. Falls back to generate_rounds if the
+    rounds can't be paired jointly.
+
+    Args:
+        history (GameHistoryIndex): Index over the games played so far.
+        players (List[str]): The players to pair.
+        rtgs (Dict[str, float]): The player's ratings.
+        col_pref (Dict[str, ColorPref]): The color preference for each player.
+        rounds (int, optional): The number of rounds. Defaults to 2.
+        odd_player (Union[str, List[str]], optional): See generate_rounds.
+        excluded_players (Dict[int, Set[str]], optional): See generate_rounds.
+        solver (str, optional): One of pairing_engine.SOLVERS. Defaults to the fastest one installed.
+        k (int, optional): See pair_players.
+        policy (PairingPolicy, optional): See generate_rounds.
+
+    Returns:
+        List[List[Tuple[str, str]]]: The white and black player of each game, for each round.
+    """
+    excluded_players = excluded_players or dict()
+    policy = policy or DEFAULT_POLICY
+    index = {player: i for i, player in enumerate(players)}
+
+    # The number of games of each player in each round.
+    degrees = [[0] * len(players) for _ in range(rounds)]
+    for round in range(rounds):
+        round_players = [p for p in players if p not in excluded_players.get(round, set())]
+
+        for player in round_players:
+            degrees[round][index[player]] = 1
+
+        if len(round_players) % 2 != 0:
+            degrees[round][index[select_odd_player(round_players, rtgs, history, round_rule(odd_player, round))]] = 2
+
+    recent_k_opps = {player: history.recent_opponents(player, policy.recent) for player in players}
+
+    def allowed(i, j):
+        a = players[i]
+        b = players[j]
+        return b not in recent_k_opps[a] or a not in recent_k_opps[b]
+
+    matchings, _ = find_round_pairings([rtgs[player] for player in players], degrees, allowed, k, solver, policy.edge_weights(players, rtgs, history))
+
+    if matchings is None:
+        return generate_rounds(history, players, rtgs, col_pref, rounds, odd_player, excluded_players, solver=solver, k=k, policy=policy)
+
+    return [assign_colors([(players[i], players[j]) for i, j in matching], history, col_pref, policy) for matching in matchings]
+
+
+def rating_gap(games: List[List[Tuple[str, str]]], rtgs: Dict[str, float]) -> float:
+    """Sums up the rating differences of all games, the cost the pairings minimize.
+
+    Args:
+        games (List[List[Tuple[str, str]]]): The white and black player of each game, for each round.
+        rtgs (Dict[str, float]): The player's ratings.
+
+    Returns:
+        float: The total rating difference.
+    """
+    return sum(abs(rtgs[white] - rtgs[black]) for round_games in games for white, black in round_games)
+
+
+def generate_pairings(df: pd.DataFrame, players: List[str], rtgs: Dict[str, float], col_pref: Dict[str, ColorPref], verbose: bool = True, exclude_pairings: set = None, history: GameHistoryIndex = None, solver: str = None, k: int = DEFAULT_K, double_pairing_player: str = None):
+    """Generates pairings for the given players based on their ratings, recent opponents and color
+    preferences and prints them. It constraints the potential pairings to not include pairings
+    that have recently occured. With odd numbers, one player will receive a 2nd pairing, asked for
+    on the command line unless given.
+
+    Args:
+        players (List[str]): The players to pair.
+        rtgs (Dict[str, float]): The player's ratings.
+        cols_pref (Dict[str, int]): The color preference for each player.
+        verbose (bool): Whether to print debug info and show graph. Defaults to True.
+        exclude_pairings (set): Set of tuples representing pairings to exclude (e.g., from previous round).
+        history (GameHistoryIndex): Index over the games in df, built from df if not given.
+        solver (str): See pair_players.
+        k (int): See pair_players.
+        double_pairing_player (str): The player who receives a 2nd pairing with odd numbers.
+    """
+    if history is None:
+        history = GameHistoryIndex(df)
+    
+    # Handle odd number of players
+    if len(players) % 2 != 0 and double_pairing_player is None:
+        double_pairing_player = prompt_odd_player(players, verbose)
+
+    if verbose:
+        print({player: history.recent_opponents(player) for player in players})
+        print(history.active_games(players))
+
+    pairings, G, pairing_players = pair_players(history, players, rtgs, exclude_pairings, double_pairing_player, solver, k, graph=verbose)
+
+    # pretty print the pairings.
+    for white, black in assign_colors(pairings, history, col_pref):
+        print(f'@{ white } vs @{ black }')
 
     if verbose:
         plot_pairings_graph(G, pairing_players)
@@ -197,25 +559,26 @@ def generate_pairings(df: pd.DataFrame, players: List[str], rtgs: Dict[str, floa
     return pairings
 
 
-def generate_double_round_pairings(df: pd.DataFrame, players: List[str], rtgs: Dict[str, float], col_pref: Dict[str, ColorPref]):
-    """Generates pairings for a double round, with round 2 avoiding round 1 pairings.
+def generate_double_round_pairings(df: pd.DataFrame, players: List[str], rtgs: Dict[str, float], col_pref: Dict[str, ColorPref], joint: bool = False, history: GameHistoryIndex = None):
+    """Generates pairings for a double round, with round 2 avoiding round 1 pairings, and prints
+    them. Round 1 is paired first and round 2 gets what is left, unless joint is True, in which
+    case both rounds are also paired in one optimization and the cheaper pairings are kept. That
+    can lower the total rating gap, but the joint optimization takes a few seconds where pairing
+    round by round takes a fraction of one, like --joint of the script.
 
     Args:
         df (pd.DataFrame): The games dataframe.
         players (List[str]): The players to pair.
         rtgs (Dict[str, float]): The player's ratings.
         col_pref (Dict[str, ColorPref]): The color preference for each player.
+        joint (bool): Whether to also pair both rounds in one optimization. Defaults to False.
+        history (GameHistoryIndex): Index over the games in df, built from df if not given.
     """
-    print("=" * 50)
-    print("ROUND 1")
-    print("=" * 50)
-    pairings_round1 = generate_pairings(df, players, rtgs, col_pref, verbose=False)
-    
-    # Convert pairings to a set of frozensets for comparison (order doesn't matter)
-    exclude_pairings = {frozenset([a, b]) for a, b in pairings_round1}
-    
+    if history is None:
+        history = GameHistoryIndex(df)
+
     # Ask user to exclude players from Round 2
-    print("\n" + "=" * 50)
+    print("=" * 50)
     print("ROUND 2 - PLAYER EXCLUSIONS")
     print("=" * 50)
     exclusion_input = input("Enter comma-separated list of players to exclude from Round 2 (or press Enter to include all): ").strip()
@@ -225,39 +588,170 @@ def generate_double_round_pairings(df: pd.DataFrame, players: List[str], rtgs: D
         excluded_players = {p.strip().lower() for p in exclusion_input.split(',')}
     
     players_for_round2 = [p for p in players if p not in excluded_players]
-    
-    print("\n" + "=" * 50)
-    print("ROUND 2")
-    print("=" * 50)
-    pairings_round2 = generate_pairings(df, players_for_round2, rtgs, col_pref, verbose=False, exclude_pairings=exclude_pairings)
 
+    # Ask for the players who receive a 2nd pairing in rounds with an odd number of players.
+    odd_player = [prompt_odd_player(round_players) if len(round_players) % 2 != 0 else ODD_PLAYER_RULES[0] for round_players in (players, players_for_round2)]
 
-if __name__ == '__main__':
-    spreadsheet = init_gspread_api()
+    sequential = generate_rounds(history, players, rtgs, col_pref, 2, odd_player, {1: excluded_players})
+    games = sequential
+    if joint:
+        # Keep the round by round pairings in the rare case they are cheaper, see pairing_engine.pair_rounds.
+        games = min(generate_joint_rounds(history, players, rtgs, col_pref, 2, odd_player, {1: excluded_players}), sequential, key=lambda games: rating_gap(games, rtgs))
+
+    print(format_rounds(games))
+
+    if joint:
+        print(f"\nTotal rating gap: {rating_gap(games, rtgs):.0f} (round by round: {rating_gap(sequential, rtgs):.0f})")
+
+
+def format_rounds(games: List[List[Tuple[str, str]]], fmt: str = 'text') -> str:
+    """Formats the games of one or more rounds.
+
+    Args:
+        games (List[List[Tuple[str, str]]]): The white and black player of each game, for each round.
+        fmt (str, optional): 'text' for the '@white vs @black' lines posted to the players,
+            'json' or 'csv'. Defaults to 'text'.
+
+    Returns:
+        str: The formatted pairings.
+    """
+    if fmt == 'json':
+        return json.dumps({'rounds': [[{'white': white, 'black': black} for white, black in round_games] for round_games in games]}, indent=2)
+
+    if fmt == 'csv':
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(['round', 'white', 'black'])
+        writer.writerows((round + 1, white, black) for round, round_games in enumerate(games) for white, black in round_games)
+        return out.getvalue()
+
+    lines = []
+    for round, round_games in enumerate(games):
+        if len(games) > 1:
+            lines += ['=' * 50, f'ROUND {round + 1}', '=' * 50]
+        lines += [f'@{ white } vs @{ black }' for white, black in round_games]
+
+    return '\n'.join(lines)
+
+
+@timed('pairings.load_input')
+def load_pairing_input(pairing_maker: pd.DataFrame, raw_data: pd.DataFrame) -> Tuple[GameHistoryIndex, List[str], Dict[str, float], Dict[str, ColorPref]]:
+    """Reads what the pairings are based on from the downloaded sheets.
 
-    df, _ = download_as_dataframe(spreadsheet, 'Pairing_Maker', 'PairingMaker')
+    Args:
+        pairing_maker (pd.DataFrame): The PairingMaker table of the Pairing_Maker sheet.
+        raw_data (pd.DataFrame): The RawData table of the RawData sheet.
 
-    players = [player.lower() for player in df['Player']]
-    pwr_rtgs = pd.to_numeric(df['Power Score']) 
-    colors = pd.to_numeric(df['Color Score'])
+    Returns:
+        Tuple[GameHistoryIndex, List[str], Dict[str, float], Dict[str, ColorPref]]: The index
+        over the games, the players to pair, their ratings and their color preferences.
+    """
+    players = [player.lower() for player in pairing_maker['Player']]
+    pwr_rtgs = pd.to_numeric(pairing_maker['Power Score']) 
+    colors = pd.to_numeric(pairing_maker['Color Score'])
 
-    df, _ = download_as_dataframe(spreadsheet, 'RawData', 'RawData')
-    df = df.set_index(['ID'])
+    df = raw_data.set_index(['ID'])
     df['Round'] = pd.to_numeric(df['Round'])
 
-    # Uncomment the line below if a double round is needed
-    # generate_double_round_pairings(
-    #     df,
-    #     players, 
-    #     {player: rtg for player, rtg in zip(players, pwr_rtgs)}, 
-    #     {player: c for player, c in zip(players, colors)}
-    # )
-    
-    # For single round, uncomment the line below and comment out the generate_double_round_pairings call
-    generate_pairings(
-        df,
-        players, 
-        {player: rtg for player, rtg in zip(players, pwr_rtgs)}, 
-        {player: c for player, c in zip(players, colors)}
-    )
+    history = GameHistoryIndex(df)
+    rtgs = {player: rtg for player, rtg in zip(players, pwr_rtgs)}
+    col_pref = {player: c for player, c in zip(players, colors)}
+
+    return history, players, rtgs, col_pref
+
 
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Generates the pairings for the next round(s).')
+    parser.add_argument('--rounds', type=int, default=1, help='number of rounds to pair, later rounds avoid the pairings of earlier ones (default: 1)')
+    parser.add_argument('--odd-player', default='lowest-rated', help=f"who receives a 2nd pairing with an odd number of players: a username or one of {', '.join(ODD_PLAYER_RULES)} (default: lowest-rated)")
+    parser.add_argument('--exclude', action='append', default=[], metavar='ROUND:PLAYERS', help='comma-separated players to leave out of a round, e.g. 2:alice,bob; can be repeated')
+    parser.add_argument('--format', choices=['text', 'json', 'csv'], default='text', help='output format (default: text)')
+    parser.add_argument('--output', help='file to write the pairings to instead of stdout')
+    parser.add_argument('--solver', help="matching solver: 'reference' or one of the pairing_engine solvers (default: fastest installed)")
+    parser.add_argument('--k', type=int, default=DEFAULT_K, help=f'number of neighbours by rating on either side considered as opponents, only widened when they can\'t pair everyone; the pairing is the best among them, not always over all players (default: {DEFAULT_K})')
+    parser.add_argument('--policy', metavar='NAME:OPTIONS', help=f"pairing policy, e.g. wide:recent=8,gap_exponent=2 with the options {', '.join(POLICY_OPTIONS)}, see simulate.py (default: the league's policy)")
+    parser.add_argument('--joint', action='store_true', help='pair all rounds in one optimization and report its rating gap next to pairing round by round')
+    parser.add_argument('--plot', action='store_true', help='show the games of each round as a graph')
+    parser.add_argument('--offline', action='store_true', help='read PairingMaker and RawData from the local snapshot instead of the spreadsheet')
+    add_report_args(parser)
+
+    return parser.parse_args(argv)
+
+
+def parse_exclusions(values: List[str]) -> Dict[int, Set[str]]:
+    """Parses the --exclude arguments.
+
+    Args:
+        values (List[str]): Arguments like '2:alice,bob'.
+
+    Returns:
+        Dict[int, Set[str]]: The excluded players by round index starting at 0.
+    """
+    excluded_players = dict()
+
+    for value in values:
+        round, names = value.split(':', 1)
+        excluded_players.setdefault(int(round) - 1, set()).update(p.strip().lower() for p in names.split(',') if p.strip())
+
+    return excluded_players
+
+
+def main(argv: List[str] = None):
+    args = parse_args(argv)
+
+    with run_report('pairings', args.report, args.profile):
+        if args.offline:
+            pairing_maker, raw_data = load_snapshots(['PairingMaker', 'RawData'])
+        else:
+            spreadsheet = init_gspread_api()
+            (pairing_maker, _), (raw_data, _) = download_as_dataframes(spreadsheet, [('Pairing_Maker', 'PairingMaker'), ('RawData', 'RawData')])
+
+        history, players, rtgs, col_pref = load_pairing_input(pairing_maker, raw_data)
+
+        excluded_players = parse_exclusions(args.exclude)
+        odd_player = args.odd_player.lower()
+        policy = PairingPolicy.parse(args.policy) if args.policy else None
+
+        games = generate_rounds(
+            history,
+            players,
+            rtgs,
+            col_pref,
+            rounds=args.rounds,
+            odd_player=odd_player,
+            excluded_players=excluded_players,
+            solver=args.solver,
+            k=args.k,
+            policy=policy
+        )
+
+        if args.joint:
+            sequential = games
+            joint = generate_joint_rounds(history, players, rtgs, col_pref, args.rounds, odd_player, excluded_players, None if args.solver == 'reference' else args.solver, args.k, policy)
+
+            # Keep the round by round pairings in the rare case they are cheaper, see pairing_engine.pair_rounds.
+            games = min(joint, sequential, key=lambda games: rating_gap(games, rtgs))
+
+            # Report on stderr, so the output stays valid json or csv.
+            print(f"Total rating gap: {rating_gap(games, rtgs):.0f} (round by round: {rating_gap(sequential, rtgs):.0f})", file=sys.stderr)
+
+        output = format_rounds(games, args.format)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + '\n')
+        else:
+            print(output)
+
+    if args.plot:
+        import networkx as nx
+
+        for round_games in games:
+            round_players = sorted({p for game in round_games for p in game})
+            G = nx.Graph()
+            G.add_nodes_from(range(len(round_players)))
+            G.add_weighted_edges_from((round_players.index(w), round_players.index(b), abs(rtgs[w] - rtgs[b])) for w, b in round_games)
+            plot_pairings_graph(G, round_players)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,43 +1,339 @@
-from apis import init_lichess_api, init_gspread_api
-from awards import compute_compensation
-from gspread_utils import download_as_dataframe, upload_dataframe
+import argparse
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
 
+from collections import deque
+from typing import Any, Dict, List, Tuple
 
-scores = {
-    0:      -800,
-    0.5:    -366,
-    1:      -240,
-    1.5:    -149,
-    2:	    -72,
-    2.5:    0,
-    3:      72,
-    3.5:    149,
-    4:      240,
-    4.5:    366,
-    5:      800
-}
+from apis import init_gspread_api
+from gspread_utils import download_as_dataframe
+from instrumentation import add_report_args, count, run_report, span
+from snapshot import load_snapshot
 
 
-def compute_perf_rating(avg_opp_rtg: float, score: float) -> float:
-    """Computes the performance rating for five games.
+PERF_CHECKPOINT_PATH = 'data/perf_rtg.json'
+
+# The rating difference for a percentage score from the FIDE handbook (B.02.1.48), from a score of
+# 100% down to 51%. A score of 50% is a difference of 0 and scores below 50% are the negative of
+# the difference for 100% minus the score.
+FIDE_DP = [
+    800, 677, 589, 538, 501, 470, 444, 422, 401, 383,
+    366, 351, 336, 322, 309, 296, 284, 273, 262, 251,
+    240, 230, 220, 211, 202, 193, 184, 175, 166, 158,
+    149, 141, 133, 125, 117, 110, 102, 95, 87, 80,
+    72, 65, 57, 50, 43, 36, 29, 21, 14, 7,
+]
+
+DP_PERCENTAGES = np.arange(101)
+DP_VALUES = np.array([-dp for dp in FIDE_DP] + [0] + FIDE_DP[::-1], dtype=float)
+
+RESULT_SCORES = {'1 - 0': 1, '0 - 1': 0, '1/2 - 1/2': 0.5}
+
+
+def ratings_hash(initial_ratings: Dict[str, float] = None) -> str:
+    """Hashes the initial ratings, so a timeline can tell if it was built from other ones.
+
+    Args:
+        initial_ratings (Dict[str, float], optional): The ratings of players before their first
+            game. Defaults to None.
+
+    Returns:
+        str: The hash.
+    """
+    return hashlib.sha256(json.dumps(initial_ratings or {}, sort_keys=True).encode()).hexdigest()
+
+
+def rating_difference(p: float) -> float:
+    """Looks up the rating difference for a percentage score, interpolating between the entries of
+    the FIDE table, so that it works for any number of games.
+
+    Args:
+        p (float): The score as a fraction of the games played.
+
+    Returns:
+        float: The rating difference.
+    """
+    # Rounding keeps scores like 1/10 from falling just next to the entry in the table.
+    return float(np.interp(round(100 * p, 9), DP_PERCENTAGES, DP_VALUES))
+
+
+def compute_perf_rating(avg_opp_rtg: float, score: float, games: int = 5) -> float:
+    """Computes the performance rating for a number of games.
 
     Args:
         avg_opp_rtg (float): The average rating of the opponents
         score (float): The points scored against the opposition.
+        games (int, optional): The number of games. Defaults to 5.
     Returns:
         float: Returns the performance rating.
     """
-    return avg_opp_rtg + scores[score]
+    return avg_opp_rtg + rating_difference(score / games)
+
+
+class PerformanceTimeline:
+    """The performance rating of each player over time. Every player's rating is their performance
+    over their last `window` finished games, where each opponent is rated with their own
+    performance rating at the time the game finished. Games are added in the order they finished,
+    so each game only updates the two players involved.
+    """
+
+    def __init__(self, window: int = 5, initial_ratings: Dict[str, float] = None, default_rating: float = 1500):
+        """Creates an empty timeline.
+
+        Args:
+            window (int, optional): The number of recent games a rating is based on. Defaults to 5.
+            initial_ratings (Dict[str, float], optional): The ratings of players before their first
+                game. Defaults to None.
+            default_rating (float, optional): The rating of other players before their first game.
+                Defaults to 1500.
+        """
+        self.window = window
+        self.default_rating = default_rating
+        self.ratings: Dict[str, float] = dict(initial_ratings or {})
+        self.initial_ratings_hash = ratings_hash(initial_ratings)
+
+        # The opponent's rating and the score of a player's recent games, with their sums.
+        self.games: Dict[str, deque] = dict()
+        self.sums: Dict[str, List[float]] = dict()
+
+        # White's score of every game in the timeline, by id.
+        self.processed: Dict[str, float] = dict()
+        self.last_key: Tuple[int, str] = None
+        self.history: List[Dict[str, Any]] = []
+
+    def rating(self, player: str) -> float:
+        return self.ratings.get(player, self.default_rating)
+
+    def _add_result(self, player: str, opp_rtg: float, score: float):
+        games = self.games.setdefault(player, deque())
+        sums = self.sums.setdefault(player, [0, 0])
+
+        games.append((opp_rtg, score))
+        sums[0] += opp_rtg
+        sums[1] += score
+
+        # Drop the oldest game once the window is full.
+        if len(games) > self.window:
+            old_opp_rtg, old_score = games.popleft()
+            sums[0] -= old_opp_rtg
+            sums[1] -= old_score
+
+        self.ratings[player] = compute_perf_rating(sums[0] / len(games), sums[1], len(games))
+
+    def add_game(self, game_id: str, termination_date: int, white: str, black: str, white_score: float):
+        """Updates the ratings of both players with a finished game.
+
+        Args:
+            game_id (str): The id of the game.
+            termination_date (int): When the game finished (in s).
+            white (str): The white player.
+            black (str): The black player.
+            white_score (float): The points white scored.
+        """
+        white_rtg, black_rtg = self.rating(white), self.rating(black)
+
+        self._add_result(white, black_rtg, white_score)
+        self._add_result(black, white_rtg, 1 - white_score)
+
+        self.processed[game_id] = white_score
+        self.last_key = (termination_date, game_id)
+        self.history.append({
+            'ID': game_id,
+            'Termination_Date': termination_date,
+            'White': white,
+            'Black': black,
+            'white_perf': self.ratings[white],
+            'black_perf': self.ratings[black],
+        })
+
+    def extend(self, df: pd.DataFrame) -> int:
+        """Adds the finished games in RawData that aren't part of the timeline yet, in the order
+        they finished.
+
+        Args:
+            df (pd.DataFrame): The games, with the columns ID, White, Black, Results and Termination_Date.
+
+        Raises:
+            ValueError: If a game of the timeline was removed or its result changed, or a new game
+                finished before the last game of the timeline.
+
+        Returns:
+            int: The number of games added.
+        """
+        games = finished_games(df)
+
+        scores = dict(zip(games['ID'], games['Score']))
+        changed = [game_id for game_id, score in self.processed.items() if scores.get(game_id) != score]
+
+        if len(changed) > 0:
+            raise ValueError(f'Game {changed[0]} was removed or its result changed, the timeline has to be rebuilt')
+
+        games = games[~games['ID'].isin(self.processed.keys())]
+
+        added = 0
+        for game_id, date, white, black, score in zip(games['ID'], games['Termination_Date'], games['White'], games['Black'], games['Score']):
+            if self.last_key is not None and (date, game_id) < self.last_key:
+                raise ValueError(f'Game {game_id} finished before the last game of the timeline, it has to be rebuilt')
+
+            self.add_game(game_id, int(date), white, black, float(score))
+            added += 1
+
+        return added
+
+    def rankings(self) -> pd.DataFrame:
+        """Collects the current rating of every player who played a game.
+
+        Returns:
+            pd.DataFrame: The players, their rating and the number of games it is based on,
+            highest rating first.
+        """
+        rankings = pd.DataFrame({
+            'Player': list(self.games),
+            'Rating': [round(self.ratings[player]) for player in self.games],
+            'Games': [len(games) for games in self.games.values()],
+        })
+
+        return rankings.sort_values(['Rating', 'Player'], ascending=[False, True], ignore_index=True)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'window': self.window,
+            'default_rating': self.default_rating,
+            'ratings': self.ratings,
+            'games': {player: list(games) for player, games in self.games.items()},
+            'initial_ratings_hash': self.initial_ratings_hash,
+            'scores': self.processed,
+            'last_key': self.last_key,
+            'history': self.history,
+        }
+
+    @classmethod
+    def from_dict(cls, state: Dict[str, Any]) -> 'PerformanceTimeline':
+        timeline = cls(state['window'], state['ratings'], state['default_rating'])
+
+        for player, games in state['games'].items():
+            timeline.games[player] = deque(tuple(game) for game in games)
+            timeline.sums[player] = [sum(opp_rtg for opp_rtg, _ in games), sum(score for _, score in games)]
+
+        # Checkpoints without the scores or the hash are rebuilt, see compute_historical_rankings.
+        timeline.initial_ratings_hash = state.get('initial_ratings_hash')
+        timeline.processed = dict(state.get('scores', {}))
+        timeline.last_key = tuple(state['last_key']) if state['last_key'] else None
+        timeline.history = state['history']
+
+        return timeline
+
+
+def finished_games(df: pd.DataFrame) -> pd.DataFrame:
+    """Selects the finished games of RawData in the order they finished.
+
+    Args:
+        df (pd.DataFrame): The games, with the columns ID, White, Black, Results and Termination_Date.
+
+    Returns:
+        pd.DataFrame: The finished games with their Termination_Date as a number and white's Score.
+    """
+    games = df[['ID', 'White', 'Black', 'Results', 'Termination_Date']].copy()
+    games['Termination_Date'] = pd.to_numeric(games['Termination_Date'], errors='coerce')
+    games['Score'] = games['Results'].map(RESULT_SCORES)
+
+    games = games[games['Score'].notna() & games['Termination_Date'].notna() & (games['ID'] != '')]
+
+    return games.sort_values(['Termination_Date', 'ID'], kind='stable')
+
+
+def load_checkpoint(path: str = PERF_CHECKPOINT_PATH) -> PerformanceTimeline:
+    """Loads the timeline written by the previous run.
+
+    Args:
+        path (str, optional): The file to load the timeline from. Defaults to PERF_CHECKPOINT_PATH.
+
+    Returns:
+        PerformanceTimeline: The timeline, or None if there is no checkpoint.
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return PerformanceTimeline.from_dict(json.load(f))
+
+
+def save_checkpoint(timeline: PerformanceTimeline, path: str = PERF_CHECKPOINT_PATH):
+    """Writes the timeline to disk, replacing the previous checkpoint in one step.
+
+    Args:
+        timeline (PerformanceTimeline): The timeline.
+        path (str, optional): The file to write the timeline to. Defaults to PERF_CHECKPOINT_PATH.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump(timeline.to_dict(), f)
+
+    os.replace(path + '.tmp', path)
+
+
+def compute_historical_rankings(df: pd.DataFrame, window: int = 5, initial_ratings: Dict[str, float] = None, checkpoint_path: str = PERF_CHECKPOINT_PATH) -> PerformanceTimeline:
+    """Computes the performance rating timeline of all games in RawData. The timeline of the
+    previous run is extended with the games that finished since. It is rebuilt instead if its
+    window or initial ratings differ, a game of it was removed or its result changed, or a game
+    finished before its last game.
+
+    Args:
+        df (pd.DataFrame): The games, with the columns ID, White, Black, Results and Termination_Date.
+        window (int, optional): The number of recent games a rating is based on. Defaults to 5.
+        initial_ratings (Dict[str, float], optional): The ratings of players before their first
+            game, 1500 for players not in it. Defaults to None.
+        checkpoint_path (str, optional): Where the timeline is kept between runs, None to always
+            rebuild it. Defaults to PERF_CHECKPOINT_PATH.
+
+    Returns:
+        PerformanceTimeline: The timeline.
+    """
+    timeline = load_checkpoint(checkpoint_path) if checkpoint_path else None
+
+    if timeline is not None and (timeline.window != window or timeline.initial_ratings_hash != ratings_hash(initial_ratings)):
+        timeline = None
+
+    try:
+        added = timeline.extend(df) if timeline is not None else None
+    except ValueError as e:
+        print(e)
+        added = None
+
+    if added is None:
+        timeline = PerformanceTimeline(window, initial_ratings)
+
+        with span('perf_rtg.rebuild'):
+            added = timeline.extend(df)
+
+    count('perf_rtg.games_added', added)
+    print(f'Added {added} games to the timeline')
+
+    if checkpoint_path:
+        save_checkpoint(timeline, checkpoint_path)
+
+    return timeline
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description='Prints the performance rating of every player.')
+    parser.add_argument('--offline', action='store_true', help='read RawData from the local snapshot instead of the spreadsheet')
+    add_report_args(parser)
+    args = parser.parse_args(argv)
 
+    with run_report('perf_rtg', args.report, args.profile):
+        if args.offline:
+            df = load_snapshot('RawData')
+        else:
+            df, _ = download_as_dataframe(init_gspread_api(), 'RawData', 'RawData')
 
-def compute_historical_rankings():
-    sh = init_gspread_api()
-    client = init_lichess_api()
-    df, _ = download_as_dataframe(sh, 'RawData', 'RawData')
-    df.sort_values("Termination_Date", axis=0, inplace=True)
+        timeline = compute_historical_rankings(df)
+        print(timeline.rankings().to_string(index=False))
 
-    for row in df:
-        
 
 if __name__ == '__main__':
-    compute_historical_rankings()
\ No newline at end of file
+    main()
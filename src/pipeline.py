@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import pandas as pd
+
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, AsyncIterator, Dict, Iterable, List, Tuple
+
+from apis import init_lichess_api, init_gspread_api
+from game_store import GameStore
+from instrumentation import add_report_args, count, run_report
+from gspread_utils import download_as_dataframes
+from players import apply_users, fetch_users, upload_players
+from lichess_export import GameRecord
+from snapshot import SNAPSHOT_TABLES, update_snapshot
+from raw_data import (EVAL_STAT_COLUMNS, add_analyses, analysis_values, finish_games, games_to_request, is_analysed,
+                      load_sync_state, prepare_games, replay_compensations, save_sync_state, sync_game, upload_games)
+
+
+# The number of analysed games whose compensation is computed together while the export continues.
+ANALYSIS_CHUNK_SIZE = 64
+
+
+async def download_tables(spreadsheet, ranges: Iterable[Tuple[str, str]]) -> List[Tuple[pd.DataFrame, List]]:
+    """Downloads several named ranges at once, in a single request for the ranges that aren't cached.
+
+    Args:
+        spreadsheet (Spreadsheet): The league spreadsheet.
+        ranges (Iterable[Tuple[str, str]]): The worksheet and named range of each table.
+
+    Returns:
+        List[Tuple[pd.DataFrame, List]]: The table and its header for each range, in order.
+    """
+    return await asyncio.to_thread(download_as_dataframes, spreadsheet, list(ranges))
+
+
+async def stream_games(client, store: GameStore, game_ids: List[str]) -> AsyncIterator[GameRecord]:
+    """Yields the records of the games as they arrive from the store and Lichess, which are read
+    in a worker thread, so that the games can be processed while the export is still streaming.
+
+    Args:
+        client (Client): The Lichess client.
+        store (GameStore): The local game store.
+        game_ids (List[str]): The ids of the games to get.
+
+    Yields:
+        GameRecord: The records of the games, in the order of GameStore.get_records.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+
+    def produce():
+        try:
+            for game in store.get_records(client, game_ids):
+                loop.call_soon_threadsafe(queue.put_nowait, game)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    producer = asyncio.create_task(asyncio.to_thread(produce))
+
+    while (game := await queue.get()) is not done:
+        yield game
+
+    # Raises the error that ended the export, if any.
+    await producer
+
+
+async def analyse_chunk(store: GameStore, pool: Executor, games: List[GameRecord], columns: Iterable[str] = ()) -> List[Dict[str, Any]]:
+    """Computes the values of a chunk of analysed games, like raw_data.analyse_games. The games
+    whose compensation isn't stored yet are replayed in the process pool, so that the replay runs
+    in parallel to the export instead of sharing the GIL with it.
+
+    Args:
+        store (GameStore): The local game store.
+        pool (Executor): The process pool the games are replayed in.
+        games (List[GameRecord]): The analysed games.
+        columns (Iterable[str], optional): The columns of EVAL_STAT_COLUMNS to compute. Defaults to none.
+
+    Returns:
+        List[Dict[str, Any]]: The values of each game by column.
+    """
+    # python-chess is only loaded once there are games to analyse.
+    from awards import COMPENSATION_VERSION
+
+    compensations = store.get_derived_records(games, 'compensation', COMPENSATION_VERSION)
+    missing = [game for game, value in zip(games, compensations) if value is None]
+
+    if len(missing) > 0:
+        count('pipeline.games_replayed', len(missing))
+
+        replayed = await asyncio.get_running_loop().run_in_executor(pool, replay_compensations, missing)
+        store.put_derived_records(missing, 'compensation', COMPENSATION_VERSION, replayed)
+
+        replayed = iter(replayed)
+        compensations = [next(replayed) if value is None else value for value in compensations]
+
+    return analysis_values(games, compensations, columns)
+
+
+async def update_players(client, spreadsheet, table: Tuple[pd.DataFrame, List]):
+    """Updates the Players_Backend sheet, like players.update_player_data.
+
+    Args:
+        client (Client): The Lichess client.
+        spreadsheet (Spreadsheet): The league spreadsheet.
+        table (Tuple[pd.DataFrame, List]): The PlayersRaw table and its header as downloaded.
+    """
+    df, header = table
+    original = df.copy()
+
+    df = df.set_index(['id'])
+
+    users = await asyncio.to_thread(fetch_users, client, list(df.index))
+    df = apply_users(df, users)
+
+    await asyncio.to_thread(upload_players, spreadsheet, df, header, original)
+
+
+async def update_raw_data(client, spreadsheet, store: GameStore, table: Tuple[pd.DataFrame, List], incremental: bool = True):
+    """Updates the PythonUpdate sheet, like raw_data.update_raw_data. The compensation of the
+    analysed games is computed in chunks in a process pool while the remaining games are still
+    being exported.
+
+    Args:
+        client (Client): The Lichess client.
+        spreadsheet (Spreadsheet): The league spreadsheet.
+        store (GameStore): The local game store.
+        table (Tuple[pd.DataFrame, List]): The PythonUpdate table and its header as downloaded.
+        incremental (bool, optional): See raw_data.update_raw_data. Defaults to True.
+    """
+    df, header = table
+    original = df.copy()
+
+    df = prepare_games(df)
+
+    state = load_sync_state() if incremental else dict()
+    game_ids = games_to_request(df, state, incremental)
+
+    count('raw_data.games_requested', len(game_ids))
+
+    stat_columns = [col for col in EVAL_STAT_COLUMNS if col in df.columns]
+    records = dict()
+    analyses = []
+    chunk = []
+
+    # The workers are only started once the first chunk has games to replay.
+    with ProcessPoolExecutor() as pool:
+        async for game in stream_games(client, store, game_ids):
+            record = sync_game(game, state, incremental)
+
+            if record is None:
+                continue
+
+            records[game.id] = record
+
+            if is_analysed(game):
+                chunk.append(game)
+
+            if len(chunk) >= ANALYSIS_CHUNK_SIZE:
+                analyses.append((chunk, asyncio.create_task(analyse_chunk(store, pool, chunk, stat_columns))))
+                chunk = []
+
+        if len(chunk) > 0:
+            analyses.append((chunk, asyncio.create_task(analyse_chunk(store, pool, chunk, stat_columns))))
+
+        for games, analysis in analyses:
+            add_analyses(records, games, await analysis)
+
+    store.commit()
+
+    if len(store.missing) > 0:
+        print(f"Lichess didn't return {len(store.missing)} games: {', '.join(store.missing)}")
+
+    df = finish_games(df, records)
+
+    if incremental:
+        print(f'Requested {len(game_ids)} games, {len(records)} changed.')
+
+    await asyncio.to_thread(upload_games, spreadsheet, df, header, original, incremental)
+
+    save_sync_state(state)
+
+
+async def run_weekly_update(client, spreadsheet, store: GameStore, incremental: bool = True) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Runs the weekly update as one pipeline. The player and game tables are downloaded at once,
+    the players and the games are then updated side by side, and once both are uploaded the
+    input of the pairings is downloaded and written to the local snapshot together with the players.
+
+    Args:
+        client (Client): The Lichess client.
+        spreadsheet (Spreadsheet): The league spreadsheet.
+        store (GameStore): The local game store.
+        incremental (bool, optional): See raw_data.update_raw_data. Defaults to True.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: The PairingMaker and RawData tables.
+    """
+    players_table, games_table = await download_tables(spreadsheet, [('Players_Backend', 'PlayersRaw'), ('PythonUpdate', 'PythonUpdate')])
+
+    await asyncio.gather(
+        update_players(client, spreadsheet, players_table),
+        update_raw_data(client, spreadsheet, store, games_table, incremental)
+    )
+
+    tables = await download_tables(spreadsheet, SNAPSHOT_TABLES.values())
+    tables = {name: df for name, (df, _) in zip(SNAPSHOT_TABLES, tables)}
+
+    await asyncio.to_thread(update_snapshot, spreadsheet, tables=tables)
+
+    return tables['PairingMaker'], tables['RawData']
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description='Runs the weekly update of the players and the games.')
+    parser.add_argument('--full', action='store_true', help='request every game and upload the whole game table')
+    parser.add_argument('--pairings', action='store_true', help='print the pairings of the next round afterwards, see pairings.py for more options')
+    add_report_args(parser)
+    args = parser.parse_args(argv)
+
+    with run_report('pipeline', args.report, args.profile):
+        sh = init_gspread_api()
+        client = init_lichess_api()
+
+        with GameStore() as store:
+            pairing_maker, raw_data = asyncio.run(run_weekly_update(client, sh, store, incremental=not args.full))
+
+        if args.pairings:
+            from pairings import format_rounds, generate_rounds, load_pairing_input
+
+            print(format_rounds(generate_rounds(*load_pairing_input(pairing_maker, raw_data))))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,125 @@
+import argparse
 import pandas as pd
 
-from berserk import Client
+from typing import TYPE_CHECKING, Dict, List
 
-from apis import init_lichess_api, init_gspread_api
+from apis import LICHESS, init_lichess_api, init_gspread_api
 from gspread_utils import download_as_dataframe, upload_dataframe
+from instrumentation import add_report_args, count, run_report, span, timed
 
+if TYPE_CHECKING:
+    from berserk import Client
 
-def update_player_data(client: Client, spreadsheet):
+
+# Lichess returns at most 300 users per request to /api/users.
+USERS_CHUNK_SIZE = 300
+
+
+def fetch_users(client: 'Client', ids: List[str]) -> List[Dict]:
+    """Fetches the given users from Lichess in as few requests as possible.
+
+    Args:
+        client (Client): The Lichess client.
+        ids (List[str]): The ids of the users.
+
+    Returns:
+        List[Dict]: The users that Lichess knows.
+    """
+    users = []
+
+    for start in range(0, len(ids), USERS_CHUNK_SIZE):
+        with span('lichess.users'):
+            users.extend(LICHESS.call(client.users.get_by_id, *ids[start:start + USERS_CHUNK_SIZE]))
+
+    count('players.users', len(users))
+
+    return users
+
+
+def get_player_record(player: Dict) -> Dict:
+    """Extracts the columns of the Players_Backend sheet from a Lichess user.
+
+    Args:
+        player (Dict): The user as returned by Lichess.
+
+    Returns:
+        Dict: The id, name and ratings of the player.
+    """
+    if 'disabled' in player and player['disabled']:
+        corr_rtg, class_rtg = 1500, 1500
+    else:
+        corr_rtg = player['perfs']['correspondence']['rating']
+        class_rtg = player['perfs']['classical']['rating']
+
+    return {'id': player['id'], 'name': player['username'], 'corr_rtg': corr_rtg, 'class_rtg': class_rtg}
+
+
+@timed('players.apply')
+def apply_users(df: pd.DataFrame, users: List[Dict]) -> pd.DataFrame:
+    """Writes the latest names and ratings from Lichess into the Players_Backend table.
+
+    Args:
+        df (pd.DataFrame): The table as downloaded, indexed by id.
+        users (List[Dict]): The users as returned by Lichess.
+
+    Returns:
+        pd.DataFrame: The table to upload. Players that Lichess didn't return keep their values.
+    """
+    updates = pd.DataFrame.from_records([get_player_record(player) for player in users], columns=['id', 'name', 'corr_rtg', 'class_rtg'])
+    updates = updates.set_index('id').reindex(df.index.str.lower())
+    updates = updates.astype({'corr_rtg': 'Int64', 'class_rtg': 'Int64'})
+    updates.index = df.index
+
+    missing = updates.index[updates['name'].isna()]
+    if len(missing) > 0:
+        print(f"Lichess didn't return {len(missing)} players: {', '.join(missing)}")
+
+    # Keep the values in the sheet for players that Lichess didn't return.
+    for col in updates.columns:
+        df[col] = updates[col].astype(object).where(updates[col].notna(), df[col])
+
+    return df.reset_index()
+
+
+def upload_players(spreadsheet, df: pd.DataFrame, header: List, original: pd.DataFrame):
+    """Uploads the changed cells of the Players_Backend table, if there are any.
+
+    Args:
+        spreadsheet (Spreadsheet): The league spreadsheet.
+        df (pd.DataFrame): The table to upload.
+        header (List): The header of the table.
+        original (pd.DataFrame): The table as it was downloaded.
+    """
+    if (df[original.columns].astype(str) == original.astype(str)).all().all():
+        print('No player data changed.')
+        return
+
+    upload_dataframe(spreadsheet, 'Players_Backend', 'PlayersRaw', df, header, original=original)
+
+
+def update_player_data(client: 'Client', spreadsheet):
     df, header = download_as_dataframe(spreadsheet, 'Players_Backend', 'PlayersRaw')
+    original = df.copy()
 
     df = df.set_index(['id'])
 
-    for id in df.index:
-        player = client.users.get_by_id(id)[0]
-        
-        df.loc[id, 'name'] = player['username']
+    users = fetch_users(client, list(df.index))
+    df = apply_users(df, users)
+
+    upload_players(spreadsheet, df, header, original)
+
 
-        if 'disabled' in player and player['disabled']:
-            df.loc[id, 'corr_rtg'] = 1500
-            df.loc[id, 'class_rtg'] = 1500
-        else:
-            df.loc[id, 'corr_rtg'] = player['perfs']['correspondence']['rating']
-            df.loc[id, 'class_rtg'] = player['perfs']['classical']['rating']
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description='Updates the names and ratings in the Players_Backend sheet.')
+    add_report_args(parser)
+    args = parser.parse_args(argv)
 
-    df = df.reset_index()
+    with run_report('players', args.report, args.profile):
+        sh = init_gspread_api()
+        client = init_lichess_api()
 
-    upload_dataframe(sh, 'Players_Backend', 'PlayersRaw', df, header)
+        update_player_data(client, sh)
 
 
 if __name__ == '__main__':
-    sh = init_gspread_api()
-    client = init_lichess_api()
-    
-    update_player_data(client, sh)
\ No newline at end of file
+    main()
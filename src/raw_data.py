@@ -1,88 +1,444 @@
+import argparse
+import json
+import os
+import numpy as np
 import pandas as pd
 import math
 
-from apis import init_lichess_api, init_gspread_api
-from awards import compute_compensation
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from apis import LazyLichessClient, init_gspread_api
+from eval_analytics import BLACK, WHITE, EvalBatch, game_stats
+from game_store import GameStore
 from gspread_utils import download_as_dataframe, upload_dataframe
+from instrumentation import add_report_args, count, run_report, span, timed
+from lichess_export import GameRecord, UNFINISHED_STATUSES
+from snapshot import update_snapshot
 
 
-def update_raw_data(client, spreadsheet):
-    df, header = download_as_dataframe(spreadsheet, 'PythonUpdate', 'PythonUpdate')
+SYNC_STATE_PATH = 'data/sync_state.json'
+
+# Stats computed from the evals of the analysed games, see eval_analytics.game_stats. They are only
+# filled in if their column has been added to the PythonUpdate table.
+EVAL_STAT_COLUMNS = {
+    'w_CPL': ('cpl', WHITE), 'b_CPL': ('cpl', BLACK),
+    'w_inaccuracies': ('inaccuracies', WHITE), 'b_inaccuracies': ('inaccuracies', BLACK),
+    'w_mistakes': ('mistakes', WHITE), 'b_mistakes': ('mistakes', BLACK),
+    'w_blunders': ('blunders', WHITE), 'b_blunders': ('blunders', BLACK),
+    'w_swing': ('swing', WHITE), 'b_swing': ('swing', BLACK),
+}
+
+# Columns that hold whole numbers, kept as nullable integers so that they are uploaded as such.
+INTEGER_COLUMNS = ['Start_Date', 'Termination_Date', 'Duration', 'White_Accuracy', 'Black_Accuracy', 'w_comp', 'b_comp', 'w_total_CPL', 'b_total_CPL', 'w_total_moves', 'b_total_moves'] + list(EVAL_STAT_COLUMNS)
+
+TERMINATIONS = {'outoftime': 'Clock Flag', 'resign': 'Resign', 'mate': 'Mate', 'draw': 'Draw by Agreement', 'cheat': 'Banned', 'insufficientMaterialClaim': 'Draw by insufficient material'}
+
+
+def load_sync_state(path: str = SYNC_STATE_PATH) -> Dict[str, Dict[str, Any]]:
+    """Loads the sync state written by the previous run.
+
+    Args:
+        path (str, optional): The file to load the state from. Defaults to SYNC_STATE_PATH.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: Maps each game id to its last seen status, lastMoveAt (in ms)
+        and whether it had been analysed.
+    """
+    if not os.path.exists(path):
+        return dict()
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_sync_state(state: Dict[str, Dict[str, Any]], path: str = SYNC_STATE_PATH):
+    """Writes the sync state to disk, replacing the previous state in one step.
+
+    Args:
+        state (Dict[str, Dict[str, Any]]): Maps each game id to its status, lastMoveAt (in ms) and
+        whether it had been analysed.
+        path (str, optional): The file to write the state to. Defaults to SYNC_STATE_PATH.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+
+    os.replace(path + '.tmp', path)
+
+
+def select_games_to_sync(df: pd.DataFrame, state: Dict[str, Dict[str, Any]]) -> List[str]:
+    """Selects the games that have to be requested from Lichess. These are the games that are new
+    in the sheet, the games that were still being played during the last run, finished games that
+    hadn't been analysed yet, since Lichess may analyse a game after it is over, and finished games
+    whose result has been cleared in the sheet since.
+
+    Args:
+        df (pd.DataFrame): The games in the sheet, indexed by game id.
+        state (Dict[str, Dict[str, Any]]): The sync state of the previous run.
+
+    Returns:
+        List[str]: The ids of the games to request.
+    """
+    game_ids = []
+
+    for game_id, result in zip(df.index, df['Results']):
+        known = state.get(game_id)
+
+        # States written before the analysis was recorded count as not analysed.
+        if known is None or known['status'] in UNFINISHED_STATUSES or not known.get('analysed', False) or result in {'game', '', None}:
+            game_ids.append(game_id)
+
+    return game_ids
+
+
+def extract_game_record(game: GameRecord) -> Dict[str, Any]:
+    """Extracts the columns of the PythonUpdate sheet from a Lichess game. Columns that can't be
+    filled yet, e.g. the accuracy of a game that hasn't been analysed, are left out.
+
+    Args:
+        game (GameRecord): The record of the game as exported from Lichess.
+
+    Returns:
+        Dict[str, Any]: The values of the game's row by column.
+    """
+    start_date = int(round(game.created_at / 1000))
+    moves = game.moves.split(' ')
+
+    record = {
+        'Start_Date': start_date,
+        'White': game.white,
+        'Black': game.black,
+    }
 
+    if len(moves) >= 4:
+        record['W_Move_1'] = moves[0]
+        record['B_Move_1'] = moves[1]
+        record['w_total_moves'] = math.ceil(len(moves)/2)
+        record['b_total_moves'] = math.floor(len(moves)/2)
+
+    status = game.status
+
+    if status != 'started':
+        if game.analysed:
+            record['White_Accuracy'] = int(game.white_acpl)
+            record['Black_Accuracy'] = int(game.black_acpl)
+            record['w_total_CPL'] = int(game.white_acpl) * math.ceil(len(moves)/2)
+            record['b_total_CPL'] = int(game.black_acpl) * math.floor(len(moves)/2)
+
+        # The result, games that aren't decisive have no winner.
+        if status in {'resign', 'cheat', 'outoftime', 'mate'}:
+            if game.winner is not None:
+                record['Results'] = '0 - 1' if game.winner == 'black' else '1 - 0'
+        else:
+            record['Results'] = '1/2 - 1/2'
+
+        record['Termination'] = TERMINATIONS.get(status, status)
+
+        # When the game terminated and how long it lasted.
+        termination_date = int(round(game.last_move_at / 1000))
+        record['Termination_Date'] = termination_date
+        record['Duration'] = termination_date - start_date
+
+        if game.eco is not None:
+            record['Opening'] = game.eco
+
+    return record
+
+
+def merge_records(df: pd.DataFrame, records: Dict[str, Dict[str, Any]]) -> pd.DataFrame:
+    """Writes the records into the rows of their games, one column at a time. Values missing from
+    a record leave the cell as it is.
+
+    Args:
+        df (pd.DataFrame): The games in the sheet, indexed by game id.
+        records (Dict[str, Dict[str, Any]]): The values to write by game id and column.
+
+    Returns:
+        pd.DataFrame: The games with the records written.
+    """
+    if len(records) == 0:
+        return df
+
+    updates = pd.DataFrame.from_dict(records, orient='index')
+    updates = updates.astype({col: 'Int64' for col in INTEGER_COLUMNS if col in updates.columns})
+
+    # A game id may appear in more than one row of the sheet, all of them are updated.
+    rows = np.flatnonzero(df.index.isin(updates.index))
+    updates = updates.reindex(df.index[rows])
+
+    for col in updates.columns:
+        values = updates[col]
+        known = values.notna().to_numpy()
+
+        if col not in df.columns:
+            df[col] = pd.Series(pd.NA, index=df.index, dtype=values.dtype)
+
+        column = df[col].copy()
+        column.iloc[rows[known]] = values[known].to_numpy()
+        df[col] = column
+
+    return df
+
+
+@timed('raw_data.prepare')
+def prepare_games(df: pd.DataFrame) -> pd.DataFrame:
+    """Indexes the downloaded PythonUpdate table by game id and converts its numeric columns.
+
+    Args:
+        df (pd.DataFrame): The table as downloaded.
+
+    Returns:
+        pd.DataFrame: The games, indexed by game id.
+    """
     df = df.set_index(['ID'])
     df['Round'] = pd.to_numeric(df['Round'])
     
-    # Convert numeric columns to proper dtype to avoid cross-platform issues
-    numeric_cols = ['Start_Date', 'Termination_Date', 'Duration', 'White_Accuracy', 'Black_Accuracy', 'w_comp', 'b_comp', 'w_total_CPL', 'b_total_CPL', 'w_total_moves', 'b_total_moves']
-    for col in numeric_cols:
+    # Convert numeric columns to nullable integers, so that they are uploaded as integers.
+    for col in INTEGER_COLUMNS:
         if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
+            df[col] = pd.to_numeric(df[col], errors='coerce').round().astype('Int64')
 
-    for game in client.games.export_multi(*df[df['Round'] > 150].index, evals=True, opening=True):
-        game_id = game['id']
+    return df
 
-        start_date = game['createdAt'].timestamp()
-        df.loc[game_id, 'Start_Date'] = int(round(start_date))
 
-        moves = game['moves'].split(' ')
+def games_to_request(df: pd.DataFrame, state: Dict[str, Dict[str, Any]], incremental: bool = True) -> List[str]:
+    """Selects the games to request from Lichess, see select_games_to_sync.
 
-        players = game['players']
-        df.loc[game_id, 'White'] = players['white']['user']['id']
-        df.loc[game_id, 'Black'] = players['black']['user']['id']
+    Args:
+        df (pd.DataFrame): The games in the sheet, indexed by game id.
+        state (Dict[str, Dict[str, Any]]): The sync state of the previous run.
+        incremental (bool, optional): Whether to only select the games that may have changed,
+        otherwise all games with a round are selected. Defaults to True.
 
-        if len(moves) >= 4:
-            df.loc[game_id, 'W_Move_1'] = moves[0]
-            df.loc[game_id, 'B_Move_1'] = moves[1]
+    Returns:
+        List[str]: The ids of the games to request.
+    """
+    game_ids = df[df['Round'].notna() & (df.index != '')].index
 
-            df.loc[game_id, 'w_total_moves'] = math.ceil(len(moves)/2)
-            df.loc[game_id, 'b_total_moves'] = math.floor(len(moves)/2)
+    if incremental:
+        return select_games_to_sync(df.loc[game_ids], state)
 
-        status = game['status']
+    return list(game_ids)
 
-        if status != 'started':
-            if 'analysis' in players['white']:
-                df.loc[game_id, 'White_Accuracy'] = int(players['white']['analysis']['acpl'])
-                df.loc[game_id, 'Black_Accuracy'] = int(players['black']['analysis']['acpl'])
 
-                w_comp, b_comp = compute_compensation(game)
+def sync_game(game: GameRecord, state: Dict[str, Dict[str, Any]], incremental: bool = True) -> Optional[Dict[str, Any]]:
+    """Records the game in the sync state and extracts its row.
 
-                df.loc[game_id, 'w_comp'] = w_comp
-                df.loc[game_id, 'b_comp'] = b_comp
+    Args:
+        game (GameRecord): The record of the game as exported from Lichess.
+        state (Dict[str, Dict[str, Any]]): The sync state, updated with the game.
+        incremental (bool, optional): Whether to skip games that haven't changed since the last
+        run. Defaults to True.
 
-                df.loc[game_id, 'w_total_CPL'] = int(players['white']['analysis']['acpl']) * math.ceil(len(moves)/2)
-                df.loc[game_id, 'b_total_CPL'] = int(players['black']['analysis']['acpl']) * math.floor(len(moves)/2)
+    Returns:
+        Optional[Dict[str, Any]]: The values of the game's row, or None if the game is unchanged.
+    """
+    game_id = game.id
 
-            # Update the game results.
-            try:
-                if status in {'resign', 'cheat', 'outoftime', 'mate'}:
-                    df.loc[game_id, 'Results'] = '0 - 1' if game['winner'] == 'black' else '1 - 0'
-                else:
-                    df.loc[game_id, 'Results'] = '1/2 - 1/2'
-            except:
-                pass
+    known = state.get(game_id)
+    state[game_id] = {'status': game.status, 'lastMoveAt': game.last_move_at, 'analysed': game.analysed}
 
-            # Update the termination types.
-            term_map = {'outoftime': 'Clock Flag', 'resign': 'Resign', 'mate': 'Mate', 'draw': 'Draw by Agreement', 'cheat': 'Banned', 'insufficientMaterialClaim': 'Draw by insufficient material'}
-            df.loc[game_id, 'Termination'] = term_map[status]
+    # A game that is still being played and hasn't seen a move since the last run is unchanged.
+    if incremental and known == state[game_id] and known['status'] == 'started':
+        count('raw_data.games_unchanged')
+        return None
 
-            # Update when the game terminated and how long it lasted.
-            termination_date = game['lastMoveAt'].timestamp()
-            df.loc[game_id, 'Termination_Date'] = int(round(termination_date))
-            df.loc[game_id, 'Duration'] = int(round(termination_date) - round(start_date))
+    count('raw_data.games_processed')
 
-            df.loc[game_id, 'Opening'] = game['opening']['eco']
+    return extract_game_record(game)
 
-    df = df.reset_index()
-    
-    # Replace NaN values with empty strings before uploading
-    df = df.fillna('')
+
+def is_analysed(game: GameRecord) -> bool:
+    """Checks whether the compensation of a game can be computed, i.e. it is over and analysed."""
+    return game.status != 'started' and game.analysed
+
+
+def add_analyses(records: Dict[str, Dict[str, Any]], games: List[GameRecord], values: Iterable[Dict[str, Any]]):
+    """Adds the values computed from the analysis of the games to their records.
+
+    Args:
+        records (Dict[str, Dict[str, Any]]): The records by game id.
+        games (List[GameRecord]): The analysed games.
+        values (Iterable[Dict[str, Any]]): The values of each game by column, see analyse_games.
+    """
+    for game, game_values in zip(games, values):
+        records[game.id].update(game_values)
+
+
+def analyse_games(store: GameStore, games: List[GameRecord], columns: Iterable[str] = ()) -> List[Dict[str, Any]]:
+    """Computes the compensation of analysed games and the given stats of EVAL_STAT_COLUMNS.
+
+    Args:
+        store (GameStore): The local game store.
+        games (List[GameRecord]): The analysed games.
+        columns (Iterable[str], optional): The columns of EVAL_STAT_COLUMNS to compute. Defaults to none.
+
+    Returns:
+        List[Dict[str, Any]]: The values of each game by column.
+    """
+    return analysis_values(games, compute_compensations(store, games), columns)
+
+
+def analysis_values(games: List[GameRecord], compensations: Iterable[Tuple[int, int]], columns: Iterable[str] = ()) -> List[Dict[str, Any]]:
+    """Computes the given stats of EVAL_STAT_COLUMNS of analysed games and puts them into their
+    columns together with the compensation, see analyse_games.
+
+    Args:
+        games (List[GameRecord]): The analysed games.
+        compensations (Iterable[Tuple[int, int]]): The compensation of white and black for each game.
+        columns (Iterable[str], optional): The columns of EVAL_STAT_COLUMNS to compute. Defaults to none.
+
+    Returns:
+        List[Dict[str, Any]]: The values of each game by column.
+    """
+    values = [{'w_comp': w_comp, 'b_comp': b_comp} for w_comp, b_comp in compensations]
+    columns = list(columns)
+
+    if len(columns) > 0:
+        with span('raw_data.eval_stats'):
+            stats = game_stats(EvalBatch([game.evals for game in games]))
+
+        for idx, game_values in enumerate(values):
+            game_values.update({col: int(stats[EVAL_STAT_COLUMNS[col][0]][idx, EVAL_STAT_COLUMNS[col][1]]) for col in columns})
+
+    return values
+
+
+def compute_compensations(store: GameStore, games: List[GameRecord]) -> List[Tuple[int, int]]:
+    """Computes the compensation of analysed games, or loads it from the store.
+
+    Args:
+        store (GameStore): The local game store.
+        games (List[GameRecord]): The analysed games.
+
+    Returns:
+        List[Tuple[int, int]]: The compensation of white and black for each game.
+    """
+    # python-chess is only loaded once there are games to replay.
+    from awards import compute_compensation_records, COMPENSATION_VERSION
+
+    with span('raw_data.compensation'):
+        return store.derive_records(games, 'compensation', COMPENSATION_VERSION, compute_compensation_records)
+
+
+def replay_compensations(games: List[GameRecord]) -> List[Tuple[int, int]]:
+    """Computes the compensation of analysed games in this process, e.g. in a worker of the
+    process pool of pipeline.py, without the store.
+
+    Args:
+        games (List[GameRecord]): The analysed games.
+
+    Returns:
+        List[Tuple[int, int]]: The compensation of white and black for each game.
+    """
+    from awards import compute_compensation_records
+
+    return list(compute_compensation_records(games, workers=1))
+
+
+@timed('raw_data.finish')
+def finish_games(df: pd.DataFrame, records: Dict[str, Dict[str, Any]]) -> pd.DataFrame:
+    """Writes the records into the games and turns them back into the table to upload.
+
+    Args:
+        df (pd.DataFrame): The games, indexed by game id.
+        records (Dict[str, Dict[str, Any]]): The values to write by game id and column.
+
+    Returns:
+        pd.DataFrame: The table, with empty strings for missing values.
+    """
+    df = merge_records(df, records).reset_index()
     
-    print(df)
-    upload_dataframe(spreadsheet, 'PythonUpdate', 'PythonUpdate', df, header)
+    # Replace missing values with empty strings before uploading
+    return df.astype(object).where(df.notna(), '')
 
 
-if __name__ == '__main__':
-    sh = init_gspread_api()
-    client = init_lichess_api()
+def upload_games(spreadsheet, df: pd.DataFrame, header: List, original: pd.DataFrame, incremental: bool = True):
+    """Uploads the PythonUpdate table, only the changed cells if incremental.
 
-    update_raw_data(client, sh)
\ No newline at end of file
+    Args:
+        spreadsheet (Spreadsheet): The league spreadsheet.
+        df (pd.DataFrame): The table to upload.
+        header (List): The header of the table.
+        original (pd.DataFrame): The table as it was downloaded.
+        incremental (bool, optional): Whether to only upload the cells that changed. Defaults to True.
+    """
+    if incremental:
+        upload_dataframe(spreadsheet, 'PythonUpdate', 'PythonUpdate', df, header, original=original)
+    else:
+        upload_dataframe(spreadsheet, 'PythonUpdate', 'PythonUpdate', df, header)
+
+
+def update_raw_data(client, spreadsheet, store: GameStore, incremental: bool = True):
+    """Updates the game data in the PythonUpdate sheet with the latest data from Lichess.
+
+    Args:
+        client (Client): The Lichess client.
+        spreadsheet (Spreadsheet): The league spreadsheet.
+        store (GameStore): The local game store, finished games are read from it.
+        incremental (bool, optional): Whether to only request the games that are new, still being
+        played or have changed since the last run and to only upload the cells that changed.
+        Otherwise all games are requested and the whole table is uploaded. Defaults to True.
+    """
+    df, header = download_as_dataframe(spreadsheet, 'PythonUpdate', 'PythonUpdate')
+    original = df.copy()
+
+    df = prepare_games(df)
+
+    state = load_sync_state() if incremental else dict()
+    game_ids = games_to_request(df, state, incremental)
+
+    stat_columns = [col for col in EVAL_STAT_COLUMNS if col in df.columns]
+    analysed = []
+    records = dict()
+
+    count('raw_data.games_requested', len(game_ids))
+
+    for game in store.get_records(client, game_ids):
+        record = sync_game(game, state, incremental)
+
+        if record is None:
+            continue
+
+        records[game.id] = record
+
+        # Only the compact records of the analysed games are kept until the export is done.
+        if is_analysed(game):
+            analysed.append(game)
+
+    # All games are analysed at once, so that a large batch is replayed in parallel, see awards._map_batch.
+    if len(analysed) > 0:
+        add_analyses(records, analysed, analyse_games(store, analysed, stat_columns))
+
+    if len(store.missing) > 0:
+        print(f"Lichess didn't return {len(store.missing)} games: {', '.join(store.missing)}")
+
+    df = finish_games(df, records)
+
+    if incremental:
+        print(f'Requested {len(game_ids)} games, {len(records)} changed.')
+
+    upload_games(spreadsheet, df, header, original, incremental)
+
+    save_sync_state(state)
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description='Updates the game data in the PythonUpdate sheet.')
+    parser.add_argument('--full', action='store_true', help='request every game and upload the whole table')
+    add_report_args(parser)
+    args = parser.parse_args(argv)
+
+    with run_report('raw_data', args.report, args.profile):
+        sh = init_gspread_api()
+        client = LazyLichessClient()
+
+        with GameStore() as store:
+            update_raw_data(client, sh, store, incremental=not args.full)
+
+        update_snapshot(sh)
+
+
+if __name__ == '__main__':
+    main()
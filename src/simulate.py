@@ -0,0 +1,326 @@
+import argparse
+import copy
+import json
+import os
+import random
+import statistics
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+from apis import init_gspread_api
+from awards import parse_rounds
+from game_history import GameHistoryIndex
+from gspread_utils import download_as_dataframes
+from instrumentation import add_report_args, count, run_report, span
+from pairing_engine import DEFAULT_K
+from pairings import ODD_PLAYER_RULES, POLICY_OPTIONS, PairingPolicy, generate_rounds, load_pairing_input
+from perf_rtg import RESULT_SCORES
+from snapshot import load_snapshots
+
+
+# The policies compared unless others are given: the league's and a single change to it each.
+CANDIDATE_POLICIES = [
+    'default',
+    'recent-3:recent=3',
+    'recent-8:recent=8',
+    'squared-gap:gap_exponent=2',
+    'rematch-penalty:rematch_penalty=200',
+    'preference-colors:color_rule=preference',
+]
+
+# The share of draws between players of the same rating, fewer the further apart they are.
+DRAW_RATE = 0.3
+
+# How far the ratings move after a simulated game, like the K-factor of Elo ratings.
+ELO_K = 20
+
+# The time between two simulated rounds (in s).
+ROUND_SECONDS = 7 * 86400
+
+# The metrics of a simulated season, see simulate_season.
+SEASON_METRICS = ['games', 'unpaired', 'rematch_rate', 'mean_gap', 'max_gap', 'color_imbalance', 'max_color_imbalance']
+
+SCORE_RESULTS = {score: result for result, score in RESULT_SCORES.items()}
+
+
+class Season:
+    """What the simulated seasons start from: the games before the first simulated round, the
+    players of each round and their ratings and color scores.
+    """
+
+    def __init__(self, history: GameHistoryIndex, rounds: List[List[str]], rtgs: Dict[str, float], col_pref: Dict[str, float], start_date: float):
+        """Creates the season.
+
+        Args:
+            history (GameHistoryIndex): Index over the games before the first round.
+            rounds (List[List[str]]): The players of each round.
+            rtgs (Dict[str, float]): The player's ratings at the start.
+            col_pref (Dict[str, float]): The player's color scores at the start, lower scores
+            prefer white.
+            start_date (float): When the first round starts (unix timestamp in s).
+        """
+        self.history = history
+        self.rounds = rounds
+        self.rtgs = rtgs
+        self.col_pref = col_pref
+        self.start_date = start_date
+
+
+def load_season(pairing_maker: pd.DataFrame, raw_data: pd.DataFrame, first_round: Optional[int] = None, last_round: Optional[int] = None) -> Season:
+    """Reads the season to simulate from the downloaded sheets. The rounds are replayed with the
+    players who played in them; rounds after the last one in RawData have all players of
+    PairingMaker. The ratings and color scores of PairingMaker are used from the start, players
+    who aren't in PairingMaker are left out.
+
+    Args:
+        pairing_maker (pd.DataFrame): The PairingMaker table of the Pairing_Maker sheet.
+        raw_data (pd.DataFrame): The RawData table of the RawData sheet.
+        first_round (Optional[int], optional): The first round to simulate. Defaults to the
+        first round in RawData.
+        last_round (Optional[int], optional): The last round to simulate. Defaults to the last
+        round in RawData.
+
+    Returns:
+        Season: The season.
+    """
+    rounds = pd.to_numeric(raw_data['Round'], errors='coerce')
+
+    first_round = int(rounds.min()) if first_round is None else first_round
+    last_round = int(rounds.max()) if last_round is None else last_round
+
+    # Games without a round count as played before the season, like in GameHistoryIndex.
+    before = raw_data[~(rounds >= first_round)]
+    history, players, rtgs, col_pref = load_pairing_input(pairing_maker, before)
+
+    season_rounds = []
+    for round in range(first_round, last_round + 1):
+        games = raw_data[rounds == round]
+        played = set(games['White']) | set(games['Black'])
+        season_rounds.append([player for player in players if player in played] if len(games) > 0 else players)
+
+    start_dates = pd.to_numeric(before['Start_Date'], errors='coerce').dropna()
+    start_date = (start_dates.max() if len(start_dates) > 0 else 0) + ROUND_SECONDS
+
+    return Season(history, season_rounds, rtgs, col_pref, float(start_date))
+
+
+def expected_score(rtg: float, opp_rtg: float) -> float:
+    """The expected score of a player against an opponent, as in the Elo ratings."""
+    return 1 / (1 + 10 ** ((opp_rtg - rtg) / 400))
+
+
+def sample_score(rng: random.Random, white_rtg: float, black_rtg: float) -> float:
+    """Samples the result of a game from the ratings of the players.
+
+    Args:
+        rng (random.Random): The random number generator.
+        white_rtg (float): The rating of the white player.
+        black_rtg (float): The rating of the black player.
+
+    Returns:
+        float: The score of the white player, 1, 0.5 or 0.
+    """
+    expected = expected_score(white_rtg, black_rtg)
+    draw = DRAW_RATE * 2 * min(expected, 1 - expected)
+    u = rng.random()
+
+    if u < expected - draw / 2:
+        return 1
+    if u < expected + draw / 2:
+        return 0.5
+    return 0
+
+
+def simulate_season(season: Season, policy: PairingPolicy, seed: int, odd_player: str = 'lowest-rated', solver: str = None, k: int = DEFAULT_K) -> Dict[str, float]:
+    """Plays a season with a pairing policy. Each round is paired like generate_rounds does, the
+    results are sampled from the ratings, which are then updated, and the games are added to the
+    history the next round is paired with.
+
+    Args:
+        season (Season): What the season starts from.
+        policy (PairingPolicy): The pairing policy.
+        seed (int): The seed of the results. Seasons with the same seed sample the same random
+        numbers, so policies are compared on the same luck.
+        odd_player (str, optional): One of ODD_PLAYER_RULES, see generate_rounds. Defaults to 'lowest-rated'.
+        solver (str, optional): See pair_players.
+        k (int, optional): See pair_players.
+
+    Returns:
+        Dict[str, float]: The metrics of the season:
+            games: the number of games,
+            unpaired: the number of times a player of a round wasn't paired,
+            rematch_rate: the share of games between players who had met before,
+            mean_gap, max_gap: the rating difference of the games,
+            color_imbalance, max_color_imbalance: how many more games players had with one color
+            than with the other over the season, on average and at most.
+    """
+    rng = random.Random(seed)
+    history = copy.deepcopy(season.history)
+    rtgs = dict(season.rtgs)
+    col_pref = dict(season.col_pref)
+    colors = dict()
+    gaps = []
+    rematches = unpaired = 0
+
+    for round, round_players in enumerate(season.rounds):
+        [round_games] = generate_rounds(history, round_players, rtgs, col_pref, 1, odd_player, solver=solver, k=k, policy=policy)
+        unpaired += len(set(round_players).difference(*round_games))
+
+        for white, black in round_games:
+            gaps.append(abs(rtgs[white] - rtgs[black]))
+            rematches += history.recent_game(white, black) is not None
+
+            score = sample_score(rng, rtgs[white], rtgs[black])
+            change = ELO_K * (score - expected_score(rtgs[white], rtgs[black]))
+            rtgs[white] += change
+            rtgs[black] -= change
+
+            colors[white] = colors.get(white, 0) + 1
+            colors[black] = colors.get(black, 0) - 1
+            col_pref[white] += 1
+            col_pref[black] -= 1
+
+            history.add_game(white, black, season.start_date + round * ROUND_SECONDS, SCORE_RESULTS[score])
+
+    imbalances = [abs(balance) for balance in colors.values()]
+
+    return {
+        'games': len(gaps),
+        'unpaired': unpaired,
+        'rematch_rate': rematches / len(gaps) if len(gaps) > 0 else 0.0,
+        'mean_gap': statistics.fmean(gaps) if len(gaps) > 0 else 0.0,
+        'max_gap': max(gaps, default=0.0),
+        'color_imbalance': statistics.fmean(imbalances) if len(imbalances) > 0 else 0.0,
+        'max_color_imbalance': max(imbalances, default=0),
+    }
+
+
+# The season simulated by the worker processes, sent once when they start.
+_SEASON: Optional[Season] = None
+
+
+def _init_worker(season: Season):
+    global _SEASON
+    _SEASON = season
+
+
+def _simulate(task) -> Dict[str, float]:
+    policy, seed, options = task
+    return simulate_season(_SEASON, policy, seed, **options)
+
+
+def simulate_policies(season: Season, policies: List[PairingPolicy], seeds: int = 20, workers: Optional[int] = None, **options) -> pd.DataFrame:
+    """Simulates the season with each policy and seed. The seasons are played in a pool of
+    worker processes that receive the season once.
+
+    Args:
+        season (Season): What the seasons start from.
+        policies (List[PairingPolicy]): The pairing policies to compare.
+        seeds (int, optional): The number of seasons per policy. Defaults to 20.
+        workers (Optional[int], optional): The number of worker processes. Defaults to the
+        number of CPUs.
+        **options: The odd_player, solver and k passed to simulate_season.
+
+    Returns:
+        pd.DataFrame: The policy, seed and metrics of each simulated season.
+
+    Raises:
+        ValueError: If two policies have the same name.
+    """
+    names = [policy.name for policy in policies]
+    if len(set(names)) < len(names):
+        raise ValueError(f"The policies need different names, got {', '.join(names)}")
+
+    tasks = [(policy, seed, options) for policy in policies for seed in range(seeds)]
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+
+    count('simulate.seasons', len(tasks))
+
+    with span('simulate.seasons'):
+        if workers <= 1:
+            results = [simulate_season(season, policy, seed, **options) for policy, seed, _ in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(season,)) as executor:
+                results = list(executor.map(_simulate, tasks))
+
+    return pd.DataFrame([{'policy': policy.name, 'seed': seed, **result} for (policy, seed, _), result in zip(tasks, results)])
+
+
+def summarize_policies(results: pd.DataFrame) -> pd.DataFrame:
+    """Averages the metrics of the simulated seasons of each policy.
+
+    Args:
+        results (pd.DataFrame): The simulated seasons, see simulate_policies.
+
+    Returns:
+        pd.DataFrame: The mean and standard deviation of each metric, one row per policy in the
+        order they were simulated.
+    """
+    return results.groupby('policy', sort=False)[SEASON_METRICS].agg(['mean', 'std'])
+
+
+def format_summary(summary: pd.DataFrame, policies: List[PairingPolicy], fmt: str = 'text') -> str:
+    """Formats the comparison of the policies.
+
+    Args:
+        summary (pd.DataFrame): The averaged metrics, see summarize_policies.
+        policies (List[PairingPolicy]): The policies.
+        fmt (str, optional): 'text' for a table of the means or 'json'. Defaults to 'text'.
+
+    Returns:
+        str: The formatted comparison.
+    """
+    if fmt == 'json':
+        return json.dumps({
+            'policies': [policy.to_dict() for policy in policies],
+            'metrics': {policy: {metric: dict(summary.loc[policy, metric].fillna(0)) for metric in SEASON_METRICS} for policy in summary.index},
+        }, indent=2)
+
+    means = summary.xs('mean', axis=1, level=1)
+    means.columns = [col.replace('_', ' ') for col in means.columns]
+
+    return means.round({'games': 1, 'unpaired': 1, 'rematch rate': 3, 'mean gap': 1, 'max gap': 1, 'color imbalance': 2, 'max color imbalance': 2}).to_string()
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description='Replays rounds of RawData with different pairing policies and compares the simulated seasons.')
+    parser.add_argument('--rounds', default=':', metavar='FIRST:LAST', help='the rounds to simulate, rounds after the last one in RawData pair all players, e.g. 10:20 (default: all rounds)')
+    parser.add_argument('--policy', action='append', metavar='NAME:OPTIONS', help=f"a policy to simulate, e.g. wide:recent=8,gap_exponent=2 with the options {', '.join(POLICY_OPTIONS)}; can be repeated (default: the league's policy and a few alternatives)")
+    parser.add_argument('--seeds', type=int, default=20, help='number of simulated seasons per policy (default: 20)')
+    parser.add_argument('--workers', type=int, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--odd-player', choices=ODD_PLAYER_RULES, default='lowest-rated', help='who receives a 2nd pairing with an odd number of players (default: lowest-rated)')
+    parser.add_argument('--solver', help="matching solver: 'reference' or one of the pairing_engine solvers (default: fastest installed)")
+    parser.add_argument('--k', type=int, default=DEFAULT_K, help=f'number of neighbours by rating on either side considered as opponents, only widened when they can\'t pair everyone; the pairing is the best among them, not always over all players (default: {DEFAULT_K})')
+    parser.add_argument('--format', choices=['text', 'json', 'csv'], default='text', help='output format, csv lists every simulated season (default: text)')
+    parser.add_argument('--output', help='file to write the comparison to instead of stdout')
+    parser.add_argument('--offline', action='store_true', help='read PairingMaker and RawData from the local snapshot instead of the spreadsheet')
+    add_report_args(parser)
+    args = parser.parse_args(argv)
+
+    with run_report('simulate', args.report, args.profile):
+        if args.offline:
+            pairing_maker, raw_data = load_snapshots(['PairingMaker', 'RawData'])
+        else:
+            (pairing_maker, _), (raw_data, _) = download_as_dataframes(init_gspread_api(), [('Pairing_Maker', 'PairingMaker'), ('RawData', 'RawData')])
+
+        policies = [PairingPolicy.parse(spec) for spec in args.policy or CANDIDATE_POLICIES]
+        season = load_season(pairing_maker, raw_data, *parse_rounds(args.rounds))
+
+        results = simulate_policies(season, policies, args.seeds, args.workers, odd_player=args.odd_player, solver=args.solver, k=args.k)
+
+        if args.format == 'csv':
+            output = results.to_csv(index=False)
+        else:
+            output = format_summary(summarize_policies(results), policies, args.format)
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + '\n')
+        else:
+            print(output)
+
+
+if __name__ == '__main__':
+    main()
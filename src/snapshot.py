@@ -0,0 +1,220 @@
+import argparse
+import json
+import os
+import pandas as pd
+
+from datetime import datetime
+from typing import Any, Dict, List
+
+from apis import init_gspread_api
+from gspread_utils import download_as_dataframes
+from instrumentation import add_report_args, count, run_report, span, timed
+
+
+SNAPSHOT_DIR = 'data/snapshot'
+
+# The tables in the snapshot and the worksheet and named range each of them is downloaded from.
+SNAPSHOT_TABLES = {
+    'RawData': ('RawData', 'RawData'),
+    'PlayersRaw': ('Players_Backend', 'PlayersRaw'),
+    'PairingMaker': ('Pairing_Maker', 'PairingMaker'),
+}
+
+# Columns that hold unix timestamps (in s).
+TIMESTAMP_COLUMNS = {'Start_Date', 'Termination_Date'}
+
+# Columns that stay text even if all their values look like numbers.
+TEXT_COLUMNS = {'ID', 'id'}
+
+
+def is_available() -> bool:
+    """Checks whether pyarrow, which reads and writes the snapshot, is installed."""
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def typed_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Gives the columns of a downloaded table their types. Columns whose values are all numbers
+    become nullable integers or floats, TIMESTAMP_COLUMNS become UTC timestamps and text columns
+    with many repeated values, like the players or the results, become categoricals. Empty cells
+    of number columns become missing values, text columns keep them as empty strings.
+
+    Args:
+        df (pd.DataFrame): The table as downloaded, all values are strings.
+
+    Returns:
+        pd.DataFrame: The typed table.
+    """
+    columns = dict()
+
+    for col in df.columns:
+        values = df[col].astype(str)
+        empty = values == ''
+        numbers = pd.to_numeric(values.where(~empty), errors='coerce')
+
+        if col not in TEXT_COLUMNS and (numbers.notna() | empty).all() and not empty.all():
+            if col in TIMESTAMP_COLUMNS:
+                columns[col] = pd.to_datetime(numbers, unit='s', utc=True).astype('datetime64[s, UTC]')
+            elif (numbers.dropna() % 1 == 0).all():
+                columns[col] = numbers.round().astype('Int64')
+            else:
+                columns[col] = numbers.astype('float64')
+        elif col not in TEXT_COLUMNS and values.nunique() <= len(values) // 2:
+            columns[col] = values.astype('category')
+        else:
+            columns[col] = values
+
+    return pd.DataFrame(columns, index=df.index)
+
+
+def _path(name: str, path: str) -> str:
+    return os.path.join(path, f'{name}.arrow')
+
+
+@timed('snapshot.write')
+def write_snapshot(tables: Dict[str, pd.DataFrame], path: str = SNAPSHOT_DIR):
+    """Writes typed tables to the snapshot as uncompressed Arrow IPC files, so that they can be
+    memory-mapped when they are read. Each file replaces the previous one in one step.
+
+    Args:
+        tables (Dict[str, pd.DataFrame]): The tables as downloaded, by name.
+        path (str, optional): The directory of the snapshot. Defaults to SNAPSHOT_DIR.
+    """
+    import pyarrow as pa
+
+    os.makedirs(path, exist_ok=True)
+
+    for name, df in tables.items():
+        table = pa.Table.from_pandas(typed_frame(df), preserve_index=False)
+        table = table.replace_schema_metadata({
+            **table.schema.metadata,
+            b'snapshot': json.dumps({'written_at': datetime.now().isoformat(timespec='seconds')}).encode(),
+        })
+
+        with pa.OSFile(_path(name, path) + '.tmp', 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+        os.replace(_path(name, path) + '.tmp', _path(name, path))
+        count('snapshot.rows_written', table.num_rows)
+
+
+def load_snapshot(name: str, path: str = SNAPSHOT_DIR, timestamps: bool = False) -> pd.DataFrame:
+    """Loads a table from the snapshot. The file is memory-mapped, so only the columns that are
+    used are read from disk.
+
+    Args:
+        name (str): The name of the table, see SNAPSHOT_TABLES.
+        path (str, optional): The directory of the snapshot. Defaults to SNAPSHOT_DIR.
+        timestamps (bool, optional): Whether to load TIMESTAMP_COLUMNS as timestamps, otherwise
+        they are unix timestamps (in s) like in the sheet. Defaults to False.
+
+    Returns:
+        pd.DataFrame: The typed table.
+
+    Raises:
+        FileNotFoundError: If the table isn't in the snapshot.
+    """
+    import pyarrow as pa
+
+    if not os.path.exists(_path(name, path)):
+        raise FileNotFoundError(f"The snapshot has no table {name}, run 'python -m src snapshot' or the weekly update first.")
+
+    with span('snapshot.load'), pa.memory_map(_path(name, path)) as source:
+        table = pa.ipc.open_file(source).read_all()
+
+        if not timestamps:
+            for idx, field in enumerate(table.schema):
+                if pa.types.is_timestamp(field.type):
+                    table = table.set_column(idx, pa.field(field.name, pa.int64()), table.column(idx).cast(pa.int64()))
+
+        # The integer columns are restored as nullable integers from the pandas metadata.
+        return table.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+
+
+def load_snapshots(names: List[str], path: str = SNAPSHOT_DIR) -> List[pd.DataFrame]:
+    """Loads several tables from the snapshot, see load_snapshot.
+
+    Args:
+        names (List[str]): The names of the tables.
+        path (str, optional): The directory of the snapshot. Defaults to SNAPSHOT_DIR.
+
+    Returns:
+        List[pd.DataFrame]: The tables, in order.
+    """
+    return [load_snapshot(name, path) for name in names]
+
+
+def snapshot_info(path: str = SNAPSHOT_DIR) -> Dict[str, Dict[str, Any]]:
+    """Describes the tables in the snapshot.
+
+    Args:
+        path (str, optional): The directory of the snapshot. Defaults to SNAPSHOT_DIR.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: The number of rows, the columns with their types and when the
+        table was written, by name.
+    """
+    import pyarrow as pa
+
+    info = dict()
+
+    for name in SNAPSHOT_TABLES:
+        if not os.path.exists(_path(name, path)):
+            continue
+
+        with pa.memory_map(_path(name, path)) as source:
+            reader = pa.ipc.open_file(source)
+            meta = json.loads(reader.schema.metadata.get(b'snapshot', b'{}'))
+            rows = sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+
+            info[name] = {'rows': rows, 'columns': {field.name: str(field.type) for field in reader.schema}, **meta}
+
+    return info
+
+
+def update_snapshot(spreadsheet, path: str = SNAPSHOT_DIR, tables: Dict[str, pd.DataFrame] = None):
+    """Downloads the tables of the snapshot in a single request and writes them. Does nothing
+    if pyarrow isn't installed.
+
+    Args:
+        spreadsheet (Spreadsheet): The league spreadsheet.
+        path (str, optional): The directory of the snapshot. Defaults to SNAPSHOT_DIR.
+        tables (Dict[str, pd.DataFrame], optional): Tables that have already been downloaded since
+        the last upload, by name. Only the others are downloaded. Defaults to None.
+    """
+    if not is_available():
+        print('pyarrow is not installed, the snapshot is not written.')
+        return
+
+    tables = dict(tables or {})
+    missing = [name for name in SNAPSHOT_TABLES if name not in tables]
+
+    if len(missing) > 0:
+        for name, (df, _) in zip(missing, download_as_dataframes(spreadsheet, [SNAPSHOT_TABLES[name] for name in missing])):
+            tables[name] = df
+
+    write_snapshot(tables, path)
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description='Writes the local snapshot of RawData, PlayersRaw and PairingMaker.')
+    parser.add_argument('--info', action='store_true', help="describe the snapshot instead of updating it")
+    add_report_args(parser)
+    args = parser.parse_args(argv)
+
+    if args.info:
+        print(json.dumps(snapshot_info(), indent=2))
+        return
+
+    with run_report('snapshot', args.report, args.profile):
+        update_snapshot(init_gspread_api())
+
+        for name, info in snapshot_info().items():
+            print(f"{name}: {info['rows']} rows, {len(info['columns'])} columns")
+
+
+if __name__ == '__main__':
+    main()